@@ -2,146 +2,245 @@
 
 import argparse
 import logging
+from datetime import datetime, timezone
+from functools import partial
+from typing import Any, Callable, Iterator, List, Sequence, Tuple
 
-import celery
+from celery.canvas import Signature
+from sqlalchemy import Row, Select, func, select
 from sqlalchemy.orm import Session
 from tqdm import tqdm
 
-from celeryworker import process_cdx_record
-from gatherspecimens.schema import (Base, CdxRecordSpecimen, MementoFailure,
-                                    MementoSpecimen)
+from celeryworker import process_cdx_record, process_cdx_records
+from gatherspecimens.failures import clear_recovered_failures
+from gatherspecimens.scheduler import SlidingWindow
+from gatherspecimens.schema import CdxRecordSpecimen, create_schema
+from gatherspecimens.selection import (GATHER_ORDERS, ID,
+                                       NEAR_DUPLICATE_POLICIES,
+                                       PENDING_COLUMNS, pending_records,
+                                       prioritize, retryable_records)
 from gatherspecimens.utils import common_logging, get_engine
 
 log = logging.getLogger(__name__)
 
 
+# How records are sent to worker tasks: as full dictionaries, as packed lists
+# of values, or as ids alone, which workers load from the database.
+PAYLOADS = ("record", "packed", "id")
+
+
+def task_payload(record: Row, payload: str) -> Any:
+    """Convert a selected record into a task payload."""
+    if payload == "id":
+        return record.id
+    if payload == "packed":
+        return CdxRecordSpecimen.to_packed(record)
+    return record._asdict()
+
+
+def make_jobs(
+    records: Sequence[Row], batch_size: int, payload: str = "record"
+) -> List[Signature]:
+    """Create Celery task signatures for records, batched if required."""
+    # Need to serialize the record to pass it to the Celery task
+    sers = [task_payload(record, payload) for record in records]
+    if batch_size <= 1:
+        return [process_cdx_record.s(ser) for ser in sers]
+    return [
+        process_cdx_records.s(sers[i : i + batch_size])
+        for i in range(0, len(sers), batch_size)
+    ]
+
+
+def record_results(value: Any, batch_size: int) -> Iterator[Tuple[int, str]]:
+    """Iterate over the per-record results of a finished task."""
+    if batch_size <= 1:
+        yield value
+    else:
+        yield from value
+
+
+def pending_jobs(
+    db_session: Session,
+    start: int,
+    chunk_size: int,
+    batch_size: int,
+    payload: str,
+    pbar: tqdm,
+    select_chunk: Callable[[int, int, Sequence[Any]], Select] = pending_records,
+) -> Iterator[Signature]:
+    """Select records that still need gathering a chunk at a time, as task jobs."""
+    # Ids alone don't need the rest of the columns.
+    columns = (CdxRecordSpecimen.id,) if payload == "id" else PENDING_COLUMNS
+    last_id = max(start - 1, 0)
+    pbar.update(last_id)
+
+    while True:
+        results = db_session.execute(select_chunk(last_id, chunk_size, columns)).all()
+        if not results:
+            return
+
+        jobs = make_jobs(results, batch_size, payload)
+        log.debug("[%d] Submitting %d jobs", last_id, len(jobs))
+        yield from jobs
+
+        # Update the progress bar with the ids covered by this chunk
+        pbar.update(results[-1].id - last_id)
+        last_id = results[-1].id
+
+
+def prioritized_jobs(
+    db_session: Session,
+    rounds: int,
+    start: int,
+    chunk_size: int,
+    batch_size: int,
+    payload: str,
+    pbar: tqdm,
+    select_chunk: Callable[..., Select] = pending_records,
+) -> Iterator[Signature]:
+    """Select records that still need gathering round by round, as task jobs.
+
+    Each round is selected by id like a normal pass, and the progress bar
+    restarts for each round.
+    """
+    for priority_round in range(1, rounds + 1):
+        pbar.reset()
+        pbar.set_description(f"Round {priority_round}/{rounds}")
+        yield from pending_jobs(
+            db_session,
+            start,
+            chunk_size,
+            batch_size,
+            payload,
+            pbar,
+            partial(select_chunk, priority_round=priority_round),
+        )
+
+
 def main():
     """Process records to gather pages."""
     parser = argparse.ArgumentParser(description="Process records to gather pages.")
     parser.add_argument(
-        "--start", type=int, default=0, help="Starting offset for processing"
+        "--start", type=int, default=0, help="CDX record id to start processing from"
     )
     # Chunk size is the number of records to process at a time. Setting this too
     # large will eat up your memory.
     parser.add_argument(
         "--chunk-size", type=int, default=1000, help="Size of chunks to process"
     )
+    # Batch size is the number of records handled by each task. Batched tasks
+    # fetch their records concurrently and store them all in one commit.
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="Number of records per task (1: one task per record)",
+    )
+    # Smaller payloads use less broker memory and serialization time.
+    parser.add_argument(
+        "--payload",
+        choices=PAYLOADS,
+        default="record",
+        help=(
+            "Send full records, packed records, or only record ids to tasks "
+            "(default: record)"
+        ),
+    )
+    # The window is the number of tasks sent to workers but not yet finished.
+    # It should be large enough to keep every worker busy.
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=1000,
+        help="Number of tasks to keep in flight (default: 1000)",
+    )
+    # Failed records are not selected again by a normal pass. A retry pass
+    # selects only those with transient failures whose backoff has passed.
+    parser.add_argument(
+        "--retry-failures",
+        action="store_true",
+        help="Retry records with transient failures instead of new records",
+    )
+    # Captures of a page that are near-duplicates of gathered ones, going by
+    # the clusters from `nearduplicates`, can be left out of a normal pass.
+    parser.add_argument(
+        "--near-duplicates",
+        choices=NEAR_DUPLICATE_POLICIES,
+        help="Skip records that are likely near-duplicates of gathered ones",
+    )
+    # Prioritized orders gather one capture of every URL before any URL's
+    # history, so useful coverage arrives early in a long run.
+    parser.add_argument(
+        "--order",
+        choices=GATHER_ORDERS,
+        default=ID,
+        help=(
+            "Gather records by id, or in rounds taking the latest, earliest or "
+            "spread-out captures of each URL first (default: id)"
+        ),
+    )
     args = parser.parse_args()
 
     engine = get_engine("config.json")
-    Base.metadata.create_all(engine)
+    create_schema(engine)
+
+    window = SlidingWindow(args.window)
+
+    select_chunk: Callable[[int, int, Sequence[Any]], Select] = partial(
+        pending_records, near_duplicates=args.near_duplicates
+    )
+    if args.retry_failures:
+        now = datetime.now(timezone.utc)
+        select_chunk = partial(retryable_records, now=now)
+        with Session(engine) as db_session:
+            cleared = clear_recovered_failures(db_session)
+            db_session.commit()
+        log.info("Cleared %d failures of records since gathered", cleared)
 
     with Session(engine) as db_session:
-        # Get the total number of records
-        cdx_query = db_session.query(CdxRecordSpecimen)
-        total_records = cdx_query.count()
-        log.info("Total records: %d", total_records)
+        # The highest id gives the progress bar a total without a full count.
+        max_id = db_session.scalar(select(func.max(CdxRecordSpecimen.id))) or 0
+        log.info("Maximum record id: %d", max_id)
 
         # Use tqdm to show a progress bar
-        with tqdm(total=total_records) as pbar:
-            pbar.update(args.start)
-
-            # Initialize the job groups
-            groups = []
-
-            # In steps of chunk_size, process the records.
-            for offset in range(args.start, total_records, args.chunk_size):
-                results = (
-                    cdx_query.order_by(CdxRecordSpecimen.id)
-                    .limit(args.chunk_size)
-                    .offset(offset)
-                    .all()
+        with tqdm(total=max_id) as pbar:
+            jobs: Iterator[Signature]
+            if args.order != ID and not args.retry_failures:
+                rounds = prioritize(db_session, args.order)
+                db_session.commit()
+                log.info("Gathering in %d rounds by %s", rounds, args.order)
+                jobs = prioritized_jobs(
+                    db_session,
+                    rounds,
+                    args.start,
+                    args.chunk_size,
+                    args.batch_size,
+                    args.payload,
+                    pbar,
+                    select_chunk,
                 )
-
-                # Get the IDs from the results
-                ids = [record.id for record in results]
-
-                # Check if any of the records have already been scraped
-                already_scraped = set(
-                    [
-                        s.id
-                        for s in db_session.query(MementoSpecimen).filter(
-                            MementoSpecimen.id.in_(ids)
-                        )
-                    ]
+            else:
+                jobs = pending_jobs(
+                    db_session,
+                    args.start,
+                    args.chunk_size,
+                    args.batch_size,
+                    args.payload,
+                    pbar,
+                    select_chunk,
                 )
-                already_failed = set(
-                    [
-                        s.id
-                        for s in db_session.query(MementoFailure).filter(
-                            MementoFailure.id.in_(ids)
-                        )
-                    ]
-                )
-                log.info(
-                    "[%d] Already scraped: %d; already failed: %d",
-                    offset,
-                    len(already_scraped),
-                    len(already_failed),
-                )
-
-                # Create a list to hold the celery jobs
-                jobs = []
-
-                for record in results:
-                    # If the record had a 4xx or higher status code
-                    # then there's no point in archiving it.
-                    if record.status_code and record.status_code >= 400:
-                        log.warning(
-                            "[%d] Record %s had error: status code %d",
-                            record.id,
-                            record.url,
-                            record.status_code,
-                        )
-                        continue
-
-                    # If the record was already scraped or already failed,
-                    # then don't try to get it again.
-                    if record.id in already_scraped:
-                        log.info(
-                            "[%d] Record %s already scraped", record.id, record.raw_url
-                        )
-                        continue
-                    elif record.id in already_failed:
-                        log.info(
-                            "[%d] Record %s previously failed",
-                            record.id,
-                            record.raw_url,
-                        )
-                        continue
-
-                    # Need to serialize the record to pass it to the Celery task
-                    ser = record.to_serializable()
-
-                    jobs.append(process_cdx_record.s(ser))
-
-                # Create a celery group so the jobs can
-                # be gotten in a batch when ready.
-                log.debug("Submitting %d jobs", len(jobs))
-                job_group = celery.group(jobs)
-                res = job_group.apply_async()
-                groups.append(res)
-
-                try:
-                    # If the first group is ready, or the groups list is too long,
-                    # then wait for the first group to finish.
-                    # Otherwise, continue processing the next chunk so that the
-                    # workers don't go idle.
-                    if groups[0].ready() or len(groups) > 5:
-                        wait_group = groups.pop(0)
-                        for record_id, result_str in wait_group.get():
-                            log.info("[%d] Processed record: %s", record_id, result_str)
-
-                except Exception as e:
+            # Each finished task is replaced straight away, so the workers
+            # always have a full window of tasks to work on.
+            for outcome in window.run(jobs):
+                pbar.set_postfix(in_flight=window.in_flight, refresh=False)
+                if outcome.error is not None:
                     # If there was an error processing the records, log it but continue
-                    log.error("Error processing records: %s", e)
-
-                # Update the progress bar with the chunk size
-                pbar.update(args.chunk_size)
-
-            # Finish off the job groups that are left over.
-            for group in groups:
-                for record_id, result_str in group.get():
+                    log.error("Error processing records: %s", outcome.error)
+                    continue
+                for record_id, result_str in record_results(
+                    outcome.value, args.batch_size
+                ):
                     log.info("[%d] Processed record: %s", record_id, result_str)
 
 
@@ -2,17 +2,33 @@
 
 import logging
 import time
-from typing import Any, Dict, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
+from pathlib import Path
+from typing import (Any, Dict, List, Optional, OrderedDict, Sequence, Tuple,
+                    Union)
 
 import wayback
-from celery import Celery, Task
+from celery import Celery, Task, signals
+from celery.concurrency import get_implementation
 from celery.exceptions import SoftTimeLimitExceeded
+from celery.utils.log import current_process_index
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
-from wayback.exceptions import MementoPlaybackError
 
-from gatherspecimens.schema import (CdxRecordSpecimen, MementoFailure,
-                                    MementoSpecimen)
+from gatherspecimens import blobstore
+from gatherspecimens.compression import Dictionary
+from gatherspecimens.failures import TIME_LIMIT, record_failure
+from gatherspecimens.gather import (group_by_digest, result_class,
+                                    store_deduplicated, store_error,
+                                    store_memento, stored_group_results,
+                                    trusted_digest)
+from gatherspecimens.metrics import (COMMIT_SECONDS, FETCH_SECONDS,
+                                     RESPONSE_BYTES, RESULTS, start_exporter)
+from gatherspecimens.ratecontrol import (controllers_from_config,
+                                         mount_controllers)
+from gatherspecimens.schema import (CdxRecordSpecimen, CompressionDictionary,
+                                    MementoBlob)
 from gatherspecimens.utils import get_engine
 
 app = Celery("celeryworker")
@@ -22,36 +38,164 @@ log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
 
+@signals.worker_init.connect
+def start_worker_metrics(sender: Any = None, **kwargs):
+    """Export metrics from the worker, unless its pool has its own processes."""
+    pool = get_implementation(sender.pool_cls) if sender else None
+    if pool is None or "prefork" not in pool.__module__:
+        start_exporter(Path("config.json"))
+
+
+@signals.worker_process_init.connect
+def start_process_metrics(**kwargs):
+    """Export metrics from a prefork pool process.
+
+    Each process serves metrics on the configured port plus its index in the
+    pool, so that the processes don't all try to bind the same port.
+    """
+    start_exporter(Path("config.json"), port_offset=current_process_index(base=0) or 0)
+
+
+# The number of mementos fetched at once by a batch task.
+BATCH_CONCURRENCY = 8
+
+# The number of records kept in each worker process after loading them by id.
+RECORD_CACHE_SIZE = 10000
+
+# A task payload: a record id, a packed record, or a serialized record.
+Payload = Union[int, List[Any], Dict[str, Any]]
+
+
 class DistributedWayback(Task):
     """Task for distributed Wayback processing."""
 
     def __init__(self):
         """Set up common resources for the task."""
         self.engine = get_engine("config.json")
+        blobstore.configure_from_config("config.json")
         self.session = wayback.WaybackSession(retries=20, backoff=0.5)
+        mount_controllers(self.session, controllers_from_config("config.json"))
         self.client = wayback.WaybackClient(session=self.session)
         self.countdown = 10
+        self._dictionaries: Optional[Dict[str, Dictionary]] = None
+        self.record_cache: OrderedDict[int, CdxRecordSpecimen] = OrderedDict()
 
+    @property
+    def dictionaries(self) -> Dict[str, Dictionary]:
+        """Load the compression dictionaries the first time they're needed."""
+        if self._dictionaries is None:
+            with Session(self.engine) as db_session:
+                self._dictionaries = CompressionDictionary.latest_by_name(db_session)
+        return self._dictionaries
 
-# Add some time limits - some jobs lock up when trying to gather mementos
-# and the time limits will kill them as necessary.
-@app.task(base=DistributedWayback, bind=True, soft_time_limit=120, time_limit=150)
-def process_cdx_record(
-    self: DistributedWayback, ser: Dict[str, Any]
-) -> Tuple[int, str]:
-    """Process a CdxRecordSpecimen and stores the memento in the database."""
-    record_specimen = CdxRecordSpecimen.from_serializable(ser)
-    record = record_specimen.to_cdx_record()
-    log.info("[%d] Processing record", record_specimen.id)
+    def load_records(
+        self, payloads: Sequence[Payload]
+    ) -> Tuple[List[CdxRecordSpecimen], List[int]]:
+        """Turn task payloads into records, returning them and any missing ids.
+
+        Records sent by id are taken from the cache where possible, and the
+        rest are loaded with a single query.
+        """
+        ids = [payload for payload in payloads if isinstance(payload, int)]
+        loaded = {
+            record_id: self.record_cache[record_id]
+            for record_id in ids
+            if record_id in self.record_cache
+        }
+        uncached = [record_id for record_id in ids if record_id not in loaded]
+        if uncached:
+            with Session(self.engine) as db_session:
+                loaded.update(CdxRecordSpecimen.load_many(db_session, uncached))
 
-    if record.status_code and record.status_code >= 400:
+        for record_id, record_specimen in loaded.items():
+            self.record_cache[record_id] = record_specimen
+            self.record_cache.move_to_end(record_id)
+        while len(self.record_cache) > RECORD_CACHE_SIZE:
+            self.record_cache.popitem(last=False)
+
+        record_specimens = []
+        missing = []
+        for payload in payloads:
+            if isinstance(payload, int):
+                if payload in loaded:
+                    record_specimens.append(loaded[payload])
+                else:
+                    missing.append(payload)
+            elif isinstance(payload, list):
+                record_specimens.append(CdxRecordSpecimen.from_packed(payload))
+            else:
+                record_specimens.append(CdxRecordSpecimen.from_serializable(payload))
+        return record_specimens, missing
+
+    def fetch_memento(self, record_specimen: CdxRecordSpecimen) -> wayback.Memento:
+        """Fetch the memento for a record."""
+        start_time = time.time()
+        memento = self.client.get_memento(record_specimen.to_cdx_record())
+        memento_time = time.time() - start_time
+        log.info("[%s] Memento gather time: %s", record_specimen.id, memento_time)
+        FETCH_SECONDS.observe(memento_time)
+        RESPONSE_BYTES.observe(len(memento.content))
+        return memento
+
+    def commit(self, db_session: Session, label: Any) -> bool:
+        """Commit the session, returning whether the commit succeeded."""
+        db_start_time = time.time()
+        try:
+            db_session.commit()
+            committed = True
+        except SQLAlchemyError as e:
+            log.error("[%s] Error committing record: %s", label, e)
+            committed = False
+        db_time = time.time() - db_start_time
+        log.info("[%s] Database commit time: %s", label, db_time)
+        COMMIT_SECONDS.observe(db_time, component="worker")
+        return committed
+
+
+def status_code_error(record_specimen: CdxRecordSpecimen) -> Optional[str]:
+    """Return a result string if the record had an error status code."""
+    # If the record had a 4xx or higher status code
+    # then there's no point in archiving it.
+    if record_specimen.status_code and record_specimen.status_code >= 400:
         log.warning(
             "[%d] Record %s had error: status code %d",
             record_specimen.id,
             record_specimen.url,
             record_specimen.status_code,
         )
-        return (record_specimen.id, f"status code error: {record_specimen.status_code}")
+        return f"status code error: {record_specimen.status_code}"
+    return None
+
+
+def soft_time_limit_failure(
+    db_session: Session, record_id: int, e: SoftTimeLimitExceeded
+) -> str:
+    """Record a memento that hit the soft time limit as a failure."""
+    log.error("[%s] Result hit soft time limit: %s", record_id, e)
+    record_failure(db_session, record_id, TIME_LIMIT)
+    return f"soft time limit exceeded: {e}"
+
+
+# Add some time limits - some jobs lock up when trying to gather mementos
+# and the time limits will kill them as necessary.
+@app.task(base=DistributedWayback, bind=True, soft_time_limit=120, time_limit=150)
+def process_cdx_record(self: DistributedWayback, ser: Payload) -> Tuple[int, str]:
+    """Process a CdxRecordSpecimen and stores the memento in the database.
+
+    The record can be sent as a record id, a packed record or a serialized
+    record.
+    """
+    record_specimens, missing = self.load_records([ser])
+    if missing:
+        log.warning("[%d] Record not found", missing[0])
+        RESULTS.inc(result="missing record")
+        return missing[0], "missing record"
+    record_specimen = record_specimens[0]
+    log.info("[%d] Processing record", record_specimen.id)
+
+    status_error = status_code_error(record_specimen)
+    if status_error:
+        return record_specimen.id, status_error
 
     with Session(self.engine) as db_session:
         # The result string is a friendly return message to the user
@@ -59,47 +203,19 @@ def process_cdx_record(
         result_str = "unknown"
 
         try:
-            start_time = time.time()
-            memento = self.client.get_memento(record)
-            memento_time = time.time() - start_time
-            log.info("[%s] Memento gather time: %s", record_specimen.id, memento_time)
-
-            if memento.ok:
-                new_page = MementoSpecimen(
-                    id=record_specimen.id,
-                    hash_raw_url=record_specimen.hash_raw_url,
-                    raw_url=record_specimen.raw_url,
-                    url=record_specimen.url,
-                    mime_type=record_specimen.mime_type,
-                    status_code=record_specimen.status_code,
-                    time=record.timestamp,
-                    view_url=record_specimen.view_url,
-                    html_content=memento.content,
-                )
-                db_session.add(new_page)
-                log.info("[%s] Result processed %s", record_specimen.id, record.url)
-                result_str = "gathered"
+            # Captures with the same digest have the same content, so only the
+            # first one needs to be fetched and stored.
+            digest = trusted_digest(record_specimen)
+            if digest and MementoBlob.exists(db_session, digest):
+                result_str = store_deduplicated(db_session, record_specimen)
             else:
-                log.warning(
-                    "[%s] Memento had error: status code %d",
-                    record_specimen.id,
-                    memento.status_code,
+                memento = self.fetch_memento(record_specimen)
+                result_str = store_memento(
+                    db_session, record_specimen, memento, self.dictionaries
                 )
-                new_memfail = MementoFailure(id=record_specimen.id)
-                db_session.add(new_memfail)
-                result_str = f"memento error: {memento.status_code}"
 
         except SoftTimeLimitExceeded as e:
-            log.error("[%s] Result hit soft time limit: %s", record_specimen.id, e)
-            new_memfail = MementoFailure(id=record_specimen.id)
-            db_session.add(new_memfail)
-            result_str = f"soft time limit exceeded: {e}"
-
-        except MementoPlaybackError as e:
-            log.debug("[%s] Result hit mementoplaybackerror %s", record_specimen.id, e)
-            new_memfail = MementoFailure(id=record_specimen.id)
-            db_session.add(new_memfail)
-            result_str = f"memento playback error: {e}"
+            result_str = soft_time_limit_failure(db_session, record_specimen.id, e)
 
         except ConnectionResetError as e:
             log.error(
@@ -111,17 +227,97 @@ def process_cdx_record(
             raise self.retry(countdown=self.countdown, exc=e)
 
         except Exception as e:
-            log.debug("[%s] Result hit exception %s", record_specimen.id, e)
-            result_str = f"exception: {e}"
+            result_str = store_error(db_session, record_specimen, e)
 
-        db_start_time = time.time()
-        try:
-            db_session.commit()
-        except SQLAlchemyError as e:
-            log.error("[%s] Error committing record: %s", record_specimen.id, e)
+        if not self.commit(db_session, record_specimen.id):
             result_str = "error while committing"
-        db_time = time.time() - db_start_time
-        log.info("[%s] Database commit time: %s", record_specimen.id, db_time)
+
+    RESULTS.inc(result=result_class(result_str))
 
     # Return the ID that was processed and the result string
     return record_specimen.id, result_str
+
+
+@app.task(base=DistributedWayback, bind=True, soft_time_limit=600, time_limit=660)
+def process_cdx_records(
+    self: DistributedWayback, sers: List[Payload]
+) -> List[Tuple[int, str]]:
+    """Process a batch of CdxRecordSpecimens, fetching their mementos concurrently.
+
+    All of the results are stored in a single commit. The results are returned
+    in the same form as `process_cdx_record`, one per record, with records that
+    were sent by id but no longer exist returned last.
+    """
+    record_specimens, missing = self.load_records(sers)
+    log.info("Processing batch of %d records", len(record_specimens))
+
+    results: Dict[int, str] = {}
+    pending = []
+    for record_specimen in record_specimens:
+        status_error = status_code_error(record_specimen)
+        if status_error:
+            results[record_specimen.id] = status_error
+        else:
+            pending.append(record_specimen)
+
+    with Session(self.engine) as db_session:
+        groups = group_by_digest(pending)
+        stored = MementoBlob.existing(db_session, groups.keys())
+
+        # Content that is already stored doesn't need to be fetched again.
+        for digest in stored:
+            for record_specimen in groups.pop(digest):
+                results[record_specimen.id] = store_deduplicated(
+                    db_session, record_specimen
+                )
+
+        # Fetch the first record of each digest group concurrently.
+        executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY)
+        futures: Dict[str, Future] = {
+            key: executor.submit(self.fetch_memento, group[0])
+            for key, group in groups.items()
+        }
+        timed_out: Optional[SoftTimeLimitExceeded] = None
+        try:
+            wait_futures(futures.values())
+        except SoftTimeLimitExceeded as e:
+            timed_out = e
+        finally:
+            # Don't wait for fetches that are still running after a time limit.
+            for future in futures.values():
+                future.cancel()
+            executor.shutdown(wait=False)
+
+        for key, group in groups.items():
+            future = futures[key]
+            if not future.done() or future.cancelled():
+                # Anything still being fetched has hit the time limit.
+                assert timed_out is not None
+                first = group[0]
+                results[first.id] = soft_time_limit_failure(
+                    db_session, first.id, timed_out
+                )
+                for record_specimen in group[1:]:
+                    results[record_specimen.id] = "skipped: soft time limit exceeded"
+                continue
+
+            error = future.exception()
+            memento = None if error else future.result()
+            results.update(
+                stored_group_results(
+                    db_session, group, memento, error, self.dictionaries
+                )
+            )
+
+        if not self.commit(db_session, f"batch of {len(record_specimens)}"):
+            results = {record_id: "error while committing" for record_id in results}
+
+    for result_str in results.values():
+        RESULTS.inc(result=result_class(result_str))
+    if missing:
+        RESULTS.inc(len(missing), result="missing record")
+
+    return [
+        (record_specimen.id, results[record_specimen.id])
+        for record_specimen in record_specimens
+    ] + [(record_id, "missing record") for record_id in missing]
@@ -0,0 +1,467 @@
+"""Extracts articles from gathered pages, with a parser for each era of the site.
+
+The eras are described in WIZARDS.md:
+
+- `mtgcom`: `www.wizards.com/default.asp?x=...`, 2002 to 2008.
+- `magazine`: `www.wizards.com/Magic/Magazine/Article.aspx?x=...`, 2008 to 2014.
+- `drupal`: `magic.wizards.com` on Drupal's `wiz_mtg` theme, 2014 to 2018.
+- `drupal2`: the redesigned `wiz_mtg` theme, 2018 to 2022.
+- `contentful`: `magic.wizards.com` on Contentful, from November 2022.
+
+Pages are parsed with the standard library's HTML parser into a small tree,
+which is forgiving of the unclosed tags common on the older sites. Pages that
+match no era get a generic extraction of their title and text, and pages that
+can't be parsed at all are marked with the `error` era.
+"""
+
+import logging
+import re
+from dataclasses import dataclass
+from datetime import date
+from html.parser import HTMLParser
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+MTGCOM = "mtgcom"
+MAGAZINE = "magazine"
+DRUPAL = "drupal"
+DRUPAL2 = "drupal2"
+CONTENTFUL = "contentful"
+GENERIC = "generic"
+ERROR = "error"
+
+log = logging.getLogger(__name__)
+
+# Elements that never have content or an end tag.
+VOID_ELEMENTS = {
+    "area",
+    "base",
+    "br",
+    "col",
+    "embed",
+    "hr",
+    "img",
+    "input",
+    "link",
+    "meta",
+    "param",
+    "source",
+    "track",
+    "wbr",
+}
+
+# Elements whose content is not text.
+SKIPPED_ELEMENTS = {"script", "style", "noscript", "svg", "template"}
+
+# Elements that start a new line of text.
+BLOCK_ELEMENTS = {
+    "address",
+    "article",
+    "blockquote",
+    "br",
+    "dd",
+    "div",
+    "dl",
+    "dt",
+    "footer",
+    "h1",
+    "h2",
+    "h3",
+    "h4",
+    "h5",
+    "h6",
+    "header",
+    "hr",
+    "li",
+    "ol",
+    "p",
+    "pre",
+    "section",
+    "table",
+    "td",
+    "th",
+    "tr",
+    "ul",
+}
+
+# Suffixes the sites add to page titles.
+TITLE_SUFFIXES = re.compile(
+    r"\s*(\|\s*MAGIC: THE GATHERING|:?\s*Daily MTG\s*:\s*Magic: The Gathering)\s*$",
+    re.IGNORECASE,
+)
+
+MONTHS = {
+    name: number
+    for number, names in enumerate(
+        [
+            ("january", "jan"),
+            ("february", "feb"),
+            ("march", "mar"),
+            ("april", "apr"),
+            ("may",),
+            ("june", "jun"),
+            ("july", "jul"),
+            ("august", "aug"),
+            ("september", "sep", "sept"),
+            ("october", "oct"),
+            ("november", "nov"),
+            ("december", "dec"),
+        ],
+        start=1,
+    )
+    for name in names
+}
+
+DATE_PATTERN = re.compile(r"\b([A-Za-z]{3,9})\.? (\d{1,2}),? (\d{4})\b")
+
+# The original site started articles with an image of their first letter.
+DROPCAP_PATTERN = re.compile(r"/dropcap_([A-Za-z])\.\w+$")
+
+CHARSET_PATTERN = re.compile(rb"""charset=["']?([A-Za-z0-9_.:-]+)""", re.IGNORECASE)
+
+
+@dataclass(eq=False)
+class Element:
+    """An HTML element and its content. Elements are only equal to themselves."""
+
+    tag: str
+    attrs: Dict[str, str]
+    children: List[Union["Element", str]]
+
+    @property
+    def classes(self) -> List[str]:
+        """Return the element's classes."""
+        return self.attrs.get("class", "").split()
+
+    def iter(self) -> Iterator["Element"]:
+        """Iterate over the element and every element inside it, in order."""
+        yield self
+        for child in self.children:
+            if isinstance(child, Element):
+                yield from child.iter()
+
+    def find_all(
+        self, tag: Optional[str] = None, cls: Optional[str] = None, **attrs: str
+    ) -> List["Element"]:
+        """Find the elements inside this one with a tag, class and attributes."""
+        return [
+            element
+            for element in self.iter()
+            if (tag is None or element.tag == tag)
+            and (cls is None or cls in element.classes)
+            and all(element.attrs.get(name) == value for name, value in attrs.items())
+        ]
+
+    def find(
+        self, tag: Optional[str] = None, cls: Optional[str] = None, **attrs: str
+    ) -> Optional["Element"]:
+        """Find the first element inside this one with a tag, class and attributes."""
+        found = self.find_all(tag, cls, **attrs)
+        return found[0] if found else None
+
+    def lines(self) -> List[str]:
+        """Return the element's text as lines, with whitespace collapsed."""
+        lines: List[str] = []
+        current: List[str] = []
+
+        def walk(node: Union[Element, str]):
+            if isinstance(node, str):
+                current.append(node)
+                return
+            if node.tag == "img":
+                dropcap = DROPCAP_PATTERN.search(node.attrs.get("src", ""))
+                if dropcap:
+                    current.append(dropcap.group(1))
+                return
+            block = node.tag in BLOCK_ELEMENTS
+            if block:
+                end_line()
+            for child in node.children:
+                walk(child)
+            if block:
+                end_line()
+
+        def end_line():
+            line = " ".join("".join(current).split())
+            if line:
+                lines.append(line)
+            current.clear()
+
+        walk(self)
+        end_line()
+        return lines
+
+    def text(self) -> str:
+        """Return the element's text, one block per line."""
+        return "\n".join(self.lines())
+
+
+class TreeBuilder(HTMLParser):
+    """Builds a tree of elements from HTML, closing unclosed tags as needed."""
+
+    def __init__(self):
+        """Start with an empty document."""
+        super().__init__(convert_charrefs=True)
+        self.root = Element("document", {}, [])
+        self.stack = [self.root]
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        """Open an element."""
+        if self.skipping:
+            if tag in SKIPPED_ELEMENTS:
+                self.skipping += 1
+            return
+        if tag in SKIPPED_ELEMENTS:
+            self.skipping = 1
+            return
+        element = Element(tag, {name: value or "" for name, value in attrs}, [])
+        self.stack[-1].children.append(element)
+        if tag not in VOID_ELEMENTS:
+            self.stack.append(element)
+
+    def handle_startendtag(self, tag, attrs):
+        """Add an element with no content."""
+        if not self.skipping and tag not in SKIPPED_ELEMENTS:
+            element = Element(tag, {name: value or "" for name, value in attrs}, [])
+            self.stack[-1].children.append(element)
+
+    def handle_endtag(self, tag):
+        """Close an element, and any unclosed elements inside it."""
+        if self.skipping:
+            if tag in SKIPPED_ELEMENTS:
+                self.skipping -= 1
+            return
+        for index in range(len(self.stack) - 1, 0, -1):
+            if self.stack[index].tag == tag:
+                del self.stack[index:]
+                return
+
+    def handle_data(self, data):
+        """Add text to the current element."""
+        if not self.skipping:
+            self.stack[-1].children.append(data)
+
+
+def decode(content: bytes) -> str:
+    """Decode a page with the charset it declares, or UTF-8."""
+    match = CHARSET_PATTERN.search(content[:4096])
+    if match:
+        try:
+            return content.decode(match.group(1).decode("ascii"), errors="replace")
+        except LookupError:
+            pass
+    return content.decode("utf-8", errors="replace")
+
+
+def parse_html(html: str) -> Element:
+    """Parse HTML into a tree of elements."""
+    builder = TreeBuilder()
+    builder.feed(html)
+    builder.close()
+    return builder.root
+
+
+def parse_date(text: Optional[str]) -> Optional[date]:
+    """Find a date like `Tuesday, January 1, 2002` or `Aug 14, 2008` in text."""
+    if not text:
+        return None
+    for match in DATE_PATTERN.finditer(text):
+        month = MONTHS.get(match.group(1).lower())
+        if month is None:
+            continue
+        try:
+            return date(int(match.group(3)), month, int(match.group(2)))
+        except ValueError:
+            continue
+    return None
+
+
+@dataclass
+class ExtractedArticle:
+    """The parts of an article extracted from a page."""
+
+    era: str
+    title: Optional[str] = None
+    author: Optional[str] = None
+    published: Optional[date] = None
+    text: str = ""
+
+
+def text_of(element: Optional[Element]) -> Optional[str]:
+    """Return the text of an element on one line, or None if it has none."""
+    if element is None:
+        return None
+    return " ".join(element.lines()) or None
+
+
+def page_title(document: Element) -> Optional[str]:
+    """Return the page's title, without the site's suffix."""
+    for meta in document.find_all("meta", property="og:title"):
+        og_title = TITLE_SUFFIXES.sub("", meta.attrs.get("content", "")).strip(" -")
+        if og_title:
+            return og_title
+    title = text_of(document.find("title"))
+    return TITLE_SUFFIXES.sub("", title).strip() or None if title else None
+
+
+def extract_mtgcom(document: Element) -> ExtractedArticle:
+    """Extract an article from the original `default.asp` site."""
+    headline = document.find("h2", "headline")
+    byline = document.find(cls="byline")
+    # The article is the paragraphs following the headline.
+    text = ""
+    if headline is not None:
+        elements = list(document.iter())
+        start = elements.index(headline)
+        blocks = [
+            element
+            for element in elements[start + 1 :]
+            if element.tag in ("p", "h3", "li", "pre", "blockquote")
+            and "byline" not in element.classes
+        ]
+        # Nested blocks are already included in the text of their parents.
+        nested = {id(inner) for block in blocks for inner in list(block.iter())[1:]}
+        text = "\n".join(
+            block.text() for block in blocks if id(block) not in nested and block.text()
+        )
+    published = parse_date(text_of(document.find(cls="mtgcom-article-dateline")))
+    if published is None and byline is not None:
+        # Later pages put the date next to the byline, in the same cell.
+        cells = [cell for cell in document.find_all("td") if byline in cell.iter()]
+        published = parse_date(text_of(cells[-1])) if cells else None
+    return ExtractedArticle(
+        era=MTGCOM,
+        title=text_of(headline) or page_title(document),
+        author=byline.lines()[0] if byline is not None and byline.lines() else None,
+        published=published,
+        text=text,
+    )
+
+
+def extract_magazine(document: Element) -> ExtractedArticle:
+    """Extract an article from the `Magic/Magazine/Article.aspx` site."""
+    heading = document.find(cls="heading")
+    byline = document.find("h5", "byline")
+    byline_lines = byline.lines() if byline is not None else []
+    # The byline holds the author and the date, separated by a line break.
+    author = next((line for line in byline_lines if not parse_date(line)), None)
+    published = next(filter(None, map(parse_date, byline_lines)), None)
+    content = document.find("div", "article-content")
+    return ExtractedArticle(
+        era=MAGAZINE,
+        title=text_of(heading.find("h4") if heading else None) or page_title(document),
+        author=author,
+        published=published,
+        text=content.text() if content is not None else "",
+    )
+
+
+def extract_drupal(document: Element) -> ExtractedArticle:
+    """Extract an article from the first Drupal `wiz_mtg` theme."""
+    meta = document.find("div", "authTag")
+    meta = meta.find("div", "meta") if meta is not None else None
+    author = text_of(meta.find("span")) if meta is not None else None
+    content = document.find("div", "field-name-body")
+    return ExtractedArticle(
+        era=DRUPAL,
+        title=text_of(document.find("h1", "title")) or page_title(document),
+        author=author,
+        published=parse_date(text_of(document.find("span", "headerPubDate"))),
+        text=content.text() if content is not None else "",
+    )
+
+
+def extract_drupal2(document: Element) -> ExtractedArticle:
+    """Extract an article from the redesigned Drupal `wiz_mtg` theme."""
+    author_block = document.find("div", "author")
+    author = text_of(author_block.find("p")) if author_block is not None else None
+    if author and author.lower().startswith("by "):
+        author = author[3:]
+    content = document.find("div", id="content-detail-page-of-an-article")
+    return ExtractedArticle(
+        era=DRUPAL2,
+        title=page_title(document) or text_of(document.find("h1")),
+        author=author,
+        published=parse_date(text_of(document.find("p", "posted-in"))),
+        text=content.text() if content is not None else "",
+    )
+
+
+def extract_contentful(document: Element) -> ExtractedArticle:
+    """Extract an article from the Contentful site."""
+    header = document.find("header") or document
+    title = text_of(header.find("h1")) or page_title(document)
+    # The author is named in the header's link to their archive.
+    author = None
+    for link in header.find_all("a"):
+        if "author=" in link.attrs.get("href", ""):
+            author = text_of(link)
+            break
+    content = document.find("div", "article-body")
+    return ExtractedArticle(
+        era=CONTENTFUL,
+        title=title,
+        author=author,
+        published=parse_date(text_of(header.find("time"))),
+        text=content.text() if content is not None else "",
+    )
+
+
+def extract_generic(document: Element) -> ExtractedArticle:
+    """Extract the title and text of a page from no known era."""
+    body = document.find("body") or document
+    return ExtractedArticle(era=GENERIC, title=page_title(document), text=body.text())
+
+
+def detect_era(url: str, html: str) -> str:
+    """Work out which era of the site a page is from."""
+    parts = urlsplit(url.lower())
+    if parts.path.endswith("/default.asp"):
+        return MTGCOM
+    if parts.path.endswith("/magazine/article.aspx"):
+        return MAGAZINE
+    if parts.hostname == "magic.wizards.com":
+        if "images.ctfassets.net/" in html:
+            return CONTENTFUL
+        if 'class="posted-in"' in html:
+            return DRUPAL2
+        if "wiz_mtg" in html or 'class="headerPubDate"' in html:
+            return DRUPAL
+    return GENERIC
+
+
+EXTRACTORS: Dict[str, Callable[[Element], ExtractedArticle]] = {
+    MTGCOM: extract_mtgcom,
+    MAGAZINE: extract_magazine,
+    DRUPAL: extract_drupal,
+    DRUPAL2: extract_drupal2,
+    CONTENTFUL: extract_contentful,
+    GENERIC: extract_generic,
+}
+
+
+def extract_article(url: str, content: bytes) -> ExtractedArticle:
+    """Extract the article from a gathered page."""
+    html = decode(content)
+    return EXTRACTORS[detect_era(url, html)](parse_html(html))
+
+
+def extract_articles(
+    pages: List[Tuple[int, str, bytes]],
+) -> List[Tuple[int, ExtractedArticle]]:
+    """Extract articles from a batch of pages, given as (id, url, content).
+
+    This is run in worker processes, so it only takes and returns plain data.
+    A page that fails to parse gets an empty article with the `error` era, so
+    that it is stored and not tried again on every run.
+    """
+    results = []
+    for memento_id, url, content in pages:
+        try:
+            article = extract_article(url, content)
+        except Exception as e:
+            log.warning("[%d] Failed to extract article: %r", memento_id, e)
+            article = ExtractedArticle(ERROR)
+        results.append((memento_id, article))
+    return results
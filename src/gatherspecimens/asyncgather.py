@@ -0,0 +1,487 @@
+"""Gathers mementos with an asyncio pipeline, without Celery.
+
+The pipeline has three stages joined by bounded queues:
+
+- a reader, which streams pending CDX records out of the database in chunks
+- fetchers, which fetch mementos over a pooled HTTP client
+- a writer, which stores the results in the database in batches.
+
+Records are selected, deduplicated by digest and stored the same way as by
+the Celery workers, so the two can be used interchangeably.
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+from urllib.parse import urljoin
+
+import aiohttp
+from sqlalchemy import Engine
+from sqlalchemy.orm import Session
+from wayback.exceptions import (MementoPlaybackError, NoMementoError,
+                                WaybackRetryError)
+
+from gatherspecimens import blobstore
+from gatherspecimens.compression import Dictionary
+from gatherspecimens.gather import (group_by_digest, result_class,
+                                    store_deduplicated, stored_group_results)
+from gatherspecimens.metrics import (COMMIT_SECONDS, FETCH_SECONDS,
+                                     RESPONSE_BYTES, RESULTS, start_exporter)
+from gatherspecimens.schema import (CdxRecordSpecimen, CompressionDictionary,
+                                    MementoBlob, create_schema)
+from gatherspecimens.selection import NEAR_DUPLICATE_POLICIES, pending_records
+from gatherspecimens.utils import common_logging, get_engine
+
+log = logging.getLogger(__name__)
+
+# Statuses from the Wayback Machine itself (not from a memento) worth retrying.
+RETRYABLE_STATUSES = frozenset((413, 421, 429, 500, 502, 503, 504, 599))
+
+MAX_REDIRECTS = 10
+
+
+@dataclass
+class AsyncMemento:
+    """A memento fetched by the async pipeline."""
+
+    ok: bool
+    status_code: int
+    content: bytes
+
+
+@dataclass
+class FetchOutcome:
+    """The outcome of fetching the first record of a digest group."""
+
+    group: List[CdxRecordSpecimen]
+    memento: Optional[AsyncMemento] = None
+    error: Optional[BaseException] = None
+    # True if the group's content was already stored and wasn't fetched.
+    deduplicated: bool = False
+
+
+@dataclass
+class PipelineSettings:
+    """Settings for the async gathering pipeline."""
+
+    start: int = 0
+    chunk_size: int = 1000
+    concurrency: int = 100
+    batch_size: int = 100
+    calls_per_second: float = 30.0
+    retries: int = 6
+    backoff: float = 2.0
+    timeout: float = 60.0
+    # A policy from `selection` for leaving out likely near-duplicates.
+    near_duplicates: Optional[str] = None
+
+
+@dataclass
+class PipelineStats:
+    """Counts of results by class, for reporting progress."""
+
+    results: Counter = field(default_factory=Counter)
+    started: float = field(default_factory=time.time)
+
+    def add(self, result_str: str):
+        """Count a result by its class, the part before any colon."""
+        self.results[result_class(result_str)] += 1
+        RESULTS.inc(result=result_class(result_str))
+
+    @property
+    def total(self) -> int:
+        """Return the total number of results."""
+        return sum(self.results.values())
+
+
+class AsyncRateLimiter:
+    """Spaces out calls so that no more than N are started per second."""
+
+    def __init__(self, calls_per_second: float):
+        """Set up the limiter; a rate of 0 or less disables it."""
+        self.interval = 1.0 / calls_per_second if calls_per_second > 0 else 0.0
+        self.next_call = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        """Wait until the next call is allowed."""
+        if not self.interval:
+            return
+        async with self.lock:
+            now = time.monotonic()
+            if self.next_call > now:
+                await asyncio.sleep(self.next_call - now)
+            self.next_call = max(now, self.next_call) + self.interval
+
+
+async def fetch_memento(
+    http: aiohttp.ClientSession,
+    limiter: AsyncRateLimiter,
+    record_specimen: CdxRecordSpecimen,
+    settings: PipelineSettings,
+) -> AsyncMemento:
+    """Fetch the memento for a record, following redirects between mementos.
+
+    This follows the same rules as `WaybackClient.get_memento` for the common
+    cases: redirects that are themselves mementos are followed, and responses
+    that aren't mementos raise `MementoPlaybackError`, or `NoMementoError` for
+    a 404.
+    """
+    url = record_specimen.raw_url
+    previous_was_memento = False
+
+    for _ in range(MAX_REDIRECTS):
+        status, headers, content = await fetch_with_retries(
+            http, limiter, url, settings
+        )
+        is_memento = "Memento-Datetime" in headers
+        location = headers.get("Location")
+        is_redirect = 300 <= status < 400 and location
+
+        if is_memento and not is_redirect:
+            return AsyncMemento(ok=status < 400, status_code=status, content=content)
+
+        # Wayback may redirect the target of a memento redirect to the nearest
+        # capture of it, which is expected; anything else is a playback error.
+        if is_redirect and (is_memento or previous_was_memento):
+            url = urljoin(url, location)
+            previous_was_memento = is_memento
+            continue
+
+        if status == 404:
+            raise NoMementoError(f"{record_specimen.raw_url} has no memento")
+        raise MementoPlaybackError(
+            f"{record_specimen.raw_url} could not be played back (status {status})"
+        )
+
+    raise MementoPlaybackError(f"{record_specimen.raw_url} redirected too many times")
+
+
+async def fetch_with_retries(
+    http: aiohttp.ClientSession,
+    limiter: AsyncRateLimiter,
+    url: str,
+    settings: PipelineSettings,
+):
+    """Make a GET request, retrying errors from the Wayback Machine itself.
+
+    Like `WaybackSession`, this raises `WaybackRetryError` once the retries run
+    out, so the failure is classed as transient.
+    """
+    start_time = time.time()
+    for attempt in range(settings.retries + 1):
+        if attempt:
+            await asyncio.sleep(settings.backoff * 2 ** (attempt - 1))
+
+        await limiter.wait()
+        try:
+            async with http.get(url, allow_redirects=False) as response:
+                content = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == settings.retries:
+                raise WaybackRetryError(attempt, time.time() - start_time, e) from e
+            log.debug("Error fetching %s, will retry: %s", url, e)
+            continue
+
+        # Mementos are returned as-is, whatever their status code.
+        if (
+            "Memento-Datetime" in response.headers
+            or response.status not in RETRYABLE_STATUSES
+        ):
+            return response.status, response.headers, content
+        log.debug("Received status %d for %s, will retry", response.status, url)
+
+    raise WaybackRetryError(
+        settings.retries, time.time() - start_time, f"status {response.status}"
+    )
+
+
+def read_chunk(
+    engine: Engine,
+    last_id: int,
+    chunk_size: int,
+    near_duplicates: Optional[str] = None,
+) -> List[CdxRecordSpecimen]:
+    """Read the next chunk of pending records from the database."""
+    with Session(engine) as db_session:
+        rows = db_session.execute(
+            pending_records(last_id, chunk_size, near_duplicates=near_duplicates)
+        ).all()
+    return [CdxRecordSpecimen.from_serializable(row._asdict()) for row in rows]
+
+
+def existing_digests(
+    engine: Engine, groups: Dict[str, List[CdxRecordSpecimen]]
+) -> Set[str]:
+    """Return which of the digest groups already have stored content."""
+    with Session(engine) as db_session:
+        return MementoBlob.existing(db_session, groups.keys())
+
+
+async def reader(
+    engine: Engine,
+    settings: PipelineSettings,
+    fetch_queue: "asyncio.Queue[Optional[List[CdxRecordSpecimen]]]",
+    write_queue: "asyncio.Queue[Optional[FetchOutcome]]",
+):
+    """Stream pending records from the database into the fetch queue."""
+    loop = asyncio.get_running_loop()
+    last_id = max(settings.start - 1, 0)
+
+    while True:
+        records = await loop.run_in_executor(
+            None,
+            read_chunk,
+            engine,
+            last_id,
+            settings.chunk_size,
+            settings.near_duplicates,
+        )
+        if not records:
+            break
+        last_id = records[-1].id
+        log.info("[%d] Read %d pending records", last_id, len(records))
+
+        groups = group_by_digest(records)
+        stored = await loop.run_in_executor(None, existing_digests, engine, groups)
+
+        for key, group in groups.items():
+            if key in stored:
+                await write_queue.put(FetchOutcome(group, deduplicated=True))
+            else:
+                await fetch_queue.put(group)
+
+
+async def fetcher(
+    http: aiohttp.ClientSession,
+    limiter: AsyncRateLimiter,
+    settings: PipelineSettings,
+    fetch_queue: "asyncio.Queue[Optional[List[CdxRecordSpecimen]]]",
+    write_queue: "asyncio.Queue[Optional[FetchOutcome]]",
+):
+    """Fetch the first record of each digest group from the fetch queue."""
+    while True:
+        group = await fetch_queue.get()
+        if group is None:
+            return
+
+        start_time = time.time()
+        try:
+            memento = await fetch_memento(http, limiter, group[0], settings)
+            outcome = FetchOutcome(group, memento=memento)
+            RESPONSE_BYTES.observe(len(memento.content))
+        except Exception as e:
+            outcome = FetchOutcome(group, error=e)
+        memento_time = time.time() - start_time
+        log.debug("[%s] Memento gather time: %s", group[0].id, memento_time)
+        FETCH_SECONDS.observe(memento_time)
+        await write_queue.put(outcome)
+
+
+def write_batch(
+    engine: Engine, outcomes: List[FetchOutcome], dictionaries: Dict[str, Dictionary]
+) -> Dict[int, str]:
+    """Store a batch of fetch outcomes in a single commit.
+
+    If anything in the batch fails to be stored, none of it is, and every record
+    in it gets an error result.
+    """
+    results: Dict[int, str] = {}
+    with Session(engine) as db_session:
+        try:
+            for outcome in outcomes:
+                if outcome.deduplicated:
+                    for record_specimen in outcome.group:
+                        results[record_specimen.id] = store_deduplicated(
+                            db_session, record_specimen
+                        )
+                else:
+                    results.update(
+                        stored_group_results(
+                            db_session,
+                            outcome.group,
+                            outcome.memento,
+                            outcome.error,
+                            dictionaries,
+                        )
+                    )
+
+            db_start_time = time.time()
+            db_session.commit()
+            db_time = time.time() - db_start_time
+            log.info("Database commit time: %s", db_time)
+            COMMIT_SECONDS.observe(db_time, component="asyncgather")
+        except Exception as e:
+            log.exception("Error storing batch: %s", e)
+            db_session.rollback()
+            results = {
+                record_specimen.id: "error while storing"
+                for outcome in outcomes
+                for record_specimen in outcome.group
+            }
+    return results
+
+
+async def writer(
+    engine: Engine,
+    settings: PipelineSettings,
+    write_queue: "asyncio.Queue[Optional[FetchOutcome]]",
+    dictionaries: Dict[str, Dictionary],
+    stats: PipelineStats,
+):
+    """Store fetch outcomes from the write queue in batches."""
+    loop = asyncio.get_running_loop()
+    finished = False
+
+    while not finished:
+        outcomes: List[FetchOutcome] = []
+        outcome = await write_queue.get()
+        while outcome is not None:
+            outcomes.append(outcome)
+            if len(outcomes) >= settings.batch_size or write_queue.empty():
+                break
+            outcome = await write_queue.get()
+        finished = outcome is None
+
+        if not outcomes:
+            continue
+
+        results = await loop.run_in_executor(
+            None, write_batch, engine, outcomes, dictionaries
+        )
+        for record_id, result_str in results.items():
+            log.info("[%d] Processed record: %s", record_id, result_str)
+            stats.add(result_str)
+
+        elapsed = time.time() - stats.started
+        log.info(
+            "Processed %d records (%.1f records/s)",
+            stats.total,
+            stats.total / elapsed if elapsed else 0.0,
+        )
+
+
+async def gather(engine: Engine, settings: PipelineSettings) -> PipelineStats:
+    """Run the gathering pipeline until there are no pending records left."""
+    with Session(engine) as db_session:
+        dictionaries = CompressionDictionary.latest_by_name(db_session)
+
+    stats = PipelineStats()
+    fetch_queue: "asyncio.Queue[Optional[List[CdxRecordSpecimen]]]" = asyncio.Queue(
+        maxsize=settings.concurrency * 2
+    )
+    write_queue: "asyncio.Queue[Optional[FetchOutcome]]" = asyncio.Queue(
+        maxsize=settings.batch_size * 2
+    )
+    limiter = AsyncRateLimiter(settings.calls_per_second)
+
+    connector = aiohttp.TCPConnector(limit=settings.concurrency)
+    timeout = aiohttp.ClientTimeout(total=settings.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as http:
+        writer_task = asyncio.create_task(
+            writer(engine, settings, write_queue, dictionaries, stats)
+        )
+        fetchers = [
+            asyncio.create_task(
+                fetcher(http, limiter, settings, fetch_queue, write_queue)
+            )
+            for _ in range(settings.concurrency)
+        ]
+
+        async def feed():
+            await reader(engine, settings, fetch_queue, write_queue)
+
+            # Shut the stages down in order, letting each one drain its queue.
+            for _ in fetchers:
+                await fetch_queue.put(None)
+            await asyncio.gather(*fetchers)
+            await write_queue.put(None)
+
+        # A stage that crashes would leave the others waiting on its queue
+        # forever, so the first error cancels the whole pipeline.
+        tasks = [asyncio.create_task(feed()), writer_task, *fetchers]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    return stats
+
+
+def main():
+    """Gather mementos for pending records with the async pipeline."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--config",
+        help="Path to the database configuration file",
+        type=Path,
+        default=Path("config.json"),
+    )
+    parser.add_argument(
+        "--start", type=int, default=0, help="CDX record id to start processing from"
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1000,
+        help="Number of records to read from the database at a time",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=100,
+        help="Maximum number of requests in flight",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=100,
+        help="Maximum number of results to store per commit",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=30.0,
+        help="Maximum number of memento requests per second (0: unlimited)",
+    )
+    parser.add_argument(
+        "--near-duplicates",
+        choices=NEAR_DUPLICATE_POLICIES,
+        help="Skip records that are likely near-duplicates of gathered ones",
+    )
+    args = parser.parse_args()
+
+    engine = get_engine(args.config)
+    create_schema(engine)
+    blobstore.configure_from_config(args.config)
+    start_exporter(args.config)
+
+    settings = PipelineSettings(
+        start=args.start,
+        chunk_size=args.chunk_size,
+        concurrency=args.concurrency,
+        batch_size=args.batch_size,
+        calls_per_second=args.rate,
+        near_duplicates=args.near_duplicates,
+    )
+    stats = asyncio.run(gather(engine, settings))
+    log.info("Finished: %s", dict(stats.results))
+
+
+def run():
+    """Run the main function with common logging."""
+    common_logging(__name__, __file__, level=logging.INFO)
+    main()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,154 @@
+"""Where the compressed content of memento blobs is kept.
+
+By default content is stored in the `memento_blob` table itself. With a
+filesystem store configured, content is instead written to files in a
+content-addressed directory tree, and the table only records which store
+holds it, which keeps the database, its WAL and its backups small. The store
+is chosen by the `blob_store` section of the config file::
+
+    "blob_store": {"backend": "filesystem", "root": "/data/blobs"}
+
+Files are named by the blob's digest, codec and dictionary, so a blob
+recompressed with another codec gets a new file rather than overwriting one
+that rows may still refer to, and sharded into directories by the first
+characters of the digest so no directory gets too large. Reads memory-map the
+file and decompress straight from the mapping.
+
+Files are shared by every transaction storing the same content, so one that
+rolls back leaves its files in place. `compressbodies gc` deletes the files no
+blob uses once they are old enough that no transaction can still be about to
+commit a blob using them.
+"""
+
+import mmap
+import os
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Union
+
+from gatherspecimens.utils import load_config
+
+DATABASE = "database"
+FILESYSTEM = "filesystem"
+
+# Directory levels, and characters of the digest per level, for sharding files.
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+
+Buffer = Union[bytes, memoryview]
+
+
+def blob_key(digest: str, codec: Optional[str], dictionary_id: Optional[int]) -> str:
+    """Return the name content is stored under, given how it is compressed."""
+    key = f"{digest}.{codec or 'identity'}"
+    if dictionary_id is not None:
+        key += f".{dictionary_id}"
+    return key
+
+
+class FileSystemStore:
+    """Stores content in sharded files under a root directory."""
+
+    name = FILESYSTEM
+
+    def __init__(self, root: Path):
+        """Set up the store to keep its files under `root`."""
+        self.root = Path(root)
+
+    def path(self, key: str) -> Path:
+        """Return the path of the file holding a key's content."""
+        shards = [
+            key[level * SHARD_WIDTH : (level + 1) * SHARD_WIDTH]
+            for level in range(SHARD_LEVELS)
+        ]
+        return self.root.joinpath(*shards, key)
+
+    def put(self, key: str, content: bytes):
+        """Write content under a key, replacing the file atomically.
+
+        Concurrent writers of the same key write the same content, so whichever
+        replaces the file last does no harm. Each write has a temporary file of
+        its own, so writers in different threads don't share one.
+        """
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(f".{key}.{uuid.uuid4().hex}.tmp")
+        with open(temp_path, "wb") as f:
+            f.write(content)
+        os.replace(temp_path, path)
+
+    @contextmanager
+    def view(self, key: str) -> Iterator[Buffer]:
+        """Map a key's content into memory for the body of a `with` block."""
+        with open(self.path(key), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                yield b""
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    yield view
+                finally:
+                    view.release()
+
+    def files(self) -> Iterator[Path]:
+        """Iterate over the paths of every file in the store.
+
+        This includes temporary files left behind by writes that didn't finish,
+        whose names start with a dot.
+        """
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                yield Path(directory, name)
+
+    def delete(self, key: str):
+        """Delete a key's content, if it exists."""
+        try:
+            self.path(key).unlink()
+        except FileNotFoundError:
+            pass
+
+
+# The configured stores by name, and the one new content is written to.
+_stores: Dict[str, FileSystemStore] = {}
+_writer: Optional[FileSystemStore] = None
+
+
+def configure(store: Optional[FileSystemStore]):
+    """Write new content to a store, or to the database if `store` is None.
+
+    The store is also used to read content it holds.
+    """
+    global _writer
+    _writer = store
+    if store is not None:
+        _stores[store.name] = store
+
+
+def configure_from_config(config_file: Path) -> Optional[FileSystemStore]:
+    """Configure the store set in the `blob_store` section of a config file."""
+    config = load_config(config_file).get("blob_store") or {}
+    backend = config.get("backend", DATABASE)
+    if backend == DATABASE:
+        configure(None)
+    elif backend == FILESYSTEM:
+        configure(FileSystemStore(Path(config["root"])))
+    else:
+        raise ValueError(f"Unknown blob store backend: {backend}")
+    return _writer
+
+
+def writer() -> Optional[FileSystemStore]:
+    """Return the store new content is written to; None means the database."""
+    return _writer
+
+
+def get_store(name: str) -> FileSystemStore:
+    """Return the store with the given name, for reading content it holds."""
+    try:
+        return _stores[name]
+    except KeyError:
+        raise ValueError(
+            f"Blob content is in the {name} store, which is not configured"
+        ) from None
@@ -0,0 +1,123 @@
+"""Rules for which captures under a prefix are worth storing.
+
+Rules are given per prefix in the input file, as an object in place of the
+prefix's URL::
+
+    {"url": "magic.wizards.com/en/articles", "status": ["2xx", "3xx"],
+     "mime_types": ["text/html"], "collapse": "digest"}
+
+They are sent with the CDX search, so the Wayback Machine leaves out captures
+that don't match, and also applied to the results before they are stored, in
+case the server ignores any of them.
+"""
+
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+import wayback
+
+from gatherspecimens.metrics import CDX_RECORDS
+
+# The fields captures can be collapsed on, with the CdxRecord attribute for each.
+COLLAPSE_FIELDS = {"digest": "digest", "urlkey": "key"}
+
+STATUS_PATTERN = re.compile(r"^[1-5][0-9x]{2}$")
+
+
+@dataclass(frozen=True)
+class CdxFilter:
+    """Which captures to keep from a CDX search."""
+
+    # Status codes like "200", or classes of them like "2xx"; empty keeps all.
+    status: Tuple[str, ...] = ()
+    # Exact MIME types; empty keeps all.
+    mime_types: Tuple[str, ...] = ()
+    # Keep only the first of consecutive captures with the same value of this
+    # field: "digest" or "urlkey".
+    collapse: Optional[str] = None
+    # URL key prefixes to leave out, because they are searched separately.
+    exclude_urlkeys: Tuple[str, ...] = ()
+
+    def __post_init__(self):
+        """Check the rules are ones the CDX API understands."""
+        for status in self.status:
+            if not STATUS_PATTERN.match(status):
+                raise ValueError(f"Invalid status filter: {status}")
+        if self.collapse is not None and self.collapse not in COLLAPSE_FIELDS:
+            raise ValueError(f"Can only collapse on {', '.join(COLLAPSE_FIELDS)}")
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> "CdxFilter":
+        """Create a filter from a prefix's entry in the input file."""
+
+        def strings(value: Union[str, List[str], None]) -> Tuple[str, ...]:
+            if value is None:
+                return ()
+            if isinstance(value, str):
+                return (value,)
+            return tuple(str(item) for item in value)
+
+        return cls(
+            status=tuple(s.lower() for s in strings(config.get("status"))),
+            mime_types=strings(config.get("mime_types")),
+            collapse=config.get("collapse"),
+        )
+
+    def filter_fields(self) -> List[str]:
+        """Return the filters to send with a CDX search."""
+        fields = []
+        if self.status:
+            patterns = "|".join(status.replace("x", ".") for status in self.status)
+            fields.append(f"statuscode:{patterns}")
+        if self.mime_types:
+            patterns = "|".join(re.escape(mime_type) for mime_type in self.mime_types)
+            fields.append(f"mimetype:{patterns}")
+        for urlkey in self.exclude_urlkeys:
+            fields.append(f"!urlkey:{re.escape(urlkey)}.*")
+        return fields
+
+    def search_args(self) -> Dict[str, Any]:
+        """Return the arguments to pass to `WaybackClient.search`."""
+        args: Dict[str, Any] = {}
+        if self.filter_fields():
+            args["filter_field"] = self.filter_fields()
+        if self.collapse:
+            args["collapse"] = self.collapse
+        return args
+
+    def matches(self, record: wayback.CdxRecord) -> bool:
+        """Check whether a record passes the rules, other than collapsing."""
+        if any(record.key.startswith(urlkey) for urlkey in self.exclude_urlkeys):
+            return False
+        if self.status:
+            code = str(record.status_code) if record.status_code else ""
+            if not any(
+                len(code) == 3 and all(p in ("x", c) for p, c in zip(status, code))
+                for status in self.status
+            ):
+                return False
+        if self.mime_types and record.mime_type not in self.mime_types:
+            return False
+        return True
+
+    def apply(
+        self, records: Iterator[wayback.CdxRecord]
+    ) -> Iterator[wayback.CdxRecord]:
+        """Yield only the records the rules keep.
+
+        As on the server, records are collapsed after they are filtered.
+        """
+        attribute = COLLAPSE_FIELDS.get(self.collapse or "")
+        previous = None
+        for record in records:
+            if not self.matches(record):
+                CDX_RECORDS.inc(outcome="filtered")
+                continue
+            if attribute:
+                value = getattr(record, attribute)
+                if value == previous:
+                    CDX_RECORDS.inc(outcome="filtered")
+                    continue
+                previous = value
+            yield record
@@ -1,59 +1,418 @@
 """Retrieves CDX records from Wayback Machine for a list of URLs."""
 
 import argparse
-import json
 import logging
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Generator, Iterator
+from typing import (Any, Callable, Dict, Iterator, List, NamedTuple, Optional,
+                    Tuple)
 
 import wayback
-from sqlalchemy import Engine
+from sqlalchemy import Engine, func, select
 from sqlalchemy.orm import Session
 
-from gatherspecimens.schema import Base, CdxRecordSpecimen
-from gatherspecimens.utils import common_logging, get_engine, url_hash
+from gatherspecimens.cdxfilters import CdxFilter
+from gatherspecimens.metrics import (CDX_RECORDS, CDX_REQUEST_SECONDS,
+                                     COMMIT_SECONDS, start_exporter)
+from gatherspecimens.planner import (CrawlTarget, load_targets, plan_targets,
+                                     urlkey_prefix)
+from gatherspecimens.ratecontrol import (AdaptiveRateController,
+                                         controllers_from_config,
+                                         mount_controllers)
+from gatherspecimens.schema import (CDX_TIMESTAMP, CdxCrawlCheckpoint,
+                                    CdxCrawlWatermark, CdxRecordSpecimen,
+                                    create_schema)
+from gatherspecimens.utils import (common_logging, get_engine,
+                                   insert_ignoring_conflicts)
 
 log = logging.getLogger(__name__)
 
+# Number of CDX records buffered before being written in a single statement.
+DEFAULT_BATCH_SIZE = 1000
 
-def process_results(results: Iterator[wayback.CdxRecord], engine: Engine):
-    """Iterate over CDX records and stores them in the database."""
-    added = 0
+# The Wayback Machine has no captures before this year.
+FIRST_CAPTURE_YEAR = 1996
+
+CDX_SEARCH_PATH = "/cdx/search/cdx"
+
+
+class CrawlJob(NamedTuple):
+    """A URL prefix to crawl, optionally restricted to a time window."""
+
+    url: str
+    from_date: Optional[datetime] = None
+    to_date: Optional[datetime] = None
+    cdx_filter: CdxFilter = CdxFilter()
+    # Whether to advance the prefix's watermark when the job completes.
+    incremental: bool = False
+
+    def __str__(self) -> str:
+        """Describe the job for logging."""
+        if self.from_date is None and self.to_date is None:
+            return self.url
+        from_str = self.from_date.date() if self.from_date else "start"
+        to_str = self.to_date.date() if self.to_date else "now"
+        return f"{self.url} [{from_str} - {to_str}]"
+
+    @property
+    def window(self) -> str:
+        """Return the time window as a key for checkpoints."""
+        from_str = self.from_date.strftime(CDX_TIMESTAMP) if self.from_date else ""
+        to_str = self.to_date.strftime(CDX_TIMESTAMP) if self.to_date else ""
+        return f"{from_str}-{to_str}"
+
+
+@dataclass
+class CrawlSettings:
+    """Settings shared by all crawl jobs in a run."""
+
+    api_limit: int = 1000
+    batch_size: int = DEFAULT_BATCH_SIZE
+    search_rate: float = 1.0
+    rate_controllers: Dict[str, AdaptiveRateController] = field(default_factory=dict)
+
+
+class ResumableWaybackSession(wayback.WaybackSession):
+    """Wayback session that tracks the CDX resume key of each search request.
+
+    If created with a resume key, the first search request continues from that
+    key rather than from the start of the results.
+    """
+
+    def __init__(self, resume_key: Optional[str] = None, **kwargs):
+        """Set up the session with an optional resume key."""
+        super().__init__(**kwargs)
+        self.resume_key = resume_key
+
+    def request(self, method, url, **kwargs):
+        """Track or inject the resume key for CDX search requests."""
+        if url.endswith(CDX_SEARCH_PATH):
+            params = kwargs.get("params") or {}
+            if "resumeKey" in params:
+                self.resume_key = params["resumeKey"]
+            elif self.resume_key:
+                kwargs["params"] = {**params, "resumeKey": self.resume_key}
+            with CDX_REQUEST_SECONDS.time():
+                return super().request(method, url, **kwargs)
+        return super().request(method, url, **kwargs)
+
+
+@dataclass
+class IngestResult:
+    """Counts of CDX records inserted and skipped during ingestion."""
+
+    inserted: int = 0
+    skipped: int = 0
+    # The time of the latest capture seen, whether inserted or skipped.
+    latest: Optional[datetime] = None
+
+
+def insert_batch(
+    db_session: Session,
+    batch: Dict[str, Dict[str, Any]],
+    ingest: IngestResult,
+    on_batch: Optional[Callable[[Session, int], None]] = None,
+):
+    """Insert a batch of CDX records in one statement, skipping stored records.
+
+    The batch maps URL hashes to column values; it is cleared once written.
+    `on_batch` is called with the number of records inserted before committing,
+    so that anything it writes is committed in the same transaction as the batch.
+    """
+    dialect_name = db_session.get_bind().dialect.name
+    stmt = (
+        insert_ignoring_conflicts(dialect_name, CdxRecordSpecimen, ["hash_raw_url"])
+        .values(list(batch.values()))
+        .returning(CdxRecordSpecimen.id)
+    )
+    inserted = len(db_session.execute(stmt).all())
+    if on_batch:
+        on_batch(db_session, inserted)
+    with COMMIT_SECONDS.time(component="cdxrecords"):
+        db_session.commit()
+
+    ingest.inserted += inserted
+    ingest.skipped += len(batch) - inserted
+    CDX_RECORDS.inc(inserted, outcome="inserted")
+    CDX_RECORDS.inc(len(batch) - inserted, outcome="skipped")
+    batch.clear()
+
+
+def process_results(
+    results: Iterator[wayback.CdxRecord],
+    engine: Engine,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    on_batch: Optional[Callable[[Session, int], None]] = None,
+) -> IngestResult:
+    """Iterate over CDX records and store them in the database in batches."""
+    ingest = IngestResult()
+
+    # Records are buffered by URL hash so that duplicates within a batch are
+    # dropped before they reach the database.
+    batch: Dict[str, Dict[str, Any]] = {}
 
     with Session(engine) as db_session:
         for index, record in enumerate(results):
-            raw_hash = url_hash(record.raw_url)
+            if ingest.latest is None or record.timestamp > ingest.latest:
+                ingest.latest = record.timestamp
+            values = CdxRecordSpecimen.values_from_cdx_record(record)
+            if values["hash_raw_url"] in batch:
+                ingest.skipped += 1
+                CDX_RECORDS.inc(outcome="skipped")
+                continue
 
-            if index % 100 == 0:
-                log.info("[%d] Checking record", index)
+            batch[values["hash_raw_url"]] = values
+            if len(batch) >= batch_size:
+                insert_batch(db_session, batch, ingest, on_batch)
+                log.info(
+                    "[%d] Committed records (inserted: %d, skipped: %d)",
+                    index,
+                    ingest.inserted,
+                    ingest.skipped,
+                )
 
-            if (
-                db_session.query(CdxRecordSpecimen)
-                .filter(CdxRecordSpecimen.hash_raw_url == raw_hash)
-                .first()
-            ):
-                # log.info("[%s] Record %s already scraped", run_id, record)
-                continue
+        if batch:
+            insert_batch(db_session, batch, ingest, on_batch)
+
+    return ingest
+
+
+def time_windows(
+    years_per_window: int, now: Optional[datetime] = None
+) -> List[Tuple[Optional[datetime], Optional[datetime]]]:
+    """Split the lifetime of the Wayback Machine into windows of whole years.
+
+    The last window is open-ended so that it picks up the most recent captures.
+    """
+    if years_per_window <= 0:
+        return [(None, None)]
+
+    now = now or datetime.now(timezone.utc)
+    windows: List[Tuple[Optional[datetime], Optional[datetime]]] = []
+    for year in range(FIRST_CAPTURE_YEAR, now.year + 1, years_per_window):
+        from_date = datetime(year, 1, 1, tzinfo=timezone.utc)
+        next_year = year + years_per_window
+        if next_year > now.year:
+            windows.append((from_date, None))
+        else:
+            # The CDX `to` bound is inclusive, so stop just before the next window.
+            to_date = datetime(next_year, 1, 1, tzinfo=timezone.utc)
+            windows.append((from_date, to_date - timedelta(seconds=1)))
+    return windows
+
+
+def plan_jobs(targets: List[CrawlTarget], years_per_window: int) -> List[CrawlJob]:
+    """Create crawl jobs for each URL prefix and time window."""
+    windows = time_windows(years_per_window)
+    return [
+        CrawlJob(target.url, from_date, to_date, target.cdx_filter)
+        for target in targets
+        for from_date, to_date in windows
+    ]
+
+
+def search(
+    client: wayback.WaybackClient, job: CrawlJob, limit: int
+) -> Iterator[wayback.CdxRecord]:
+    """Search for the captures a job should store.
+
+    The job's filter is sent with the search, and applied again to its results.
+    """
+    results = client.search(
+        job.url,
+        match_type="prefix",
+        limit=limit,
+        from_date=job.from_date,
+        to_date=job.to_date,
+        **job.cdx_filter.search_args(),
+    )
+    return job.cdx_filter.apply(results)
+
+
+def load_checkpoint(db_session: Session, job: CrawlJob) -> CdxCrawlCheckpoint:
+    """Load the checkpoint for a crawl job, creating it if necessary."""
+    checkpoint = (
+        db_session.query(CdxCrawlCheckpoint)
+        .filter(
+            CdxCrawlCheckpoint.prefix == job.url,
+            CdxCrawlCheckpoint.window == job.window,
+        )
+        .one_or_none()
+    )
+    if checkpoint is None:
+        checkpoint = CdxCrawlCheckpoint(
+            prefix=job.url,
+            window=job.window,
+            completed=False,
+            updated=datetime.now(timezone.utc),
+        )
+        db_session.add(checkpoint)
+    return checkpoint
+
+
+def save_checkpoint(
+    db_session: Session,
+    job: CrawlJob,
+    resume_key: Optional[str],
+    completed: bool,
+    inserted: int = 0,
+):
+    """Record the progress of a crawl job; the caller commits.
+
+    The number of records inserted since the last checkpoint is added to the
+    job's count, which gives per-prefix totals without counting the records.
+    """
+    checkpoint = load_checkpoint(db_session, job)
+    checkpoint.resume_key = resume_key
+    checkpoint.completed = completed
+    checkpoint.updated = datetime.now(timezone.utc)
+    checkpoint.records = (checkpoint.records or 0) + inserted
 
-            new_record = CdxRecordSpecimen.from_cdx_record(record)
-            db_session.add(new_record)
-            added += 1
 
-            if index % 100 == 0:
-                log.info("[%d] Committing records (added so far: %d)", index, added)
-                db_session.commit()
+def as_utc(timestamp: datetime) -> datetime:
+    """Return a time in UTC; naive times, as SQLite returns, are taken to be UTC."""
+    if timestamp.tzinfo is None:
+        return timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.astimezone(timezone.utc)
 
 
-def process_url(url: str, engine: Engine, api_limit: int):
-    """Process a URL and store found CDX records in the database."""
-    session = wayback.WaybackSession(retries=20, backoff=0.5)
+def load_watermark(db_session: Session, prefix: str) -> Optional[datetime]:
+    """Return the time of the latest capture crawled under a prefix.
+
+    A prefix that has no watermark yet, because it has only been crawled in
+    full, starts from the latest capture already stored under it.
+    """
+    watermark = db_session.get(CdxCrawlWatermark, prefix)
+    if watermark is not None:
+        return as_utc(watermark.timestamp)
+    latest = db_session.scalar(
+        select(func.max(CdxRecordSpecimen.timestamp)).where(
+            CdxRecordSpecimen.key.startswith(urlkey_prefix(prefix), autoescape=True)
+        )
+    )
+    return as_utc(latest) if latest is not None else None
+
+
+def save_watermark(db_session: Session, prefix: str, latest: Optional[datetime]):
+    """Advance a prefix's watermark to the latest capture crawled; the caller commits.
+
+    The watermark never moves backwards. Since CDX results are ordered by URL
+    rather than by time, it is only saved once a whole crawl has committed.
+    """
+    times = [
+        as_utc(timestamp)
+        for timestamp in (latest, load_watermark(db_session, prefix))
+        if timestamp is not None
+    ]
+    if not times:
+        return
+
+    watermark = db_session.get(CdxCrawlWatermark, prefix)
+    if watermark is None:
+        watermark = CdxCrawlWatermark(prefix=prefix)
+        db_session.add(watermark)
+    watermark.timestamp = max(times)
+    watermark.updated = datetime.now(timezone.utc)
+
+
+def plan_incremental_jobs(
+    engine: Engine, targets: List[CrawlTarget], overlap: timedelta
+) -> List[CrawlJob]:
+    """Create a job for each prefix searching only for captures after its watermark.
+
+    The search starts `overlap` before the watermark, to pick up captures that
+    were added to the CDX index late.
+
+    A run that found nothing new leaves the watermark, and so the job's window,
+    where it was, so the job's checkpoint is reset if it was completed; an
+    unfinished one is left to be resumed.
+    """
+    jobs = []
+    with Session(engine) as db_session:
+        for target in targets:
+            watermark = load_watermark(db_session, target.url)
+            from_date = watermark - overlap if watermark is not None else None
+            job = CrawlJob(target.url, from_date, None, target.cdx_filter, True)
+            checkpoint = load_checkpoint(db_session, job)
+            if checkpoint.completed:
+                checkpoint.completed = False
+                checkpoint.resume_key = None
+            jobs.append(job)
+        db_session.commit()
+    return jobs
+
+
+def process_job(job: CrawlJob, engine: Engine, settings: CrawlSettings) -> IngestResult:
+    """Process a crawl job and store found CDX records in the database.
+
+    Progress is checkpointed with every committed batch, so a job that failed
+    part of the way through continues from its last checkpoint.
+    """
+    with Session(engine) as db_session:
+        checkpoint = load_checkpoint(db_session, job)
+        if checkpoint.completed:
+            log.info("Skipping %s: already completed", job)
+            return IngestResult()
+        resume_key = checkpoint.resume_key
+
+    if resume_key:
+        log.info("Resuming %s from %s", job, resume_key)
+
+    # Wayback rate limits are shared by every session in the process, so each
+    # thread can have its own session without exceeding the global rate.
+    session = ResumableWaybackSession(
+        resume_key=resume_key,
+        retries=20,
+        backoff=0.5,
+        search_calls_per_second=settings.search_rate,
+    )
+    mount_controllers(session, settings.rate_controllers)
     client = wayback.WaybackClient(session=session)
 
-    results: Generator[wayback.CdxRecord] = client.search(
-        url, match_type="prefix", limit=api_limit
+    results = search(client, job, settings.api_limit)
+
+    # The search is lazy, so when a batch is committed the session's resume
+    # key is the one for the page holding the last record in the batch.
+    # Resuming from it repeats at most one page.
+    def checkpoint_batch(db_session: Session, inserted: int):
+        save_checkpoint(
+            db_session, job, session.resume_key, completed=False, inserted=inserted
+        )
+
+    ingest = process_results(results, engine, settings.batch_size, checkpoint_batch)
+
+    with Session(engine) as db_session:
+        save_checkpoint(db_session, job, session.resume_key, completed=True)
+        if job.incremental:
+            save_watermark(db_session, job.url, ingest.latest)
+        db_session.commit()
+
+    log.info(
+        "Finished %s (inserted: %d, skipped: %d)", job, ingest.inserted, ingest.skipped
     )
-    process_results(results, engine)
+    return ingest
+
+
+def reset_checkpoints(engine: Engine):
+    """Delete all crawl checkpoints so that every job starts from scratch."""
+    with Session(engine) as db_session:
+        db_session.query(CdxCrawlCheckpoint).delete()
+        db_session.commit()
+
+
+def run_job(job: CrawlJob, engine: Engine, settings: CrawlSettings) -> IngestResult:
+    """Process a crawl job, retrying it until it succeeds."""
+    log.info("Processing URLs under %s", job)
+
+    while True:
+        try:
+            return process_job(job, engine, settings)
+        except Exception:
+            log.exception("[%s] Error while processing; sleep a while", job)
+            time.sleep(60)
 
 
 def main():
@@ -74,26 +433,86 @@ def main():
     parser.add_argument(
         "--limit",
         help="API limit for Wayback Machine",
+        type=int,
         default=1000,
     )
+    parser.add_argument(
+        "--batch-size",
+        help="Number of CDX records to insert per database statement",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of crawl jobs to run in parallel",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--split-years",
+        help="Split each prefix into time windows of this many years (0: no split)",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--rate",
+        help=(
+            "Maximum CDX API calls per second, shared across all workers; "
+            "ignored if the config has search rate control"
+        ),
+        type=float,
+        default=1.0,
+    )
+    parser.add_argument(
+        "--incremental",
+        help="Only search for captures after each prefix's watermark",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--overlap-days",
+        help="With --incremental, also search this many days before the watermark",
+        type=float,
+        default=2.0,
+    )
+    parser.add_argument(
+        "--reset-checkpoints",
+        help="Ignore saved crawl progress and crawl every job from the start",
+        action="store_true",
+    )
     args = parser.parse_args()
 
     engine = get_engine(args.config)
-    Base.metadata.create_all(engine)
+    create_schema(engine)
+    start_exporter(args.config)
 
-    with open(args.input, "r") as f:
-        urls = json.load(f)
+    if args.reset_checkpoints:
+        reset_checkpoints(engine)
 
-    for url in urls:
-        log.info("Processing URLs under %s", url)
+    settings = CrawlSettings(
+        api_limit=args.limit,
+        batch_size=args.batch_size,
+        search_rate=args.rate,
+        rate_controllers=controllers_from_config(args.config),
+    )
+    targets = load_targets(args.input)
+    planned = plan_targets(targets)
+    log.info("Planned %d of %d prefixes from the input", len(planned), len(targets))
+    if args.incremental:
+        jobs = plan_incremental_jobs(engine, planned, timedelta(days=args.overlap_days))
+    else:
+        jobs = plan_jobs(planned, args.split_years)
+    log.info("Running %d crawl jobs with %d workers", len(jobs), args.workers)
 
-        while True:
-            try:
-                process_url(url, engine, args.limit)
-                break
-            except Exception:
-                log.exception("Error while processing; sleep a while")
-                time.sleep(60)
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(run_job, job, engine, settings): job for job in jobs}
+        for future in as_completed(futures):
+            ingest = future.result()
+            log.info(
+                "Completed %s (inserted: %d, skipped: %d)",
+                futures[future],
+                ingest.inserted,
+                ingest.skipped,
+            )
 
 
 def run():
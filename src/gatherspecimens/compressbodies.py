@@ -0,0 +1,412 @@
+"""Trains compression dictionaries, and recompresses and moves stored bodies."""
+
+import argparse
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from sqlalchemy import ColumnElement, Engine, func, or_, select, update
+from sqlalchemy.orm import Session, selectinload, undefer
+
+from gatherspecimens import blobstore, compression
+from gatherspecimens.compression import Dictionary, dictionary_name
+from gatherspecimens.schema import (CompressionDictionary, MementoBlob,
+                                    MementoSpecimen, create_schema)
+from gatherspecimens.utils import common_logging, content_digest, get_engine
+
+log = logging.getLogger(__name__)
+
+# How old a blob store file must be before it is deleted for being unused. A
+# transaction that wrote it may otherwise still be about to commit its blob.
+DEFAULT_GRACE_PERIOD = timedelta(days=1)
+
+
+def train(
+    engine: Engine,
+    host: str,
+    samples: int,
+    size: int = compression.DEFAULT_DICTIONARY_SIZE,
+) -> int:
+    """Train a dictionary on a random sample of pages from a host.
+
+    Returns the id of the new dictionary.
+    """
+    name = dictionary_name(f"http://{host}/")
+    with Session(engine) as db_session:
+        mementos = (
+            db_session.query(MementoSpecimen)
+            .filter(
+                or_(
+                    MementoSpecimen.url.like(f"%://{name}/%"),
+                    MementoSpecimen.url.like(f"%://www.{name}/%"),
+                )
+            )
+            .order_by(func.random())
+            .limit(samples)
+        )
+        sample_data = [memento.content for memento in mementos]
+        log.info("Training dictionary for %s on %d pages", name, len(sample_data))
+
+        dictionary = CompressionDictionary(
+            name=name,
+            created=datetime.now(timezone.utc),
+            data=compression.train_dictionary(sample_data, size),
+        )
+        db_session.add(dictionary)
+        db_session.commit()
+        log.info("Stored dictionary %d for %s", dictionary.id, name)
+        return dictionary.id
+
+
+def move_inline_content(
+    engine: Engine,
+    batch_size: int,
+    codec: str,
+    dictionaries: Dict[str, Dictionary],
+) -> int:
+    """Move content stored inline in memento rows into compressed blobs.
+
+    Returns the number of memento rows moved.
+    """
+    moved = 0
+    last_id = 0
+    while True:
+        with Session(engine) as db_session:
+            rows = db_session.execute(
+                select(
+                    MementoSpecimen.id,
+                    MementoSpecimen.url,
+                    MementoSpecimen.html_content,
+                )
+                .where(MementoSpecimen.id > last_id)
+                .where(MementoSpecimen.html_content.is_not(None))
+                .order_by(MementoSpecimen.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                return moved
+
+            for row in rows:
+                # The CDX digest of a redirect is not that of its stored content.
+                digest = content_digest(row.html_content)
+                MementoBlob.store(
+                    db_session,
+                    digest,
+                    row.html_content,
+                    codec,
+                    dictionaries.get(dictionary_name(row.url)),
+                )
+                db_session.execute(
+                    update(MementoSpecimen)
+                    .where(MementoSpecimen.id == row.id)
+                    .values(digest=digest, html_content=None)
+                )
+            db_session.commit()
+
+        moved += len(rows)
+        last_id = rows[-1].id
+        log.info("[%d] Moved %d inline bodies into blobs", last_id, moved)
+
+
+def recompress_blobs(
+    engine: Engine,
+    batch_size: int,
+    codec: str,
+    dictionaries: Dict[str, Dictionary],
+) -> int:
+    """Recompress blobs that aren't stored with the given codec and dictionary.
+
+    Blobs compressed with an older dictionary than the latest for their host are
+    recompressed too. Returns the number of blobs recompressed.
+    """
+    latest_ids = [dictionary.id for dictionary in dictionaries.values()]
+    # Select the blobs that may change. Which dictionary a blob should have
+    # depends on its host, so that is checked for each blob before its content is
+    # loaded.
+    stale: List[ColumnElement[bool]] = [
+        MementoBlob.codec.is_(None),
+        MementoBlob.codec != codec,
+    ]
+    if codec != compression.ZSTD or not latest_ids:
+        stale.append(MementoBlob.dictionary_id.is_not(None))
+    else:
+        stale.append(MementoBlob.dictionary_id.is_(None))
+        stale.append(MementoBlob.dictionary_id.not_in(latest_ids))
+    # Any memento referencing the blob gives the host its dictionary is for.
+    blob_url = (
+        select(MementoSpecimen.url)
+        .where(MementoSpecimen.digest == MementoBlob.digest)
+        .limit(1)
+        .scalar_subquery()
+    )
+
+    recompressed = 0
+    last_digest = ""
+    while True:
+        with Session(engine) as db_session:
+            rows = db_session.execute(
+                select(MementoBlob, blob_url.label("url"))
+                .where(MementoBlob.digest > last_digest)
+                .where(or_(*stale))
+                .order_by(MementoBlob.digest)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                return recompressed
+
+            changed: Dict[str, Optional[Dictionary]] = {}
+            for blob, url in rows:
+                dictionary: Optional[Dictionary] = None
+                if codec == compression.ZSTD and url:
+                    dictionary = dictionaries.get(dictionary_name(url))
+                dictionary_id = dictionary.id if dictionary else None
+                if blob.codec != codec or blob.dictionary_id != dictionary_id:
+                    changed[blob.digest] = dictionary
+            last_digest = rows[-1][0].digest
+
+            # Files holding the old content, deleted once nothing refers to them.
+            replaced = []
+            # Loading the blobs again fills in their content and dictionaries.
+            for blob in db_session.scalars(
+                select(MementoBlob)
+                .options(undefer(MementoBlob.content))
+                .options(selectinload(MementoBlob.dictionary))
+                .where(MementoBlob.digest.in_(changed))
+            ):
+                if blob.backend is not None:
+                    replaced.append((blob.backend, blob.key))
+                values = MementoBlob.stored_values(
+                    blob.digest, blob.data, codec, changed[blob.digest]
+                )
+                for key, value in values.items():
+                    setattr(blob, key, value)
+                recompressed += 1
+
+            db_session.commit()
+            for backend, key in replaced:
+                blobstore.get_store(backend).delete(key)
+
+        log.info("[%s] Recompressed %d blobs", last_digest, recompressed)
+
+
+def offload_blobs(engine: Engine, batch_size: int) -> int:
+    """Move blob content into the configured blob store, as it is compressed.
+
+    With no blob store configured, content is moved back into the table.
+    Returns the number of blobs moved.
+    """
+    store = blobstore.writer()
+    misplaced: ColumnElement[bool]
+    if store is None:
+        misplaced = MementoBlob.backend.is_not(None)
+    else:
+        misplaced = or_(
+            MementoBlob.backend.is_(None), MementoBlob.backend != store.name
+        )
+
+    moved = 0
+    last_digest = ""
+    while True:
+        with Session(engine) as db_session:
+            blobs = db_session.scalars(
+                select(MementoBlob)
+                .options(undefer(MementoBlob.content))
+                .where(MementoBlob.digest > last_digest)
+                .where(misplaced)
+                .order_by(MementoBlob.digest)
+                .limit(batch_size)
+            ).all()
+            if not blobs:
+                return moved
+
+            # Files holding the old content, deleted once nothing refers to them.
+            replaced = []
+            for blob in blobs:
+                content = blob.content
+                if blob.backend is not None:
+                    replaced.append((blob.backend, blob.key))
+                    with blobstore.get_store(blob.backend).view(blob.key) as mapped:
+                        content = bytes(mapped)
+                if content is None:
+                    log.warning("Blob %s has no content to move", blob.digest)
+                    continue
+                if store is None:
+                    blob.content = content
+                    blob.backend = None
+                else:
+                    store.put(blob.key, content)
+                    blob.content = None
+                    blob.backend = store.name
+                moved += 1
+
+            last_digest = blobs[-1].digest
+            db_session.commit()
+            for backend, key in replaced:
+                blobstore.get_store(backend).delete(key)
+
+        log.info("[%s] Moved %d blobs", last_digest, moved)
+
+
+def delete_unused_files(engine: Engine, store_name: str, files: Dict[str, Path]) -> int:
+    """Delete the files of a batch, keyed by blob key, that no blob uses."""
+    digests = {key.split(".")[0] for key in files}
+    with Session(engine) as db_session:
+        used = {
+            blob.key
+            for blob in db_session.scalars(
+                select(MementoBlob)
+                .where(MementoBlob.backend == store_name)
+                .where(MementoBlob.digest.in_(digests))
+            )
+        }
+    deleted = 0
+    for key, path in files.items():
+        if key not in used:
+            path.unlink(missing_ok=True)
+            deleted += 1
+    return deleted
+
+
+def collect_garbage(
+    engine: Engine, batch_size: int, grace_period: timedelta = DEFAULT_GRACE_PERIOD
+) -> int:
+    """Delete files in the configured blob store that no blob uses.
+
+    These are left by transactions that rolled back, and temporary files by
+    writes that didn't finish. Files newer than `grace_period` are kept.
+    Returns the number of files deleted.
+    """
+    store = blobstore.writer()
+    if store is None:
+        return 0
+
+    cutoff = time.time() - grace_period.total_seconds()
+    deleted = 0
+    batch: Dict[str, Path] = {}
+    for path in store.files():
+        if path.stat().st_mtime > cutoff:
+            continue
+        if path.name.startswith("."):
+            path.unlink(missing_ok=True)
+            deleted += 1
+            continue
+        batch[path.name] = path
+        if len(batch) >= batch_size:
+            deleted += delete_unused_files(engine, store.name, batch)
+            batch = {}
+            log.info("Deleted %d unused files", deleted)
+    if batch:
+        deleted += delete_unused_files(engine, store.name, batch)
+    return deleted
+
+
+def main():
+    """Train compression dictionaries or recompress stored bodies."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--config",
+        help="Path to the database configuration file",
+        type=Path,
+        default=Path("config.json"),
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    train_parser = subparsers.add_parser(
+        "train", help="Train a zstd dictionary on pages from a host"
+    )
+    train_parser.add_argument("host", help="Host to train the dictionary for")
+    train_parser.add_argument(
+        "--samples", help="Number of pages to sample", type=int, default=2000
+    )
+    train_parser.add_argument(
+        "--size",
+        help="Size of the dictionary in bytes",
+        type=int,
+        default=compression.DEFAULT_DICTIONARY_SIZE,
+    )
+
+    recompress_parser = subparsers.add_parser(
+        "recompress", help="Compress stored bodies with the latest dictionaries"
+    )
+    recompress_parser.add_argument(
+        "--codec",
+        help="Codec to compress with",
+        choices=[compression.IDENTITY, compression.ZLIB, compression.ZSTD],
+        default=compression.default_codec(),
+    )
+    recompress_parser.add_argument(
+        "--batch-size",
+        help="Number of rows to recompress per transaction",
+        type=int,
+        default=100,
+    )
+    offload_parser = subparsers.add_parser(
+        "offload",
+        help="Move stored bodies out of the database into the configured blob store",
+    )
+    offload_parser.add_argument(
+        "--batch-size",
+        help="Number of rows to move per transaction",
+        type=int,
+        default=100,
+    )
+    gc_parser = subparsers.add_parser(
+        "gc", help="Delete files in the blob store that no stored body uses"
+    )
+    gc_parser.add_argument(
+        "--grace-hours",
+        help="Only delete files older than this many hours",
+        type=float,
+        default=DEFAULT_GRACE_PERIOD.total_seconds() / 3600,
+    )
+    gc_parser.add_argument(
+        "--batch-size",
+        help="Number of files to look up at a time",
+        type=int,
+        default=1000,
+    )
+    args = parser.parse_args()
+
+    engine = get_engine(args.config)
+    create_schema(engine)
+    blobstore.configure_from_config(args.config)
+
+    if args.command == "train":
+        train(engine, args.host, args.samples, args.size)
+        return
+
+    if args.command == "gc":
+        deleted = collect_garbage(
+            engine, args.batch_size, timedelta(hours=args.grace_hours)
+        )
+        log.info("Deleted %d unused files", deleted)
+        return
+
+    with Session(engine) as db_session:
+        dictionaries = CompressionDictionary.latest_by_name(db_session)
+
+    if args.command == "offload":
+        moved = move_inline_content(
+            engine, args.batch_size, compression.default_codec(), dictionaries
+        )
+        log.info("Moved %d inline bodies into blobs", moved)
+        moved = offload_blobs(engine, args.batch_size)
+        log.info("Moved %d blobs", moved)
+        return
+
+    moved = move_inline_content(engine, args.batch_size, args.codec, dictionaries)
+    log.info("Moved %d inline bodies into blobs", moved)
+    recompressed = recompress_blobs(engine, args.batch_size, args.codec, dictionaries)
+    log.info("Recompressed %d blobs", recompressed)
+
+
+def run():
+    """Run the main function with common logging."""
+    common_logging(__name__, __file__)
+    main()
+
+
+if __name__ == "__main__":
+    run()
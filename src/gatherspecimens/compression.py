@@ -0,0 +1,107 @@
+"""Compression codecs for memento bodies.
+
+Bodies are compressed with zstd when the `zstandard` package is installed, or
+with zlib otherwise. Zstd can also use a dictionary trained on pages from the
+same host, which holds the boilerplate shared by those pages.
+"""
+
+import zlib
+from functools import lru_cache
+from typing import List, NamedTuple, Optional, Sequence, Union
+from urllib.parse import urlsplit
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None  # type: ignore[assignment]
+
+IDENTITY = "identity"
+ZLIB = "zlib"
+ZSTD = "zstd"
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 10
+
+# The default size of trained dictionaries, in bytes.
+DEFAULT_DICTIONARY_SIZE = 112640
+
+
+class Dictionary(NamedTuple):
+    """A trained compression dictionary and its id in the database."""
+
+    id: int
+    data: bytes
+
+
+def default_codec() -> str:
+    """Return the best codec available in this environment."""
+    return ZSTD if zstandard is not None else ZLIB
+
+
+def dictionary_name(url: str) -> str:
+    """Return the name of the dictionary used for a URL: its host, sans `www.`."""
+    host = (urlsplit(url).hostname or "").lower()
+    if host.startswith("www."):
+        host = host[len("www.") :]
+    return host
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise RuntimeError("The zstandard package is required for zstd compression")
+
+
+@lru_cache(maxsize=32)
+def _zstd_dictionary(data: bytes) -> "zstandard.ZstdCompressionDict":
+    dictionary = zstandard.ZstdCompressionDict(data)
+    dictionary.precompute_compress(level=ZSTD_LEVEL)
+    return dictionary
+
+
+def compress(data: bytes, codec: str, dictionary: Optional[bytes] = None) -> bytes:
+    """Compress data with the given codec and optional zstd dictionary."""
+    if codec == IDENTITY:
+        return data
+    if codec == ZLIB:
+        return zlib.compress(data, ZLIB_LEVEL)
+    if codec == ZSTD:
+        _require_zstandard()
+        if dictionary is None:
+            compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+        else:
+            compressor = zstandard.ZstdCompressor(
+                dict_data=_zstd_dictionary(dictionary)
+            )
+        return compressor.compress(data)
+    raise ValueError(f"Unknown codec: {codec}")
+
+
+def decompress(
+    data: Union[bytes, memoryview],
+    codec: Optional[str],
+    dictionary: Optional[bytes] = None,
+) -> bytes:
+    """Decompress data stored with the given codec; None means uncompressed."""
+    if codec is None or codec == IDENTITY:
+        return bytes(data)
+    if codec == ZLIB:
+        return zlib.decompress(data)
+    if codec == ZSTD:
+        _require_zstandard()
+        if dictionary is None:
+            decompressor = zstandard.ZstdDecompressor()
+        else:
+            decompressor = zstandard.ZstdDecompressor(
+                dict_data=_zstd_dictionary(dictionary)
+            )
+        return decompressor.decompress(data)
+    raise ValueError(f"Unknown codec: {codec}")
+
+
+def train_dictionary(
+    samples: Sequence[bytes], size: int = DEFAULT_DICTIONARY_SIZE
+) -> bytes:
+    """Train a zstd dictionary on sample bodies."""
+    _require_zstandard()
+    buffers: List[Union[bytes, bytearray, memoryview]] = list(samples)
+    return zstandard.train_dictionary(size, buffers).as_bytes()
@@ -1,25 +1,75 @@
-"""Counts how many CDX records are stored in the database."""
+"""Reports gathering progress: counts, throughput, bytes stored and ETA."""
 
+import argparse
 import logging
 import time
+from pathlib import Path
 
-from sqlalchemy.orm import Session
-
-from gatherspecimens.schema import CdxRecordSpecimen
+from gatherspecimens.stats import progress, take_snapshot
 from gatherspecimens.utils import common_logging, get_engine
 
 log = logging.getLogger(__name__)
 
+# The number of prefixes with the most records that are reported.
+TOP_PREFIXES = 10
+
+
+def format_bytes(count: float) -> str:
+    """Format a number of bytes with a binary unit."""
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if abs(count) < 1024 or unit == "TiB":
+            break
+        count /= 1024
+    return f"{count:.1f} {unit}"
+
 
 def main():
-    """Count stored records."""
-    engine = get_engine("config.json")
-
-    with Session(engine) as db_session:
-        while True:
-            cdx_count = db_session.query(CdxRecordSpecimen).count()
-            log.info("CDX records: %d", cdx_count)
-            time.sleep(60)
+    """Report gathering progress periodically."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--config",
+        help="Path to the database configuration file",
+        type=Path,
+        default=Path("config.json"),
+    )
+    parser.add_argument(
+        "--interval",
+        help="Seconds between reports (default: 60)",
+        type=float,
+        default=60.0,
+    )
+    args = parser.parse_args()
+
+    engine = get_engine(args.config)
+
+    previous = take_snapshot(engine)
+    while True:
+        time.sleep(args.interval)
+        current = take_snapshot(engine)
+        rates = progress(previous, current)
+
+        log.info(
+            "CDX records: %d (%.1f/s), mementos: %d (%.1f/s), failures: %d (%.1f/s)",
+            current.cdx_records,
+            rates.cdx_records_per_second,
+            current.mementos,
+            rates.mementos_per_second,
+            current.failures,
+            rates.failures_per_second,
+        )
+        log.info(
+            "Stored: %s (%s/s), remaining: %d, ETA: %s",
+            format_bytes(current.stored_bytes),
+            format_bytes(rates.bytes_per_second),
+            current.remaining,
+            rates.eta if rates.eta is not None else "unknown",
+        )
+        log.info("Status codes: %s", current.status_codes)
+        log.info("Failure reasons: %s", current.failure_reasons)
+        top = sorted(current.prefixes.items(), key=lambda item: -item[1])
+        log.info("Top prefixes: %s", dict(top[:TOP_PREFIXES]))
+
+        previous = current
 
 
 def run():
@@ -0,0 +1,167 @@
+"""Extracts the article from each stored HTML memento into the article table.
+
+Each run extracts only the mementos that don't have an article row yet, so it
+can be run after every gathering pass. Pages are parsed in a pool of worker
+processes, while this process loads the next batches and stores the results.
+"""
+
+import argparse
+import logging
+import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Deque, List, Optional, Tuple
+
+from sqlalchemy import Engine, select
+from sqlalchemy.orm import Session, selectinload, undefer
+
+from gatherspecimens import blobstore
+from gatherspecimens.articles import ExtractedArticle, extract_articles
+from gatherspecimens.schema import (Article, MementoBlob, MementoSpecimen,
+                                    create_schema)
+from gatherspecimens.search import create_search_index
+from gatherspecimens.utils import (common_logging, get_engine,
+                                   insert_ignoring_conflicts)
+
+log = logging.getLogger(__name__)
+
+Page = Tuple[int, str, bytes]
+
+
+def pending_pages(
+    engine: Engine, after_id: int, batch_size: int
+) -> Tuple[List[Page], Optional[int]]:
+    """Load the next batch of HTML mementos without an article.
+
+    Returns the pages, and the id of the last memento looked at, or None if
+    there are none left.
+    """
+    with Session(engine) as db_session:
+        mementos = db_session.scalars(
+            select(MementoSpecimen)
+            .options(
+                selectinload(MementoSpecimen.blob).options(
+                    undefer(MementoBlob.content),
+                    selectinload(MementoBlob.dictionary),
+                )
+            )
+            .outerjoin(Article, Article.memento_id == MementoSpecimen.id)
+            .where(Article.memento_id.is_(None))
+            .where(MementoSpecimen.id > after_id)
+            .where(MementoSpecimen.mime_type.like("text/html%"))
+            .order_by(MementoSpecimen.id)
+            .limit(batch_size)
+        ).all()
+        if not mementos:
+            return [], None
+
+        pages = []
+        for memento in mementos:
+            try:
+                pages.append((memento.id, memento.url, memento.content))
+            except (ValueError, OSError) as e:
+                log.warning("Skipping memento %d: %s", memento.id, e)
+        return pages, mementos[-1].id
+
+
+def store_articles(engine: Engine, results: List[Tuple[int, ExtractedArticle]]):
+    """Store extracted articles, ignoring any already stored by another run."""
+    if not results:
+        return
+    extracted = datetime.now(timezone.utc)
+    with Session(engine) as db_session:
+        db_session.execute(
+            insert_ignoring_conflicts(engine.dialect.name, Article, ["memento_id"]),
+            [
+                {
+                    "memento_id": memento_id,
+                    "era": article.era,
+                    "title": article.title,
+                    "author": article.author,
+                    "published": article.published,
+                    "text": article.text,
+                    "extracted": extracted,
+                }
+                for memento_id, article in results
+            ],
+        )
+        db_session.commit()
+
+
+def extract(engine: Engine, batch_size: int, workers: int) -> int:
+    """Extract articles from every HTML memento that doesn't have one yet.
+
+    Up to two batches per worker are in flight at once, which keeps the
+    workers busy without loading every page into memory. Returns the number
+    of articles stored.
+    """
+    stored = 0
+    last_id = 0
+    in_flight: Deque[Tuple[int, Future]] = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            pages, batch_last_id = pending_pages(engine, last_id, batch_size)
+            if batch_last_id is not None:
+                last_id = batch_last_id
+                if pages:
+                    in_flight.append(
+                        (last_id, executor.submit(extract_articles, pages))
+                    )
+            # Store finished batches in order, waiting for the oldest once the
+            # pool is full or there is nothing left to load.
+            while in_flight and (
+                batch_last_id is None
+                or len(in_flight) >= 2 * workers
+                or in_flight[0][1].done()
+            ):
+                batch_id, future = in_flight.popleft()
+                results = future.result()
+                store_articles(engine, results)
+                stored += len(results)
+                log.info("[%d] Extracted %d articles", batch_id, stored)
+            if batch_last_id is None:
+                return stored
+
+
+def main():
+    """Extract articles from stored mementos."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--config",
+        help="Path to the database configuration file",
+        type=Path,
+        default=Path("config.json"),
+    )
+    parser.add_argument(
+        "--batch-size",
+        help="Number of mementos to send to a worker at a time",
+        type=int,
+        default=50,
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of worker processes to parse pages in",
+        type=int,
+        default=os.cpu_count() or 1,
+    )
+    args = parser.parse_args()
+
+    engine = get_engine(args.config)
+    create_schema(engine)
+    create_search_index(engine)
+    blobstore.configure_from_config(args.config)
+
+    stored = extract(engine, args.batch_size, args.workers)
+    log.info("Extracted %d articles", stored)
+
+
+def run():
+    """Run the main function with common logging."""
+    common_logging(__name__, __file__)
+    main()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,100 @@
+"""Classifying memento failures and scheduling retries of transient ones."""
+
+import logging
+import re
+from datetime import datetime, timedelta, timezone
+from typing import Optional, cast
+
+from sqlalchemy import CursorResult, delete, exists
+from sqlalchemy.orm import Session
+from wayback.exceptions import (BlockedByRobotsError, BlockedSiteError,
+                                MementoPlaybackError, RateLimitError,
+                                WaybackRetryError)
+
+from gatherspecimens.schema import MementoFailure, MementoSpecimen
+
+log = logging.getLogger(__name__)
+
+# The memento was archived with an error status, so it won't ever be gathered.
+ERROR_STATUS = "error_status"
+# The Wayback Machine couldn't play the memento back, or has no memento.
+PLAYBACK = "playback"
+# The Wayback Machine blocks access to the URL, e.g. because of robots.txt.
+BLOCKED = "blocked"
+# The Wayback Machine itself failed or rate limited us, even after retries.
+SERVER_ERROR = "server_error"
+# Gathering the memento hit a task time limit.
+TIME_LIMIT = "time_limit"
+# Gathering the memento raised some other exception, e.g. a connection error.
+EXCEPTION = "exception"
+
+# The message `WaybackClient.get_memento` raises `MementoPlaybackError` with when
+# the Wayback Machine's own error responses outlast the session's retries.
+WAYBACK_ERROR_MESSAGE = re.compile(r"(429|5\d\d) error while loading memento")
+
+# Failures that may succeed if tried again later.
+TRANSIENT_REASONS = (SERVER_ERROR, TIME_LIMIT, EXCEPTION)
+
+# The wait before the first retry, doubled with each attempt after it.
+RETRY_BACKOFF = timedelta(hours=1)
+
+# Records that have failed this many times are given up on.
+MAX_ATTEMPTS = 6
+
+
+def error_reason(error: BaseException) -> str:
+    """Classify the failure of a memento whose fetch raised an error.
+
+    Errors from the Wayback Machine itself and from the connection to it are
+    transient. Errors about the memento, like it not being playable or its URL
+    being blocked, are permanent.
+    """
+    if isinstance(error, (WaybackRetryError, RateLimitError)):
+        return SERVER_ERROR
+    if isinstance(error, (BlockedSiteError, BlockedByRobotsError)):
+        return BLOCKED
+    if isinstance(error, MementoPlaybackError):
+        if WAYBACK_ERROR_MESSAGE.match(str(error)):
+            return SERVER_ERROR
+        return PLAYBACK
+    return EXCEPTION
+
+
+def next_attempt(reason: str, attempts: int, now: datetime) -> Optional[datetime]:
+    """Return when a failed record may be retried, or None if it won't be."""
+    if reason not in TRANSIENT_REASONS or attempts >= MAX_ATTEMPTS:
+        return None
+    return now + RETRY_BACKOFF * 2 ** (attempts - 1)
+
+
+def record_failure(
+    db_session: Session,
+    record_id: int,
+    reason: str,
+    now: Optional[datetime] = None,
+) -> MementoFailure:
+    """Record a failed attempt at gathering a record's memento.
+
+    A record that has failed before has its attempts counted up, so that it
+    backs off further before its next retry.
+    """
+    now = now or datetime.now(timezone.utc)
+    failure = db_session.get(MementoFailure, record_id)
+    if failure is None:
+        failure = MementoFailure(id=record_id)
+        db_session.add(failure)
+    failure.reason = reason
+    failure.attempts = (failure.attempts or 0) + 1
+    failure.last_attempt = now
+    failure.next_attempt = next_attempt(reason, failure.attempts, now)
+    return failure
+
+
+def clear_recovered_failures(db_session: Session) -> int:
+    """Delete the failures of records that were gathered on a later attempt."""
+    result = db_session.execute(
+        delete(MementoFailure).where(
+            exists().where(MementoSpecimen.id == MementoFailure.id)
+        )
+    )
+    return cast(CursorResult, result).rowcount
@@ -0,0 +1,166 @@
+"""Storing gathered mementos, shared by the different ways of gathering them."""
+
+import logging
+from typing import Dict, Iterable, List, Optional, Protocol
+
+from sqlalchemy.orm import Session
+
+from gatherspecimens import blobstore
+from gatherspecimens.compression import Dictionary, dictionary_name
+from gatherspecimens.failures import (BLOCKED, ERROR_STATUS, PLAYBACK,
+                                      error_reason, record_failure)
+from gatherspecimens.schema import (CdxRecordSpecimen, MementoBlob,
+                                    MementoSpecimen)
+from gatherspecimens.utils import content_digest
+
+log = logging.getLogger(__name__)
+
+
+class FetchedMemento(Protocol):
+    """The parts of a fetched memento that are needed to store it."""
+
+    ok: bool
+    status_code: int
+    content: bytes
+
+
+def result_class(result_str: str) -> str:
+    """Return the class of a result string, the part before any colon."""
+    return result_str.split(":")[0]
+
+
+def new_page(record_specimen: CdxRecordSpecimen) -> MementoSpecimen:
+    """Create a memento row for a CDX record, without its content."""
+    record = record_specimen.to_cdx_record()
+    return MementoSpecimen(
+        id=record_specimen.id,
+        hash_raw_url=record_specimen.hash_raw_url,
+        raw_url=record_specimen.raw_url,
+        url=record_specimen.url,
+        mime_type=record_specimen.mime_type,
+        status_code=record_specimen.status_code,
+        time=record.timestamp,
+        view_url=record_specimen.view_url,
+        digest=trusted_digest(record_specimen),
+    )
+
+
+def trusted_digest(record_specimen: CdxRecordSpecimen) -> Optional[str]:
+    """Return the record's CDX digest, if it is the digest of what is fetched for it.
+
+    Mementos are fetched following redirects, so what is fetched for a redirect
+    is its target, not the redirect its digest is of. Revisit records are played
+    back from another capture, so they aren't trusted either.
+    """
+    status_code = record_specimen.status_code
+    if (status_code and 300 <= status_code < 400) or (
+        record_specimen.mime_type == "warc/revisit"
+    ):
+        return None
+    return record_specimen.digest or None
+
+
+def group_by_digest(
+    record_specimens: Iterable[CdxRecordSpecimen],
+) -> Dict[str, List[CdxRecordSpecimen]]:
+    """Group records by digest, so that each distinct content is fetched once.
+
+    Records without a trusted digest are put in a group of their own.
+    """
+    groups: Dict[str, List[CdxRecordSpecimen]] = {}
+    for record_specimen in record_specimens:
+        key = trusted_digest(record_specimen) or f"id:{record_specimen.id}"
+        groups.setdefault(key, []).append(record_specimen)
+    return groups
+
+
+def store_deduplicated(db_session: Session, record_specimen: CdxRecordSpecimen) -> str:
+    """Store a memento whose content is already stored under its digest."""
+    db_session.add(new_page(record_specimen))
+    log.info("[%s] Result deduplicated %s", record_specimen.id, record_specimen.url)
+    return "deduplicated"
+
+
+def store_memento(
+    db_session: Session,
+    record_specimen: CdxRecordSpecimen,
+    memento: FetchedMemento,
+    dictionaries: Dict[str, Dictionary],
+) -> str:
+    """Store a fetched memento as a new page, or record its failure."""
+    if not memento.ok:
+        log.warning(
+            "[%s] Memento had error: status code %d",
+            record_specimen.id,
+            memento.status_code,
+        )
+        # The status is the archived one, so trying again won't change it.
+        record_failure(db_session, record_specimen.id, ERROR_STATUS)
+        return f"memento error: {memento.status_code}"
+
+    page = new_page(record_specimen)
+    if not page.digest and (record_specimen.digest or blobstore.writer() is not None):
+        # Content whose CDX digest isn't trusted is stored by its own digest, as
+        # is all content whenever a blob store is configured.
+        page.digest = content_digest(memento.content)
+    if page.digest:
+        MementoBlob.store(
+            db_session,
+            page.digest,
+            memento.content,
+            dictionary=dictionaries.get(dictionary_name(page.url)),
+        )
+    else:
+        page.html_content = memento.content
+    db_session.add(page)
+    log.info("[%s] Result processed %s", record_specimen.id, record_specimen.url)
+    return "gathered"
+
+
+def store_error(
+    db_session: Session, record_specimen: CdxRecordSpecimen, error: BaseException
+) -> str:
+    """Record an error raised while fetching a memento.
+
+    Playback errors and blocked URLs are permanent failures, so the record isn't
+    tried again. Other errors are transient, so the record is retried later
+    with backoff.
+    """
+    reason = error_reason(error)
+    record_failure(db_session, record_specimen.id, reason)
+    if reason in (PLAYBACK, BLOCKED):
+        log.debug("[%s] Result hit mementoplaybackerror %s", record_specimen.id, error)
+        return f"memento playback error: {error}"
+
+    log.debug("[%s] Result hit exception %s", record_specimen.id, error)
+    return f"exception: {error}"
+
+
+def stored_group_results(
+    db_session: Session,
+    group: List[CdxRecordSpecimen],
+    memento: Optional[FetchedMemento],
+    error: Optional[BaseException],
+    dictionaries: Dict[str, Dictionary],
+) -> Dict[int, str]:
+    """Store the outcome of fetching the first record of a digest group.
+
+    If the fetch succeeded, the rest of the group is stored as duplicates of
+    it. Otherwise the rest are left to be tried again on the next pass.
+    """
+    first, rest = group[0], group[1:]
+    if memento is not None:
+        result_str = store_memento(db_session, first, memento, dictionaries)
+    else:
+        assert error is not None
+        result_str = store_error(db_session, first, error)
+
+    results = {first.id: result_str}
+    for record_specimen in rest:
+        if result_str == "gathered" and trusted_digest(first):
+            results[record_specimen.id] = store_deduplicated(
+                db_session, record_specimen
+            )
+        else:
+            results[record_specimen.id] = f"skipped: {result_str}"
+    return results
@@ -0,0 +1,326 @@
+"""Metrics for the hot paths of gathering, exported in Prometheus text format.
+
+Metrics are registered in a process-wide registry when this module is
+imported. They can be served over HTTP for Prometheus to scrape, or written
+periodically to a file for the node exporter's textfile collector, as set by
+the `metrics` section of the config file::
+
+    "metrics": {"port": 9101}
+    "metrics": {"textfile": "/var/lib/node_exporter/gatherer.prom", "interval": 15}
+"""
+
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+from gatherspecimens.utils import load_config
+
+log = logging.getLogger(__name__)
+
+# Bucket upper bounds in seconds, from fast database commits to slow fetches.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Bucket upper bounds in bytes, from empty responses to very large pages.
+SIZE_BUCKETS = tuple(1024 * 4**i for i in range(9))
+
+# Seconds between writes of the metrics file.
+DEFAULT_TEXTFILE_INTERVAL = 15.0
+
+LabelValues = Tuple[str, ...]
+
+
+def format_value(value: float) -> str:
+    """Format a sample value as Prometheus expects."""
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    """Format label names and values for a sample line."""
+    if not names:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(
+            name,
+            value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class Metric:
+    """A named metric with optional labels."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        """Set up the metric without any samples."""
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+
+    def label_values(self, labels: Dict[str, str]) -> LabelValues:
+        """Return the values of the metric's labels, in order."""
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} has labels {self.labelnames}, not {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        """Return the metric's sample lines."""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        """Render the metric in Prometheus text format."""
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        lines.extend(self.samples())
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    """A count that only goes up."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        """Set up the counter at zero."""
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        """Increase the count for the given labels."""
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        """Return a sample line for each set of labels."""
+        with self.lock:
+            values = sorted(self.values.items())
+        return [
+            f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Histogram(Metric):
+    """Observed values counted in cumulative buckets."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        """Set up the histogram with no observations."""
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.counts: Dict[LabelValues, List[int]] = {}
+        self.sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: str):
+        """Count an observed value for the given labels."""
+        key = self.label_values(labels)
+        with self.lock:
+            counts = self.counts.setdefault(key, [0] * len(self.buckets))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self.sums[key] = self.sums.get(key, 0.0) + value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observe the number of seconds taken by the body of a `with` block."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def samples(self) -> List[str]:
+        """Return bucket, sum and count lines for each set of labels."""
+        with self.lock:
+            series = [
+                (key, list(counts), self.sums[key])
+                for key, counts in sorted(self.counts.items())
+            ]
+
+        lines = []
+        names = self.labelnames + ("le",)
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = format_labels(names, key + (format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+M = TypeVar("M", bound=Metric)
+
+
+class Registry:
+    """A collection of metrics to export together."""
+
+    def __init__(self):
+        """Set up an empty registry."""
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: M) -> M:
+        """Add a metric to the registry, returning it."""
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Render every metric in Prometheus text format."""
+        return "".join(metric.render() for metric in self.metrics.values())
+
+
+REGISTRY = Registry()
+
+FETCH_SECONDS = REGISTRY.register(
+    Histogram(
+        "gatherspecimens_memento_fetch_seconds",
+        "Time taken to fetch a memento, including retries.",
+    )
+)
+RESPONSE_BYTES = REGISTRY.register(
+    Histogram(
+        "gatherspecimens_memento_response_bytes",
+        "Size of fetched memento bodies.",
+        buckets=SIZE_BUCKETS,
+    )
+)
+COMMIT_SECONDS = REGISTRY.register(
+    Histogram(
+        "gatherspecimens_commit_seconds",
+        "Time taken by database commits.",
+        ["component"],
+    )
+)
+RESULTS = REGISTRY.register(
+    Counter(
+        "gatherspecimens_memento_results_total",
+        "Records processed, by result class.",
+        ["result"],
+    )
+)
+CDX_REQUEST_SECONDS = REGISTRY.register(
+    Histogram(
+        "gatherspecimens_cdx_request_seconds",
+        "Time taken by each CDX search request, including retries.",
+    )
+)
+CDX_RECORDS = REGISTRY.register(
+    Counter(
+        "gatherspecimens_cdx_records_total",
+        "CDX records found, by whether they were inserted, skipped or filtered.",
+        ["outcome"],
+    )
+)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """HTTP handler serving the registry's metrics."""
+
+    registry = REGISTRY
+
+    def do_GET(self):
+        """Serve the metrics."""
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Log requests at debug level rather than to stderr."""
+        log.debug(format, *args)
+
+
+def serve(
+    port: int, host: str = "", registry: Registry = REGISTRY
+) -> ThreadingHTTPServer:
+    """Serve metrics over HTTP from a background thread."""
+    handler = type("Handler", (MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    log.info("Serving metrics on port %d", server.server_address[1])
+    return server
+
+
+def write_textfile(path: Path, registry: Registry = REGISTRY):
+    """Write metrics to a file, replacing it atomically."""
+    path = Path(path)
+    temp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    temp_path.write_text(registry.render())
+    os.replace(temp_path, path)
+
+
+def write_textfile_periodically(
+    path: Path, interval: float, registry: Registry = REGISTRY
+) -> threading.Thread:
+    """Write metrics to a file every interval from a background thread."""
+
+    def write_forever():
+        while True:
+            try:
+                write_textfile(path, registry)
+            except OSError as e:
+                log.error("Error writing metrics to %s: %s", path, e)
+            time.sleep(interval)
+
+    thread = threading.Thread(target=write_forever, daemon=True)
+    thread.start()
+    return thread
+
+
+def start_exporter(
+    config_file: Path, port_offset: int = 0
+) -> Optional[ThreadingHTTPServer]:
+    """Start exporting metrics as set by the `metrics` section of a config file.
+
+    A `{pid}` in the textfile path is replaced with the process id, so that
+    several processes on one machine can each write their own file. Likewise
+    `port_offset` is added to the port, for processes that serve their own.
+    """
+    config = load_config(config_file).get("metrics")
+    if not config:
+        return None
+
+    if config.get("textfile"):
+        path = Path(config["textfile"].format(pid=os.getpid()))
+        write_textfile_periodically(
+            path, config.get("interval", DEFAULT_TEXTFILE_INTERVAL)
+        )
+    if config.get("port") is not None:
+        port = config["port"] + port_offset
+        try:
+            return serve(port, config.get("host", ""))
+        except OSError as e:
+            log.warning("Not serving metrics on port %s: %s", port, e)
+    return None
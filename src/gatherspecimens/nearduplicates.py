@@ -0,0 +1,332 @@
+"""Finds captures of a URL whose text is nearly identical.
+
+Captures of a page often differ only in a timestamp, an ad, or markup like the
+inline SVG logos described in WIZARDS.md, so their digests differ although
+their text doesn't. Each HTML memento gets a 64-bit SimHash of the words in
+its text, leaving out scripts, styles and SVG, and captures of the same URL
+whose SimHashes differ in at most a few bits are grouped into a cluster.
+
+Fingerprints are stored, so each run only fingerprints new mementos and
+compares them with the clusters already found for their URLs. Gathering can
+then skip captures that are likely near-duplicates (see `selection`).
+
+SimHashes are computed a batch at a time with NumPy when it is installed, and
+in pure Python otherwise, with the same results.
+"""
+
+import argparse
+import logging
+import re
+from hashlib import blake2b
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import Engine, select
+from sqlalchemy.orm import Session, selectinload, undefer
+
+from gatherspecimens import blobstore
+from gatherspecimens.articles import decode, parse_html
+from gatherspecimens.schema import (CdxRecordSpecimen, MementoBlob,
+                                    MementoFingerprint, MementoSpecimen,
+                                    create_schema)
+from gatherspecimens.utils import common_logging, get_engine
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None  # type: ignore[assignment]
+
+log = logging.getLogger(__name__)
+
+# The number of consecutive words hashed together as one feature.
+SHINGLE_SIZE = 3
+# The most bits two SimHashes can differ in for their pages to be near-duplicates.
+DEFAULT_MAX_DISTANCE = 3
+
+BITS = 64
+MASK = (1 << BITS) - 1
+# Constants for combining word hashes into shingle hashes, and for mixing the
+# bits of the result (from SplitMix64).
+MULTIPLIER = 0x9E3779B97F4A7C15
+MIX_1 = 0xBF58476D1CE4E5B9
+MIX_2 = 0x94D049BB133111EB
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def word_hashes(text: str) -> List[int]:
+    """Hash each word of a text, ignoring case."""
+    cache: Dict[str, int] = {}
+    hashes = []
+    for word in WORD_PATTERN.findall(text.lower()):
+        if word not in cache:
+            digest = blake2b(word.encode("utf-8"), digest_size=8).digest()
+            cache[word] = int.from_bytes(digest, "little")
+        hashes.append(cache[word])
+    return hashes
+
+
+def shingle_hashes(hashes: Sequence[int]) -> List[int]:
+    """Combine the hashes of each run of `SHINGLE_SIZE` words."""
+    count = max(len(hashes) - SHINGLE_SIZE + 1, 1) if hashes else 0
+    shingles = []
+    for start in range(count):
+        value = 0
+        for word_hash in hashes[start : start + SHINGLE_SIZE]:
+            value = (value * MULTIPLIER + word_hash) & MASK
+        value ^= value >> 30
+        value = (value * MIX_1) & MASK
+        value ^= value >> 27
+        value = (value * MIX_2) & MASK
+        value ^= value >> 31
+        shingles.append(value)
+    return shingles
+
+
+def simhash(hashes: Sequence[int]) -> int:
+    """Compute the SimHash of a page from the hashes of its words."""
+    shingles = shingle_hashes(hashes)
+    fingerprint = 0
+    for bit in range(BITS):
+        ones = sum((shingle >> bit) & 1 for shingle in shingles)
+        if 2 * ones > len(shingles):
+            fingerprint |= 1 << bit
+    return fingerprint
+
+
+def simhashes(pages: Sequence[Sequence[int]]) -> List[int]:
+    """Compute the SimHashes of a batch of pages, from the hashes of their words.
+
+    With NumPy, the shingles of the whole batch are hashed and counted bit by
+    bit in a few array operations.
+    """
+    if numpy is None:
+        return [simhash(hashes) for hashes in pages]
+
+    shingles = []
+    for hashes in pages:
+        words = numpy.asarray(hashes, dtype=numpy.uint64)
+        if len(words) > SHINGLE_SIZE:
+            count = len(words) - SHINGLE_SIZE + 1
+        else:
+            count = min(len(words), 1)
+        combined: Any = numpy.zeros(count, dtype=numpy.uint64)
+        for offset in range(min(SHINGLE_SIZE, len(words))):
+            combined = combined * numpy.uint64(MULTIPLIER) + words[offset:][:count]
+        shingles.append(combined)
+    lengths = numpy.array([len(value) for value in shingles])
+    if not lengths.any():
+        return [0] * len(pages)
+
+    value = numpy.concatenate(shingles)
+    value ^= value >> numpy.uint64(30)
+    value *= numpy.uint64(MIX_1)
+    value ^= value >> numpy.uint64(27)
+    value *= numpy.uint64(MIX_2)
+    value ^= value >> numpy.uint64(31)
+
+    # One row of bits per shingle, least significant first.
+    bits = numpy.unpackbits(
+        value.astype("<u8").view(numpy.uint8).reshape(-1, 8),
+        axis=1,
+        bitorder="little",
+    )
+    # Count the ones in each bit position, page by page.
+    nonempty = lengths > 0
+    starts = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))[nonempty]
+    ones = numpy.add.reduceat(bits, starts, axis=0, dtype=numpy.int64)
+    majority = 2 * ones > lengths[nonempty, numpy.newaxis]
+    packed = numpy.packbits(majority, axis=1, bitorder="little").view("<u8").ravel()
+
+    fingerprints = [0] * len(pages)
+    for index, fingerprint in zip(numpy.flatnonzero(nonempty), packed):
+        fingerprints[index] = int(fingerprint)
+    return fingerprints
+
+
+def page_words(content: bytes) -> List[int]:
+    """Return the hashes of the words in a page's text.
+
+    A page the parser fails on is fingerprinted by the words of its raw HTML,
+    so that it is still stored and not tried again on every run.
+    """
+    html = decode(content)
+    try:
+        text = parse_html(html).text()
+    except Exception as e:
+        log.warning("Failed to parse page, using its raw HTML: %r", e)
+        text = html
+    return word_hashes(text)
+
+
+def to_signed(fingerprint: int) -> int:
+    """Convert a 64-bit fingerprint to the signed value stored in the database."""
+    return fingerprint - (1 << BITS) if fingerprint >> (BITS - 1) else fingerprint
+
+
+def distance(a: int, b: int) -> int:
+    """Return the number of bits two fingerprints differ in."""
+    return bin((a ^ b) & MASK).count("1")
+
+
+def pending_pages(
+    engine: Engine, after_id: int, batch_size: int
+) -> Tuple[List[Tuple[CdxRecordSpecimen, bytes]], Optional[int]]:
+    """Load the next batch of HTML mementos without a fingerprint.
+
+    Returns each memento's CDX record and content, and the id of the last
+    memento looked at, or None if there are none left.
+    """
+    with Session(engine) as db_session:
+        rows = db_session.execute(
+            select(MementoSpecimen, CdxRecordSpecimen)
+            .options(
+                selectinload(MementoSpecimen.blob).options(
+                    undefer(MementoBlob.content),
+                    selectinload(MementoBlob.dictionary),
+                )
+            )
+            .join(CdxRecordSpecimen, CdxRecordSpecimen.id == MementoSpecimen.id)
+            .outerjoin(
+                MementoFingerprint, MementoFingerprint.memento_id == MementoSpecimen.id
+            )
+            .where(MementoFingerprint.memento_id.is_(None))
+            .where(MementoSpecimen.id > after_id)
+            .where(MementoSpecimen.mime_type.like("text/html%"))
+            .order_by(MementoSpecimen.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            return [], None
+
+        pages = []
+        for memento, record in rows:
+            try:
+                pages.append((record, memento.content))
+            except (ValueError, OSError) as e:
+                log.warning("Skipping memento %d: %s", memento.id, e)
+            db_session.expunge(record)
+        return pages, rows[-1][0].id
+
+
+def fingerprint(
+    engine: Engine,
+    batch_size: int = 100,
+    max_distance: int = DEFAULT_MAX_DISTANCE,
+) -> Tuple[int, int]:
+    """Fingerprint every HTML memento without a fingerprint, and cluster them.
+
+    A capture joins the cluster of the closest earlier-fingerprinted capture of
+    its URL that started a cluster, if they differ in at most `max_distance`
+    bits, and starts a cluster of its own otherwise. Returns the number of
+    mementos fingerprinted, and how many of them were near-duplicates.
+    """
+    fingerprinted = 0
+    duplicates = 0
+    last_id = 0
+    while True:
+        pages, batch_last_id = pending_pages(engine, last_id, batch_size)
+        if batch_last_id is None:
+            return fingerprinted, duplicates
+        last_id = batch_last_id
+
+        hashes = simhashes([page_words(content) for _, content in pages])
+        with Session(engine) as db_session:
+            urls = {record.url for record, _ in pages}
+            # The fingerprints that started each of the URLs' clusters.
+            starts: Dict[str, List[Tuple[int, int]]] = {url: [] for url in urls}
+            for row in db_session.execute(
+                select(
+                    MementoFingerprint.url,
+                    MementoFingerprint.memento_id,
+                    MementoFingerprint.simhash,
+                )
+                .where(MementoFingerprint.url.in_(urls))
+                .where(MementoFingerprint.cluster == MementoFingerprint.memento_id)
+            ):
+                starts[row.url].append((row.memento_id, row.simhash))
+
+            for (record, _), value in zip(pages, hashes):
+                signed = to_signed(value)
+                nearest = min(
+                    starts[record.url],
+                    key=lambda start: distance(start[1], signed),
+                    default=None,
+                )
+                if nearest is not None and distance(nearest[1], signed) <= max_distance:
+                    cluster = nearest[0]
+                    duplicates += 1
+                else:
+                    cluster = record.id
+                    starts[record.url].append((record.id, signed))
+                db_session.add(
+                    MementoFingerprint(
+                        memento_id=record.id,
+                        url=record.url,
+                        timestamp=record.timestamp,
+                        simhash=signed,
+                        cluster=cluster,
+                    )
+                )
+            db_session.commit()
+
+        fingerprinted += len(pages)
+        log.info(
+            "[%d] Fingerprinted %d mementos, %d near-duplicates",
+            last_id,
+            fingerprinted,
+            duplicates,
+        )
+
+
+def url_clusters(db_session: Session, url: str) -> Dict[int, List[int]]:
+    """Return the captures of a URL grouped by cluster, in capture order."""
+    clusters: Dict[int, List[int]] = {}
+    for row in db_session.execute(
+        select(MementoFingerprint.cluster, MementoFingerprint.memento_id)
+        .where(MementoFingerprint.url == url)
+        .order_by(MementoFingerprint.timestamp)
+    ):
+        clusters.setdefault(row.cluster, []).append(row.memento_id)
+    return clusters
+
+
+def main():
+    """Fingerprint new mementos and group near-duplicate captures."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--config",
+        help="Path to the database configuration file",
+        type=Path,
+        default=Path("config.json"),
+    )
+    parser.add_argument(
+        "--batch-size",
+        help="Number of mementos to fingerprint at a time",
+        type=int,
+        default=100,
+    )
+    parser.add_argument(
+        "--max-distance",
+        help="Most bits near-duplicate fingerprints may differ in",
+        type=int,
+        default=DEFAULT_MAX_DISTANCE,
+    )
+    args = parser.parse_args()
+
+    engine = get_engine(args.config)
+    create_schema(engine)
+    blobstore.configure_from_config(args.config)
+
+    fingerprinted, duplicates = fingerprint(engine, args.batch_size, args.max_distance)
+    log.info("Fingerprinted %d mementos, %d near-duplicates", fingerprinted, duplicates)
+
+
+def run():
+    """Run the main function with common logging."""
+    common_logging(__name__, __file__)
+    main()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,137 @@
+"""Plans which URL prefixes to crawl, so each capture is searched for once.
+
+The CDX API matches URLs by their SURT-formatted key, which ignores the
+scheme, case and any `www.` subdomain, so `www.wizards.com/default.asp` and
+`wizards.com/default.asp` find exactly the same captures, and a prefix finds
+every capture that a longer prefix under it finds. Prefixes from the input
+file are compared by the key they match, and:
+
+- a prefix with the same key as, or under, another prefix with the same rules
+  is dropped, since the other prefix already finds its captures;
+- a prefix under another prefix with different rules is kept, and the other
+  prefix's search leaves out its captures, so the most specific rules apply.
+
+Every capture, identified by its key and timestamp, is then found by exactly
+one search.
+"""
+
+import json
+import logging
+import re
+from dataclasses import replace
+from pathlib import Path
+from typing import List, NamedTuple, Optional
+from urllib.parse import urlsplit
+
+from gatherspecimens.cdxfilters import CdxFilter
+
+log = logging.getLogger(__name__)
+
+
+class CrawlTarget(NamedTuple):
+    """A URL prefix from the input file, with the rules for which captures to keep."""
+
+    url: str
+    cdx_filter: CdxFilter = CdxFilter()
+
+
+def load_targets(input_file: Path) -> List[CrawlTarget]:
+    """Load the URL prefixes to crawl from the input file.
+
+    Each entry is either a prefix, or an object with the prefix as its `url`
+    and rules for which of its captures to keep (see `cdxfilters`).
+    """
+    with open(input_file, "r") as f:
+        entries = json.load(f)
+    targets = []
+    for entry in entries:
+        if isinstance(entry, str):
+            targets.append(CrawlTarget(entry))
+        else:
+            targets.append(CrawlTarget(entry["url"], CdxFilter.from_config(entry)))
+    return targets
+
+
+def urlkey_prefix(url: str) -> str:
+    """Return the SURT-formatted key prefix that a URL prefix matches.
+
+    For example, `https://www.Wizards.com/Magic` gives `com,wizards)/magic`.
+    """
+    if not re.match(r"^[a-z][a-z0-9+.-]*://", url, re.IGNORECASE):
+        url = f"http://{url}"
+    parts = urlsplit(url)
+    host = re.sub(r"^www\d*\.", "", (parts.hostname or "").lower())
+    key = ",".join(reversed(host.split(".")))
+    if parts.port and parts.port not in (80, 443):
+        key += f":{parts.port}"
+    path = parts.path or "/"
+    if parts.query:
+        path += f"?{parts.query}"
+    return f"{key}){path}".lower()
+
+
+def covering(key: str, keys: List[str]) -> Optional[int]:
+    """Return the index of the longest of `keys` that `key` starts with."""
+    best = None
+    for index, planned_key in enumerate(keys):
+        if key.startswith(planned_key) and (
+            best is None or len(planned_key) > len(keys[best])
+        ):
+            best = index
+    return best
+
+
+def plan_targets(targets: List[CrawlTarget]) -> List[CrawlTarget]:
+    """Merge overlapping prefixes so each capture is searched for only once.
+
+    Prefixes keep their spelling and order from the input file, so their crawl
+    checkpoints still apply. Of prefixes with the same key, only the first
+    listed is kept, with its rules.
+    """
+    keyed = sorted(
+        (
+            (urlkey_prefix(target.url), index, target)
+            for index, target in enumerate(targets)
+        ),
+        key=lambda item: item[:2],
+    )
+    planned: List[CrawlTarget] = []
+    keys: List[str] = []
+    # The rules each planned prefix was given, without any exclusions.
+    rules: List[CdxFilter] = []
+    positions: List[int] = []
+    for key, position, target in keyed:
+        # Prefixes sort before the prefixes under them, so any prefix covering
+        # this one has already been planned.
+        cover = covering(key, keys)
+        if cover is not None and (
+            keys[cover] == key or rules[cover] == target.cdx_filter
+        ):
+            if rules[cover] != target.cdx_filter:
+                log.warning(
+                    "Not crawling %s: same URLs as %s, with different rules",
+                    target.url,
+                    planned[cover].url,
+                )
+            else:
+                log.info(
+                    "Not crawling %s: covered by %s", target.url, planned[cover].url
+                )
+            continue
+
+        if cover is not None:
+            outer = planned[cover]
+            log.info("Crawling %s separately from %s", target.url, outer.url)
+            planned[cover] = outer._replace(
+                cdx_filter=replace(
+                    outer.cdx_filter,
+                    exclude_urlkeys=outer.cdx_filter.exclude_urlkeys + (key,),
+                )
+            )
+        planned.append(target)
+        keys.append(key)
+        rules.append(target.cdx_filter)
+        positions.append(position)
+
+    # Crawl the prefixes in the order they were listed.
+    return [target for _, target in sorted(zip(positions, planned))]
@@ -0,0 +1,276 @@
+"""Adaptive rate control for requests to the Wayback Machine.
+
+A controller spaces requests out so that no more than its current rate are
+sent per second, and adjusts that rate with AIMD (additive increase,
+multiplicative decrease): every successful, fast response nudges the rate up,
+and a 429, 5xx, connection error or slow response cuts it back.
+
+The state can be held in Redis, so that every worker in the cluster shares one
+rate, or in-process for a single machine.
+"""
+
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import requests
+import wayback
+from requests.adapters import HTTPAdapter
+
+from gatherspecimens.utils import load_config
+
+log = logging.getLogger(__name__)
+
+# Lua scripts keep each update atomic across the cluster. Times come from the
+# Redis server so that workers' clocks don't need to agree. Floats are returned
+# as strings, as Redis truncates Lua numbers to integers.
+RESERVE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local rate = tonumber(redis.call('GET', KEYS[2]) or ARGV[1])
+local next_slot = tonumber(redis.call('GET', KEYS[1]) or now)
+if next_slot < now then next_slot = now end
+redis.call('SET', KEYS[1], tostring(next_slot + 1 / rate), 'EX', 3600)
+return tostring(next_slot - now)
+"""
+
+INCREASE_SCRIPT = """
+local rate = tonumber(redis.call('GET', KEYS[1]) or ARGV[1])
+rate = math.min(tonumber(ARGV[3]), rate + tonumber(ARGV[2]) / rate)
+redis.call('SET', KEYS[1], tostring(rate))
+return tostring(rate)
+"""
+
+DECREASE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local rate = tonumber(redis.call('GET', KEYS[1]) or ARGV[1])
+local last = tonumber(redis.call('GET', KEYS[2]) or 0)
+if now - last >= tonumber(ARGV[4]) then
+    rate = math.max(tonumber(ARGV[3]), rate * tonumber(ARGV[2]))
+    redis.call('SET', KEYS[1], tostring(rate))
+    redis.call('SET', KEYS[2], tostring(now))
+end
+return tostring(rate)
+"""
+
+
+@dataclass
+class RateLimits:
+    """Limits and AIMD parameters for one API."""
+
+    # Requests per second, across every worker sharing the controller.
+    initial_rate: float = 10.0
+    min_rate: float = 0.5
+    max_rate: float = 60.0
+    # Increase the rate by this much per second's worth of successes.
+    increase: float = 1.0
+    # Multiply the rate by this on an error...
+    decrease: float = 0.5
+    # ...but no more than once per this many seconds, as errors arrive in bursts.
+    decrease_hold: float = 2.0
+    # Responses slower than this count as errors.
+    latency_limit: float = 15.0
+
+
+# The CDX search API tolerates far fewer requests than the memento API.
+DEFAULT_LIMITS = {
+    "memento": RateLimits(),
+    "search": RateLimits(initial_rate=0.5, min_rate=0.1, max_rate=2.0),
+}
+
+
+class LocalRateState:
+    """Rate control state held in this process."""
+
+    def __init__(self, limits: RateLimits):
+        """Set up the state at the initial rate."""
+        self.rate = limits.initial_rate
+        self.next_slot = 0.0
+        self.last_decrease = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self, limits: RateLimits) -> float:
+        """Reserve the next request slot, returning how long to wait for it."""
+        with self.lock:
+            now = time.time()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + 1 / self.rate
+            return slot - now
+
+    def increase(self, limits: RateLimits) -> float:
+        """Increase the rate additively, returning the new rate."""
+        with self.lock:
+            self.rate = min(limits.max_rate, self.rate + limits.increase / self.rate)
+            return self.rate
+
+    def decrease(self, limits: RateLimits) -> float:
+        """Decrease the rate multiplicatively, returning the new rate."""
+        with self.lock:
+            now = time.time()
+            if now - self.last_decrease >= limits.decrease_hold:
+                self.rate = max(limits.min_rate, self.rate * limits.decrease)
+                self.last_decrease = now
+            return self.rate
+
+
+class RedisRateState:
+    """Rate control state shared through Redis."""
+
+    def __init__(self, redis_client: Any, name: str):
+        """Set up the state under keys named after the controller."""
+        self.redis = redis_client
+        self.rate_key = f"gatherspecimens:rate:{name}"
+        self.slot_key = f"gatherspecimens:rate:{name}:next"
+        self.decrease_key = f"gatherspecimens:rate:{name}:decreased"
+        self.reserve_script = redis_client.register_script(RESERVE_SCRIPT)
+        self.increase_script = redis_client.register_script(INCREASE_SCRIPT)
+        self.decrease_script = redis_client.register_script(DECREASE_SCRIPT)
+
+    def reserve(self, limits: RateLimits) -> float:
+        """Reserve the next request slot, returning how long to wait for it."""
+        return float(
+            self.reserve_script(
+                keys=[self.slot_key, self.rate_key], args=[limits.initial_rate]
+            )
+        )
+
+    def increase(self, limits: RateLimits) -> float:
+        """Increase the rate additively, returning the new rate."""
+        return float(
+            self.increase_script(
+                keys=[self.rate_key],
+                args=[limits.initial_rate, limits.increase, limits.max_rate],
+            )
+        )
+
+    def decrease(self, limits: RateLimits) -> float:
+        """Decrease the rate multiplicatively, returning the new rate."""
+        return float(
+            self.decrease_script(
+                keys=[self.rate_key, self.decrease_key],
+                args=[
+                    limits.initial_rate,
+                    limits.decrease,
+                    limits.min_rate,
+                    limits.decrease_hold,
+                ],
+            )
+        )
+
+
+class AdaptiveRateController:
+    """Paces requests and adapts the rate to the responses they get."""
+
+    def __init__(self, state: Any, limits: RateLimits):
+        """Set up the controller with its state and limits."""
+        self.state = state
+        self.limits = limits
+
+    def acquire(self):
+        """Wait until the next request may be sent."""
+        wait = self.state.reserve(self.limits)
+        if wait > 0:
+            time.sleep(wait)
+
+    def record(self, status_code: Optional[int], latency: float):
+        """Adjust the rate for a response; a status of None means no response."""
+        if (
+            status_code is None
+            or status_code == 429
+            or status_code >= 500
+            or latency > self.limits.latency_limit
+        ):
+            rate = self.state.decrease(self.limits)
+            log.debug(
+                "Backing off after status %s in %.1fs: rate %.2f/s",
+                status_code,
+                latency,
+                rate,
+            )
+        else:
+            self.state.increase(self.limits)
+
+
+class RateControlledAdapter(HTTPAdapter):
+    """HTTP adapter that sends each request, including retries, under control."""
+
+    def __init__(self, controller: AdaptiveRateController, **kwargs):
+        """Set up the adapter with its controller."""
+        super().__init__(**kwargs)
+        self.controller = controller
+
+    def send(self, request: requests.PreparedRequest, *args, **kwargs):
+        """Send a request once the controller allows it, and report the outcome."""
+        self.controller.acquire()
+        start_time = time.time()
+        try:
+            response = super().send(request, *args, **kwargs)
+        except Exception:
+            self.controller.record(None, time.time() - start_time)
+            raise
+        self.controller.record(response.status_code, time.time() - start_time)
+        return response
+
+
+# The URL prefixes each controller covers. Requests picks the adapter with the
+# longest matching prefix, so each API gets its own controller.
+CONTROLLED_PREFIXES = {
+    "memento": "https://web.archive.org/web/",
+    "search": "https://web.archive.org/cdx/",
+}
+
+
+def mount_controllers(
+    session: wayback.WaybackSession, controllers: Dict[str, AdaptiveRateController]
+):
+    """Send a Wayback session's requests under rate controllers.
+
+    The session's own per-process limits are turned off for each API with a
+    controller, since the controller already paces those requests.
+    """
+    for name, controller in controllers.items():
+        session.mount(CONTROLLED_PREFIXES[name], RateControlledAdapter(controller))
+    if "memento" in controllers:
+        session.memento_calls_per_second = 0
+    if "search" in controllers:
+        session.search_calls_per_second = 0
+
+
+def controllers_from_config(config_file: Path) -> Dict[str, AdaptiveRateController]:
+    """Create rate controllers from the `rate_control` section of a config file.
+
+    The section looks like::
+
+        "rate_control": {
+            "redis_url": "redis://localhost:6379/0",
+            "memento": {"initial_rate": 10, "max_rate": 60},
+            "search": {"initial_rate": 0.5, "max_rate": 2}
+        }
+
+    Without a `redis_url`, the rate is controlled in-process. Without a
+    `rate_control` section at all, no controllers are created.
+    """
+    config = load_config(config_file).get("rate_control")
+    if config is None:
+        return {}
+
+    redis_client = None
+    if config.get("redis_url"):
+        import redis
+
+        redis_client = redis.Redis.from_url(config["redis_url"])
+
+    controllers = {}
+    for name, defaults in DEFAULT_LIMITS.items():
+        limits = RateLimits(**{**defaults.__dict__, **config.get(name, {})})
+        state: Any
+        if redis_client is not None:
+            state = RedisRateState(redis_client, name)
+        else:
+            state = LocalRateState(limits)
+        controllers[name] = AdaptiveRateController(state, limits)
+    return controllers
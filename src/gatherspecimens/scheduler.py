@@ -0,0 +1,112 @@
+"""Scheduling of Celery tasks with a fixed number in flight."""
+
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, Iterable, Iterator, Optional
+
+from vine import promise
+
+log = logging.getLogger(__name__)
+
+# Seconds to sleep between checks for finished tasks when none have finished,
+# with a results backend that can't report them as they finish.
+DEFAULT_POLL_INTERVAL = 0.05
+
+
+@dataclass
+class TaskOutcome:
+    """The outcome of a finished task: its return value or its error."""
+
+    task_id: str
+    value: Any = None
+    error: Optional[BaseException] = None
+
+
+class SlidingWindow:
+    """Keeps up to a fixed number of tasks in flight.
+
+    Tasks are sent from an iterable of signatures, which is only consumed as
+    room becomes available, so it can lazily select more work. Outcomes are
+    yielded in the order the tasks finish, and each finished task is replaced
+    straight away, so one slow task never holds up the rest.
+
+    Results backends that push results, like rpc and Redis, report each task as
+    it finishes. Other backends are polled.
+    """
+
+    def __init__(self, size: int, poll_interval: float = DEFAULT_POLL_INTERVAL):
+        """Set up an empty window of the given number of tasks."""
+        if size < 1:
+            raise ValueError(f"Window size must be at least 1, not {size}")
+        self.size = size
+        self.poll_interval = poll_interval
+        self.pending: Dict[str, Any] = {}
+        self.finished: Deque[Any] = deque()
+        self.any_finished = promise()
+
+    @property
+    def in_flight(self) -> int:
+        """Return the number of tasks sent but not yet finished."""
+        return len(self.pending)
+
+    def run(self, signatures: Iterable[Any]) -> Iterator[TaskOutcome]:
+        """Send every task, yielding their outcomes as they finish."""
+        signatures = iter(signatures)
+        exhausted = False
+        while True:
+            while not exhausted and len(self.pending) < self.size:
+                signature = next(signatures, None)
+                if signature is None:
+                    exhausted = True
+                else:
+                    result = signature.apply_async()
+                    self.pending[result.id] = result
+                    result.then(self.on_finished)
+
+            if not self.pending:
+                return
+
+            if not self.finished:
+                self.wait()
+            while self.finished:
+                result = self.finished.popleft()
+                del self.pending[result.id]
+                yield self.outcome(result)
+
+    def on_finished(self, result: Any):
+        """Queue a task's result once the backend reports it finished."""
+        self.finished.append(result)
+        self.any_finished()
+
+    def wait(self):
+        """Wait until at least one task has finished."""
+        self.any_finished = promise()
+        backend = next(iter(self.pending.values())).backend
+        if backend.is_async:
+            for _ in backend.result_consumer.drain_events_until(self.any_finished):
+                pass
+            return
+        while not self.finished:
+            # Checking whether a task is ready fetches its result, which calls
+            # on_finished if it has finished.
+            for result in self.pending.values():
+                result.ready()
+            if not self.finished:
+                time.sleep(self.poll_interval)
+
+    @staticmethod
+    def outcome(result: Any) -> TaskOutcome:
+        """Collect the outcome of a finished task, and forget its result."""
+        try:
+            outcome = TaskOutcome(result.id, value=result.get())
+        except Exception as e:
+            log.debug("Task %s failed: %s", result.id, e)
+            outcome = TaskOutcome(result.id, error=e)
+        try:
+            result.forget()
+        except NotImplementedError:
+            # Results in the rpc backend are gone once they are received.
+            pass
+        return outcome
@@ -1,15 +1,25 @@
 """SQLAlchemy schema for the gatherspecimens package."""
 
 import base64
-from datetime import datetime, timezone
-from typing import Any, Dict, Optional
+from datetime import date, datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, cast
 
-from sqlalchemy import DateTime, Integer, LargeBinary, String, UnicodeText
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+from sqlalchemy import (BigInteger, Boolean, CursorResult, Date, DateTime,
+                        Engine, ForeignKey, Index, Integer, LargeBinary,
+                        String, UnicodeText, UniqueConstraint, inspect, select,
+                        text)
+from sqlalchemy.orm import (DeclarativeBase, Mapped, Session, mapped_column,
+                            relationship)
 from typing_extensions import Self
 from wayback import CdxRecord
 
-from gatherspecimens.utils import url_hash
+from gatherspecimens import blobstore, compression
+from gatherspecimens.blobstore import blob_key
+from gatherspecimens.compression import Dictionary
+from gatherspecimens.utils import insert_ignoring_conflicts, url_hash
+
+# The format of timestamps in CDX records and packed task payloads.
+CDX_TIMESTAMP = "%Y%m%d%H%M%S"
 
 
 class Base(DeclarativeBase):
@@ -35,21 +45,26 @@ class CdxRecordSpecimen(Base):
     raw_url: Mapped[str] = mapped_column(UnicodeText)
     view_url: Mapped[str] = mapped_column(UnicodeText)
 
+    @staticmethod
+    def values_from_cdx_record(record: CdxRecord) -> Dict[str, Any]:
+        """Convert a CdxRecord to a mapping of column values for bulk inserts."""
+        return {
+            "hash_raw_url": url_hash(record.raw_url),
+            "key": record.key,
+            "timestamp": record.timestamp,
+            "url": record.url,
+            "mime_type": record.mime_type,
+            "status_code": record.status_code,
+            "digest": record.digest,
+            "length": record.length,
+            "raw_url": record.raw_url,
+            "view_url": record.view_url,
+        }
+
     @classmethod
     def from_cdx_record(cls, record: CdxRecord) -> Self:
         """Create a new instance from a CdxRecord."""
-        return cls(
-            hash_raw_url=url_hash(record.raw_url),
-            key=record.key,
-            timestamp=record.timestamp,
-            url=record.url,
-            mime_type=record.mime_type,
-            status_code=record.status_code,
-            digest=record.digest,
-            length=record.length,
-            raw_url=record.raw_url,
-            view_url=record.view_url,
-        )
+        return cls(**cls.values_from_cdx_record(record))
 
     def to_cdx_record(self) -> CdxRecord:
         """Convert the instance to a CdxRecord."""
@@ -84,10 +99,14 @@ class CdxRecordSpecimen(Base):
 
     @classmethod
     def from_serializable(cls, data: Dict[str, Any]) -> Self:
-        """Create a new instance from a serializable dictionary."""
+        """Create a new instance from a serializable dictionary.
+
+        The URL hash is recomputed if the dictionary doesn't have it, as with
+        rows of `selection.PENDING_COLUMNS`.
+        """
         return cls(
             id=data["id"],
-            hash_raw_url=data["hash_raw_url"],
+            hash_raw_url=data.get("hash_raw_url") or url_hash(data["raw_url"]),
             key=data["key"],
             timestamp=data["timestamp"],
             url=data["url"],
@@ -99,6 +118,258 @@ class CdxRecordSpecimen(Base):
             view_url=data["view_url"],
         )
 
+    @staticmethod
+    def to_packed(record: Any) -> List[Any]:
+        """Pack a record or result row into a compact list for task payloads.
+
+        Field names are implied by position, the timestamp is a CDX timestamp
+        string, and the URL hash is left out, as it can be recomputed.
+        """
+        timestamp = record.timestamp
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(timezone.utc)
+        return [
+            record.id,
+            record.key,
+            timestamp.strftime(CDX_TIMESTAMP),
+            record.url,
+            record.mime_type,
+            record.status_code,
+            record.digest,
+            record.length,
+            record.raw_url,
+            record.view_url,
+        ]
+
+    @classmethod
+    def from_packed(cls, values: Sequence[Any]) -> Self:
+        """Create a new instance from a packed list."""
+        (
+            record_id,
+            key,
+            timestamp,
+            url,
+            mime_type,
+            status_code,
+            digest,
+            length,
+            raw_url,
+            view_url,
+        ) = values
+        return cls(
+            id=record_id,
+            hash_raw_url=url_hash(raw_url),
+            key=key,
+            timestamp=datetime.strptime(timestamp, CDX_TIMESTAMP).replace(
+                tzinfo=timezone.utc
+            ),
+            url=url,
+            mime_type=mime_type,
+            status_code=status_code,
+            digest=digest,
+            length=length,
+            raw_url=raw_url,
+            view_url=view_url,
+        )
+
+    @classmethod
+    def load_many(cls, db_session: Session, ids: Iterable[int]) -> Dict[int, Self]:
+        """Load the records with the given ids in one query, keyed by id.
+
+        The records are expunged from the session, so they can be used after
+        it is closed. Ids with no record are left out.
+        """
+        ids = list(ids)
+        if not ids:
+            return {}
+        records = db_session.scalars(select(cls).where(cls.id.in_(ids))).all()
+        for record in records:
+            db_session.expunge(record)
+        return {record.id: record for record in records}
+
+
+class CompressionDictionary(Base):
+    """Model for storing zstd dictionaries trained on memento bodies."""
+
+    __tablename__ = "compression_dictionary"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    # The host whose pages the dictionary was trained on.
+    name: Mapped[str] = mapped_column(String, index=True)
+    created: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    data: Mapped[bytes] = mapped_column(LargeBinary)
+
+    @classmethod
+    def latest_by_name(cls, db_session: Session) -> Dict[str, Dictionary]:
+        """Load the most recently trained dictionary for each name."""
+        latest: Dict[str, Dictionary] = {}
+        for row in db_session.query(cls).order_by(cls.created):
+            latest[row.name] = Dictionary(row.id, row.data)
+        return latest
+
+
+class MementoBlob(Base):
+    """Model for storing memento content once per distinct digest."""
+
+    __tablename__ = "memento_blob"
+
+    digest: Mapped[str] = mapped_column(String, primary_key=True)
+    # The stored content is deferred, so queries that don't need it don't load it.
+    # It is None when the content is kept in the blob store named by `backend`.
+    content: Mapped[Optional[bytes]] = mapped_column(LargeBinary, deferred=True)
+    # The codec the content is compressed with; None means uncompressed.
+    codec: Mapped[Optional[str]] = mapped_column(String)
+    dictionary_id: Mapped[Optional[int]] = mapped_column(
+        ForeignKey("compression_dictionary.id")
+    )
+    # The uncompressed length of the content.
+    length: Mapped[Optional[int]] = mapped_column(Integer)
+    # The length of the content as stored, after compression.
+    stored_length: Mapped[Optional[int]] = mapped_column(Integer)
+    # The blob store holding the content; None means the content column.
+    backend: Mapped[Optional[str]] = mapped_column(String)
+    dictionary: Mapped[Optional[CompressionDictionary]] = relationship()
+
+    @property
+    def key(self) -> str:
+        """Return the name the content is stored under in a blob store."""
+        return blob_key(self.digest, self.codec, self.dictionary_id)
+
+    @property
+    def data(self) -> bytes:
+        """Return the uncompressed content, wherever it is stored."""
+        dictionary = self.dictionary.data if self.dictionary else None
+        if self.backend is None:
+            if self.content is None:
+                raise ValueError(f"Blob {self.digest} has no content")
+            return compression.decompress(self.content, self.codec, dictionary)
+        with blobstore.get_store(self.backend).view(self.key) as content:
+            return compression.decompress(content, self.codec, dictionary)
+
+    @classmethod
+    def exists(cls, db_session: Session, digest: str) -> bool:
+        """Check whether content with the given digest is already stored."""
+        return (
+            db_session.scalar(select(cls.digest).where(cls.digest == digest))
+            is not None
+        )
+
+    @classmethod
+    def existing(cls, db_session: Session, digests: Iterable[str]) -> Set[str]:
+        """Return which of the given digests already have stored content."""
+        digests = [digest for digest in digests if digest]
+        if not digests:
+            return set()
+        return set(
+            db_session.scalars(select(cls.digest).where(cls.digest.in_(digests)))
+        )
+
+    @staticmethod
+    def compressed_values(
+        content: bytes, codec: Optional[str], dictionary: Optional[Dictionary]
+    ) -> Dict[str, Any]:
+        """Compress content, returning the column values to store it with."""
+        codec = codec or compression.default_codec()
+        if codec != compression.ZSTD:
+            dictionary = None
+        compressed = compression.compress(
+            content, codec, dictionary.data if dictionary else None
+        )
+        return {
+            "content": compressed,
+            "codec": codec,
+            "dictionary_id": dictionary.id if dictionary else None,
+            "length": len(content),
+            "stored_length": len(compressed),
+        }
+
+    @classmethod
+    def stored_values(
+        cls,
+        digest: str,
+        content: bytes,
+        codec: Optional[str],
+        dictionary: Optional[Dictionary],
+    ) -> Dict[str, Any]:
+        """Compress content and write it to the configured blob store, if any.
+
+        Returns the column values to store it with. If the transaction storing
+        them doesn't commit, the file written is left for `collect_garbage` in
+        `compressbodies`, since another transaction may be storing the same
+        content in it.
+        """
+        values = cls.compressed_values(content, codec, dictionary)
+        store = blobstore.writer()
+        if store is None:
+            values["backend"] = None
+            return values
+        store.put(
+            blob_key(digest, values["codec"], values["dictionary_id"]),
+            values["content"],
+        )
+        values["content"] = None
+        values["backend"] = store.name
+        return values
+
+    @classmethod
+    def store(
+        cls,
+        db_session: Session,
+        digest: str,
+        content: bytes,
+        codec: Optional[str] = None,
+        dictionary: Optional[Dictionary] = None,
+    ):
+        """Store content under the given digest, unless it is already stored.
+
+        The content is compressed with the given codec (by default, the best
+        available) and, for zstd, the given dictionary, and kept in the
+        configured blob store or, by default, in the table.
+        """
+        dialect_name = db_session.get_bind().dialect.name
+        values = cls.stored_values(digest, content, codec, dictionary)
+        result = db_session.execute(
+            insert_ignoring_conflicts(dialect_name, cls, ["digest"]).values(
+                digest=digest, **values
+            )
+        )
+        if values["backend"] is not None and cast(CursorResult, result).rowcount == 0:
+            # The digest was already stored, perhaps compressed differently, in
+            # which case the file just written isn't needed.
+            delete_unused_file(
+                db_session,
+                values["backend"],
+                digest,
+                values["codec"],
+                values["dictionary_id"],
+            )
+
+
+def delete_unused_file(
+    db_session: Session,
+    backend: str,
+    digest: str,
+    codec: Optional[str],
+    dictionary_id: Optional[int],
+):
+    """Delete a blob store file, unless the blob with its digest uses it.
+
+    The blob's row is locked first, so that a transaction recompressing it into
+    this file has committed before the check.
+    """
+    blob = db_session.execute(
+        select(MementoBlob.backend, MementoBlob.codec, MementoBlob.dictionary_id)
+        .where(MementoBlob.digest == digest)
+        .with_for_update()
+    ).first()
+    key = blob_key(digest, codec, dictionary_id)
+    if blob is not None and (
+        blob.backend == backend
+        and blob_key(digest, blob.codec, blob.dictionary_id) == key
+    ):
+        return
+    blobstore.get_store(backend).delete(key)
+
 
 class MementoSpecimen(Base):
     """Model for storing scraped pages in the database."""
@@ -112,11 +383,25 @@ class MementoSpecimen(Base):
     status_code: Mapped[Optional[int]] = mapped_column(Integer)
     time: Mapped[datetime] = mapped_column(DateTime)
     view_url: Mapped[str] = mapped_column(UnicodeText)
-    html_content: Mapped[bytes] = mapped_column(LargeBinary)
+    # Older rows store their content inline; newer rows reference a blob.
+    html_content: Mapped[Optional[bytes]] = mapped_column(LargeBinary)
+    digest: Mapped[Optional[str]] = mapped_column(
+        ForeignKey("memento_blob.digest"), index=True
+    )
+    blob: Mapped[Optional[MementoBlob]] = relationship()
+
+    @property
+    def content(self) -> bytes:
+        """Return the content of the memento, wherever it is stored."""
+        if self.html_content is not None:
+            return self.html_content
+        if self.blob is not None:
+            return self.blob.data
+        raise ValueError(f"Memento {self.id} has no content")
 
     def to_serializable(self) -> Dict[str, Any]:
         """Convert the instance to a serializable dictionary."""
-        base64_content = base64.b64encode(self.html_content).decode("utf-8")
+        base64_content = base64.b64encode(self.content).decode("utf-8")
         return {
             "id": self.id,
             "hash_raw_url": self.hash_raw_url,
@@ -152,3 +437,143 @@ class MementoFailure(Base):
     __tablename__ = "memento_failure"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    # The class of failure, from `gatherspecimens.failures`. Failures recorded
+    # before failures were classified have no reason, and aren't retried.
+    reason: Mapped[Optional[str]] = mapped_column(String, index=True)
+    attempts: Mapped[Optional[int]] = mapped_column(Integer)
+    last_attempt: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True))
+    # When the record may next be retried, or None if it won't be.
+    next_attempt: Mapped[Optional[datetime]] = mapped_column(
+        DateTime(timezone=True), index=True
+    )
+
+
+class CdxCrawlCheckpoint(Base):
+    """Model for storing the progress of CDX crawls so they can be resumed."""
+
+    __tablename__ = "cdx_crawl_checkpoint"
+    __table_args__ = (UniqueConstraint("prefix", "window"),)
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    prefix: Mapped[str] = mapped_column(UnicodeText)
+    # The time window of the crawl, as `<from>-<to>` CDX timestamps.
+    window: Mapped[str] = mapped_column(String(64))
+    # The CDX API resume key of the last page whose records were all committed.
+    resume_key: Mapped[Optional[str]] = mapped_column(UnicodeText)
+    completed: Mapped[bool] = mapped_column(Boolean, default=False)
+    updated: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    # The number of CDX records inserted by the crawl so far.
+    records: Mapped[Optional[int]] = mapped_column(Integer)
+
+
+class CdxCrawlWatermark(Base):
+    """Model for storing the latest capture crawled under each prefix.
+
+    Incremental crawls only search for captures after the watermark.
+    """
+
+    __tablename__ = "cdx_crawl_watermark"
+
+    prefix: Mapped[str] = mapped_column(UnicodeText, primary_key=True)
+    timestamp: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    updated: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+
+
+class GatherPriority(Base):
+    """Model for storing the round each CDX record is gathered in.
+
+    Prioritized gathering passes gather the records of each round in turn, so
+    earlier rounds cover every URL before later ones fill in its history.
+    """
+
+    __tablename__ = "gather_priority"
+    __table_args__ = (
+        Index("ix_gather_priority_round_record_id", "round", "record_id"),
+    )
+
+    record_id: Mapped[int] = mapped_column(
+        ForeignKey("cdx_record_specimen.id"), primary_key=True
+    )
+    round: Mapped[int] = mapped_column(Integer)
+
+
+class Article(Base):
+    """Model for storing the article extracted from a memento.
+
+    Every HTML memento that has been through extraction has a row, even if no
+    article was found in it, so extraction can pick up the mementos without one.
+    """
+
+    __tablename__ = "article"
+
+    memento_id: Mapped[int] = mapped_column(
+        ForeignKey("memento_specimen.id"), primary_key=True
+    )
+    # The era of the site the page is from, from `gatherspecimens.articles`.
+    era: Mapped[str] = mapped_column(String, index=True)
+    title: Mapped[Optional[str]] = mapped_column(UnicodeText)
+    author: Mapped[Optional[str]] = mapped_column(UnicodeText, index=True)
+    published: Mapped[Optional[date]] = mapped_column(Date, index=True)
+    text: Mapped[str] = mapped_column(UnicodeText)
+    extracted: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+
+
+class MementoFingerprint(Base):
+    """Model for storing the SimHash of a memento's text, to find near-duplicates.
+
+    The URL and timestamp are copied from the memento's CDX record, so captures
+    of a URL can be compared without joining other tables.
+    """
+
+    __tablename__ = "memento_fingerprint"
+    __table_args__ = (
+        Index("ix_memento_fingerprint_url_timestamp", "url", "timestamp"),
+    )
+
+    memento_id: Mapped[int] = mapped_column(
+        ForeignKey("memento_specimen.id"), primary_key=True
+    )
+    url: Mapped[str] = mapped_column(UnicodeText)
+    timestamp: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    # The 64-bit SimHash, as a signed integer to fit a BIGINT column.
+    simhash: Mapped[int] = mapped_column(BigInteger)
+    # The first fingerprinted capture of the URL that this capture is a
+    # near-duplicate of, or this capture's own id if there is none.
+    cluster: Mapped[int] = mapped_column(Integer)
+
+
+def create_schema(engine: Engine):
+    """Create any missing tables, and add any columns missing from existing tables.
+
+    There are no migrations, so columns added to existing models are nullable
+    and are added to existing tables here.
+    """
+    Base.metadata.create_all(engine)
+
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {c["name"]: c for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(
+                        text(
+                            f"ALTER TABLE {table.name} "
+                            f"ADD COLUMN {column.name} {column_type}"
+                        )
+                    )
+                elif (
+                    column.nullable
+                    and not existing[column.name]["nullable"]
+                    and engine.dialect.name == "postgresql"
+                ):
+                    conn.execute(
+                        text(
+                            f"ALTER TABLE {table.name} "
+                            f"ALTER COLUMN {column.name} DROP NOT NULL"
+                        )
+                    )
+
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
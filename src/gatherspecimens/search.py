@@ -0,0 +1,230 @@
+"""Searches the text of extracted articles.
+
+The index covers the `article` table, which `extractarticles` fills. On
+PostgreSQL it is a generated tsvector column with a GIN index; on SQLite it is
+an FTS5 table kept in step with `article` by triggers. Either way the database
+updates the index as articles are stored, so it never needs rebuilding.
+
+Titles rank above authors, and authors above body text. Queries use the web
+search syntax: words must all appear, `"quoted phrases"` must appear as
+written, `or` between words accepts either, and `-word` excludes pages.
+"""
+
+import argparse
+import logging
+import re
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+
+from sqlalchemy import (DateTime, Engine, Float, Integer, UnicodeText, inspect,
+                        text)
+
+from gatherspecimens.schema import create_schema
+from gatherspecimens.utils import common_logging, get_engine
+
+log = logging.getLogger(__name__)
+
+# The text search configuration PostgreSQL stems words with.
+POSTGRES_CONFIG = "english"
+
+POSTGRES_DDL = [
+    f"""
+    ALTER TABLE article ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('{POSTGRES_CONFIG}', coalesce(title, '')), 'A')
+        || setweight(to_tsvector('{POSTGRES_CONFIG}', coalesce(author, '')), 'B')
+        || setweight(to_tsvector('{POSTGRES_CONFIG}', text), 'C')
+    ) STORED
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ix_article_search_vector
+    ON article USING GIN (search_vector)
+    """,
+]
+
+POSTGRES_QUERY = f"""
+    SELECT m.id, m.url, m.time, a.title,
+           ts_rank_cd(a.search_vector, q.query) AS rank
+    FROM article a
+    JOIN memento_specimen m ON m.id = a.memento_id,
+         websearch_to_tsquery('{POSTGRES_CONFIG}', :query) AS q(query)
+    WHERE a.search_vector @@ q.query
+    ORDER BY rank DESC, m.id
+    LIMIT :limit
+"""
+
+# The FTS5 table reads its content from `article`, so the text isn't stored
+# twice, and the triggers tell it when that content changes.
+SQLITE_TABLE = """
+    CREATE VIRTUAL TABLE article_fts USING fts5(
+        title, author, text,
+        content='article', content_rowid='memento_id',
+        tokenize='porter unicode61'
+    )
+"""
+
+SQLITE_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS article_fts_insert AFTER INSERT ON article BEGIN
+        INSERT INTO article_fts (rowid, title, author, text)
+        VALUES (new.memento_id, new.title, new.author, new.text);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS article_fts_delete AFTER DELETE ON article BEGIN
+        INSERT INTO article_fts (article_fts, rowid, title, author, text)
+        VALUES ('delete', old.memento_id, old.title, old.author, old.text);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS article_fts_update AFTER UPDATE ON article BEGIN
+        INSERT INTO article_fts (article_fts, rowid, title, author, text)
+        VALUES ('delete', old.memento_id, old.title, old.author, old.text);
+        INSERT INTO article_fts (rowid, title, author, text)
+        VALUES (new.memento_id, new.title, new.author, new.text);
+    END
+    """,
+]
+
+# bm25 is lower for better matches, so its negation is the rank.
+SQLITE_QUERY = """
+    SELECT m.id, m.url, m.time, a.title,
+           -bm25(article_fts, 10.0, 5.0, 1.0) AS rank
+    FROM article_fts
+    JOIN article a ON a.memento_id = article_fts.rowid
+    JOIN memento_specimen m ON m.id = a.memento_id
+    WHERE article_fts MATCH :query
+    ORDER BY rank DESC, m.id
+    LIMIT :limit
+"""
+
+TERM_PATTERN = re.compile(r'(-?)"([^"]*)"?|(\S+)')
+
+
+@dataclass
+class SearchResult:
+    """A page matching a search, with how well it matches."""
+
+    memento_id: int
+    url: str
+    time: datetime
+    title: Optional[str]
+    rank: float
+
+
+def create_search_index(engine: Engine):
+    """Create the full-text index over articles, if it doesn't exist yet."""
+    with engine.begin() as conn:
+        if engine.dialect.name == "postgresql":
+            for statement in POSTGRES_DDL:
+                conn.execute(text(statement))
+        elif engine.dialect.name == "sqlite":
+            if not inspect(conn).has_table("article_fts"):
+                conn.execute(text(SQLITE_TABLE))
+                # Index the articles stored before the index existed.
+                conn.execute(
+                    text("INSERT INTO article_fts (article_fts) VALUES ('rebuild')")
+                )
+            for statement in SQLITE_TRIGGERS:
+                conn.execute(text(statement))
+        else:
+            raise ValueError(f"Unsupported database dialect: {engine.dialect.name}")
+
+
+def fts5_query(query: str) -> Optional[str]:
+    """Translate a web search style query into an FTS5 query.
+
+    Every term is quoted, so punctuation in it is not taken as FTS5 syntax.
+    Returns None if the query has nothing to match.
+    """
+    groups: List[List[str]] = [[]]
+    excluded = []
+    alternative = False
+    for match in TERM_PATTERN.finditer(query):
+        negated, phrase, word = match.groups()
+        if word is not None:
+            if word.lower() == "or":
+                alternative = True
+                continue
+            negated = "-" if word.startswith("-") and len(word) > 1 else ""
+            phrase = word[1:] if negated else word
+        if not phrase.strip():
+            continue
+        term = '"' + phrase.replace('"', '""') + '"'
+        if negated:
+            excluded.append(term)
+        elif alternative and groups[-1]:
+            groups[-1].append(term)
+        else:
+            groups.append([term])
+        alternative = False
+
+    terms = [
+        group[0] if len(group) == 1 else f"({' OR '.join(group)})"
+        for group in groups
+        if group
+    ]
+    if not terms:
+        return None
+    return " AND ".join(terms) + "".join(f" NOT {term}" for term in excluded)
+
+
+def search(engine: Engine, query: str, limit: int = 20) -> List[SearchResult]:
+    """Find the articles best matching a query."""
+    parameter: Optional[str] = query
+    if engine.dialect.name == "postgresql":
+        statement = POSTGRES_QUERY
+    elif engine.dialect.name == "sqlite":
+        statement, parameter = SQLITE_QUERY, fts5_query(query)
+        if parameter is None:
+            return []
+    else:
+        raise ValueError(f"Unsupported database dialect: {engine.dialect.name}")
+
+    with engine.connect() as conn:
+        rows = conn.execute(
+            text(statement).columns(
+                id=Integer,
+                url=UnicodeText,
+                time=DateTime,
+                title=UnicodeText,
+                rank=Float,
+            ),
+            {"query": parameter, "limit": limit},
+        )
+        return [SearchResult(*row) for row in rows]
+
+
+def main():
+    """Search extracted articles and print the best matches."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--config",
+        help="Path to the database configuration file",
+        type=Path,
+        default=Path("config.json"),
+    )
+    parser.add_argument(
+        "--limit", help="Maximum number of results", type=int, default=20
+    )
+    parser.add_argument("query", help="Words or phrases to search for")
+    args = parser.parse_args()
+
+    engine = get_engine(args.config)
+    create_schema(engine)
+    create_search_index(engine)
+
+    for result in search(engine, args.query, args.limit):
+        print(f"{result.rank:.4f}\t{result.time}\t{result.url}\t{result.title or ''}")
+
+
+def run():
+    """Run the main function with common logging."""
+    common_logging(__name__, __file__)
+    main()
+
+
+if __name__ == "__main__":
+    run()
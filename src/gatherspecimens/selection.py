@@ -0,0 +1,238 @@
+"""Queries for selecting CDX records that still need their mementos gathered."""
+
+from datetime import datetime, timezone
+from typing import Any, List, Optional, Sequence
+
+from sqlalchemy import (ColumnElement, Select, and_, case, delete, exists,
+                        extract, func, insert, or_, select)
+from sqlalchemy.orm import Session
+
+from gatherspecimens.failures import TRANSIENT_REASONS
+from gatherspecimens.schema import (CdxRecordSpecimen, GatherPriority,
+                                    MementoFailure, MementoFingerprint,
+                                    MementoSpecimen)
+
+# The columns needed to rebuild a CdxRecordSpecimen in a worker task. The URL
+# hash is left out, as it can be recomputed from the raw URL.
+PENDING_COLUMNS = (
+    CdxRecordSpecimen.id,
+    CdxRecordSpecimen.key,
+    CdxRecordSpecimen.timestamp,
+    CdxRecordSpecimen.url,
+    CdxRecordSpecimen.mime_type,
+    CdxRecordSpecimen.status_code,
+    CdxRecordSpecimen.digest,
+    CdxRecordSpecimen.length,
+    CdxRecordSpecimen.raw_url,
+    CdxRecordSpecimen.view_url,
+)
+
+# Policies for not gathering captures that are likely near-duplicates of ones
+# already gathered, going by the clusters in `nearduplicates`.
+SKIP = "skip"
+COLLAPSE = "collapse"
+NEAR_DUPLICATE_POLICIES = (SKIP, COLLAPSE)
+
+# Orders records can be gathered in: by id, or in prioritized rounds that take
+# the latest, the earliest, or captures spread across the years first.
+ID = "id"
+LATEST = "latest"
+EARLIEST = "earliest"
+SPREAD = "spread"
+GATHER_ORDERS = (ID, LATEST, EARLIEST, SPREAD)
+
+
+def near_duplicate_filter(policy: str) -> ColumnElement[bool]:
+    """Build a condition excluding likely near-duplicates under a policy.
+
+    - `skip` excludes captures whose nearest fingerprinted captures of the same
+      URL, before and after them, are in one cluster: the page didn't change
+      in between.
+    - `collapse` also excludes every capture of a URL whose fingerprinted
+      captures, at least two of them, are all in one cluster: the page looks
+      like it never changes.
+    """
+    if policy not in NEAR_DUPLICATE_POLICIES:
+        raise ValueError(f"Unknown near-duplicate policy: {policy}")
+
+    def nearest_cluster(later: bool):
+        same_url = MementoFingerprint.url == CdxRecordSpecimen.url
+        if later:
+            order = MementoFingerprint.timestamp.asc()
+            side = MementoFingerprint.timestamp > CdxRecordSpecimen.timestamp
+        else:
+            order = MementoFingerprint.timestamp.desc()
+            side = MementoFingerprint.timestamp < CdxRecordSpecimen.timestamp
+        return (
+            select(MementoFingerprint.cluster)
+            .where(same_url, side)
+            .order_by(order)
+            .limit(1)
+            .scalar_subquery()
+        )
+
+    # A missing neighbour never matches, so captures at either end are kept.
+    condition = func.coalesce(nearest_cluster(False), -1) != func.coalesce(
+        nearest_cluster(True), -2
+    )
+    if policy == COLLAPSE:
+        unchanging = (
+            select(MementoFingerprint.url)
+            .where(MementoFingerprint.url == CdxRecordSpecimen.url)
+            .group_by(MementoFingerprint.url)
+            .having(
+                and_(
+                    func.count() >= 2,
+                    func.min(MementoFingerprint.cluster)
+                    == func.max(MementoFingerprint.cluster),
+                )
+            )
+        )
+        condition = and_(condition, ~exists(unchanging))
+    return condition
+
+
+def priority_rounds(order: str) -> Select:
+    """Select the round each CDX record should be gathered in, for an order.
+
+    Captures are ranked within each URL key, and a capture's rank is its
+    round, so round 1 has one capture of every URL. Within a URL, 2xx
+    captures come before others, and captures with a digest not yet ranked
+    before those repeating one. Ties are broken by the order: the latest or
+    earliest capture first, or for `spread`, the latest capture of each year
+    before the second latest of any year.
+    """
+    if order not in GATHER_ORDERS or order == ID:
+        raise ValueError(f"Not a prioritized order: {order}")
+
+    record = CdxRecordSpecimen
+    by_time = (
+        (record.timestamp.asc(), record.id)
+        if order == EARLIEST
+        else (record.timestamp.desc(), record.id)
+    )
+    not_ok = case(
+        (and_(record.status_code >= 200, record.status_code < 300), 0), else_=1
+    )
+    columns = [
+        record.id,
+        record.key,
+        record.timestamp,
+        not_ok.label("not_ok"),
+        func.row_number()
+        .over(partition_by=(record.key, record.digest), order_by=by_time)
+        .label("digest_rank"),
+    ]
+    if order == SPREAD:
+        columns.append(
+            func.row_number()
+            .over(
+                partition_by=(record.key, extract("year", record.timestamp)),
+                order_by=by_time,
+            )
+            .label("year_rank")
+        )
+    ranked = (
+        select(*columns)
+        .where(or_(record.status_code.is_(None), record.status_code < 400))
+        .subquery()
+    )
+
+    ordering: List[ColumnElement[Any]] = [ranked.c.not_ok, ranked.c.digest_rank]
+    if order == SPREAD:
+        ordering.append(ranked.c.year_rank)
+    ordering.append(
+        ranked.c.timestamp.asc() if order == EARLIEST else ranked.c.timestamp.desc()
+    )
+    ordering.append(ranked.c.id)
+    return select(
+        ranked.c.id,
+        func.row_number()
+        .over(partition_by=ranked.c.key, order_by=ordering)
+        .label("round"),
+    )
+
+
+def prioritize(db_session: Session, order: str) -> int:
+    """Work out the round of every CDX record, replacing any from earlier runs.
+
+    Rounds are worked out over all records, gathered or not, so they are the
+    same every time for the same records. Returns the number of rounds.
+    """
+    db_session.execute(delete(GatherPriority))
+    db_session.execute(
+        insert(GatherPriority).from_select(
+            ["record_id", "round"], priority_rounds(order)
+        )
+    )
+    return db_session.scalar(select(func.max(GatherPriority.round))) or 0
+
+
+def pending_records(
+    after_id: int,
+    limit: int,
+    columns: Sequence[Any] = PENDING_COLUMNS,
+    near_duplicates: Optional[str] = None,
+    priority_round: Optional[int] = None,
+) -> Select:
+    """Select the next chunk of CDX records that need gathering.
+
+    Records are paginated by id rather than offset, so every chunk costs the
+    same however far through the table it is. Records are excluded if they:
+
+    - have already been gathered
+    - have already failed gathering
+    - have a 4xx or higher status code, as there's no point in archiving them.
+
+    Only the given columns are selected, e.g. just the id when workers load
+    the rest themselves. With a `near_duplicates` policy, records that are
+    likely near-duplicates of gathered ones are excluded too. With a
+    `priority_round`, only records in that round (see `prioritize`) are
+    selected.
+    """
+    query = (
+        select(*columns)
+        .where(CdxRecordSpecimen.id > after_id)
+        .where(
+            or_(
+                CdxRecordSpecimen.status_code.is_(None),
+                CdxRecordSpecimen.status_code < 400,
+            )
+        )
+        .where(~exists().where(MementoSpecimen.id == CdxRecordSpecimen.id))
+        .where(~exists().where(MementoFailure.id == CdxRecordSpecimen.id))
+        .order_by(CdxRecordSpecimen.id)
+        .limit(limit)
+    )
+    if near_duplicates is not None:
+        query = query.where(near_duplicate_filter(near_duplicates))
+    if priority_round is not None:
+        query = query.join(
+            GatherPriority, GatherPriority.record_id == CdxRecordSpecimen.id
+        ).where(GatherPriority.round == priority_round)
+    return query
+
+
+def retryable_records(
+    after_id: int,
+    limit: int,
+    columns: Sequence[Any] = PENDING_COLUMNS,
+    now: Optional[datetime] = None,
+) -> Select:
+    """Select the next chunk of CDX records whose failures are due a retry.
+
+    Only records with transient failures whose backoff has passed by `now`
+    (default: the current time) are selected, paginated by id like
+    `pending_records`.
+    """
+    now = now or datetime.now(timezone.utc)
+    return (
+        select(*columns)
+        .join(MementoFailure, MementoFailure.id == CdxRecordSpecimen.id)
+        .where(CdxRecordSpecimen.id > after_id)
+        .where(MementoFailure.reason.in_(TRANSIENT_REASONS))
+        .where(MementoFailure.next_attempt <= now)
+        .where(~exists().where(MementoSpecimen.id == CdxRecordSpecimen.id))
+        .order_by(CdxRecordSpecimen.id)
+        .limit(limit)
+    )
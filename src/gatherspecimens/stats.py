@@ -0,0 +1,280 @@
+"""Cheap statistics about gathering progress.
+
+On PostgreSQL, row counts come from the statistics the server keeps as rows
+are written (`pg_stat_user_tables`), breakdowns by status code and failure
+reason come from the planner's column statistics (`pg_stats`), and sizes come
+from the size of each table on disk, plus the size of content kept in blob
+stores, estimated from a sample of the blob table. None of these scan the
+tables, so they are cheap enough to take every few seconds on tables with
+millions of rows, at the cost of being estimates.
+
+On other databases, which are expected to be small, the counts are exact.
+
+Per-prefix CDX record counts are kept in the crawl checkpoints as records are
+inserted, so they are exact on every database.
+"""
+
+import time
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Dict, Optional
+
+from sqlalchemy import Connection, Engine, func, select, text
+
+from gatherspecimens.schema import (CdxCrawlCheckpoint, CdxRecordSpecimen,
+                                    MementoBlob, MementoFailure,
+                                    MementoSpecimen)
+
+# The models whose rows are counted.
+COUNTED_MODELS = {
+    "cdx_records": CdxRecordSpecimen,
+    "mementos": MementoSpecimen,
+    "failures": MementoFailure,
+}
+
+# The models holding gathered content, whose tables' sizes are added up.
+CONTENT_MODELS = (MementoSpecimen, MementoBlob)
+
+# The number of blob rows sampled to estimate the size of content in blob stores.
+SAMPLE_ROWS = 10_000
+
+
+@dataclass
+class Snapshot:
+    """Statistics about the database at one point in time."""
+
+    # Seconds since the epoch.
+    taken: float
+    cdx_records: int = 0
+    mementos: int = 0
+    failures: int = 0
+    # Bytes of gathered content stored, including content in blob stores. On
+    # PostgreSQL, an estimate: the tables' whole size on disk, including indexes
+    # and overheads, plus the size of blob store content going by a sample.
+    stored_bytes: int = 0
+    status_codes: Dict[Optional[int], int] = field(default_factory=dict)
+    failure_reasons: Dict[Optional[str], int] = field(default_factory=dict)
+    prefixes: Dict[str, int] = field(default_factory=dict)
+
+    @property
+    def remaining(self) -> int:
+        """Return the number of CDX records that are neither gathered nor failed.
+
+        Records with a 4xx or higher status are never gathered (see
+        `selection.pending_records`), so they aren't counted.
+        """
+        ungathered = sum(
+            count
+            for status_code, count in self.status_codes.items()
+            if status_code is not None and status_code >= 400
+        )
+        return max(0, self.cdx_records - ungathered - self.mementos - self.failures)
+
+
+@dataclass
+class Progress:
+    """Rates of progress between two snapshots."""
+
+    cdx_records_per_second: float
+    mementos_per_second: float
+    failures_per_second: float
+    bytes_per_second: float
+    # The time left to gather the remaining records at the current rate.
+    eta: Optional[timedelta]
+
+
+def postgres_count(conn: Connection, table: str) -> int:
+    """Estimate the number of rows in a table."""
+    # The live row count is kept up to date as rows are written; the planner's
+    # estimate is only updated by VACUUM and ANALYZE.
+    count = conn.execute(
+        text(
+            "SELECT COALESCE("
+            "(SELECT n_live_tup FROM pg_stat_user_tables "
+            "WHERE relid = to_regclass(:table)), "
+            "(SELECT reltuples::bigint FROM pg_class "
+            "WHERE oid = to_regclass(:table)))"
+        ),
+        {"table": table},
+    ).scalar()
+    return max(0, int(count or 0))
+
+
+def postgres_counts(conn: Connection) -> Dict[str, int]:
+    """Estimate the number of rows in each counted table."""
+    return {
+        name: postgres_count(conn, model.__tablename__)
+        for name, model in COUNTED_MODELS.items()
+    }
+
+
+def postgres_offloaded_bytes(conn: Connection) -> int:
+    """Estimate the bytes of blob content kept in blob stores.
+
+    Their stored lengths are added up over a sample of the blob table's pages,
+    and scaled up to the whole table.
+    """
+    rows = postgres_count(conn, MementoBlob.__tablename__)
+    percent = min(100.0, 100.0 * SAMPLE_ROWS / max(rows, 1))
+    # Blobs stored before their stored length was recorded count in full.
+    sampled = conn.execute(
+        text(
+            "SELECT COALESCE(SUM(COALESCE(stored_length, length)), 0) "
+            f"FROM {MementoBlob.__tablename__} TABLESAMPLE SYSTEM (:percent) "
+            "WHERE backend IS NOT NULL"
+        ),
+        {"percent": percent},
+    ).scalar_one()
+    return round(int(sampled) * 100.0 / percent)
+
+
+def postgres_frequencies(
+    conn: Connection, table: str, column: str, total: int
+) -> Dict[Optional[str], int]:
+    """Estimate the number of rows with each common value of a column.
+
+    Values too rare to be in the planner's statistics are left out.
+    """
+    row = conn.execute(
+        text(
+            "SELECT null_frac, most_common_vals::text::text[], most_common_freqs "
+            "FROM pg_stats WHERE schemaname = current_schema() "
+            "AND tablename = :table AND attname = :column"
+        ),
+        {"table": table, "column": column},
+    ).first()
+    if row is None:
+        return {}
+
+    null_frac, values, freqs = row
+    estimates: Dict[Optional[str], int] = {}
+    if null_frac:
+        estimates[None] = round(null_frac * total)
+    for value, freq in zip(values or [], freqs or []):
+        estimates[value] = round(freq * total)
+    return estimates
+
+
+def postgres_snapshot(conn: Connection) -> Snapshot:
+    """Take a snapshot of a PostgreSQL database from its statistics.
+
+    Its counts and stored bytes are estimates.
+    """
+    taken = conn.execute(
+        text("SELECT extract(epoch FROM clock_timestamp())")
+    ).scalar_one()
+    counts = postgres_counts(conn)
+    snapshot = Snapshot(
+        taken=float(taken),
+        cdx_records=counts["cdx_records"],
+        mementos=counts["mementos"],
+        failures=counts["failures"],
+    )
+    snapshot.stored_bytes = sum(
+        int(
+            conn.execute(
+                text("SELECT COALESCE(pg_total_relation_size(to_regclass(:table)), 0)"),
+                {"table": model.__tablename__},
+            ).scalar_one()
+        )
+        for model in CONTENT_MODELS
+    ) + postgres_offloaded_bytes(conn)
+    snapshot.status_codes = {
+        int(value) if value is not None else None: count
+        for value, count in postgres_frequencies(
+            conn,
+            CdxRecordSpecimen.__tablename__,
+            "status_code",
+            snapshot.cdx_records,
+        ).items()
+    }
+    snapshot.failure_reasons = postgres_frequencies(
+        conn, MementoFailure.__tablename__, "reason", snapshot.failures
+    )
+    return snapshot
+
+
+def exact_snapshot(conn: Connection) -> Snapshot:
+    """Take a snapshot of a database by counting its rows."""
+    counts = {
+        name: conn.execute(select(func.count()).select_from(model)).scalar_one()
+        for name, model in COUNTED_MODELS.items()
+    }
+    snapshot = Snapshot(
+        taken=time.time(),
+        cdx_records=counts["cdx_records"],
+        mementos=counts["mementos"],
+        failures=counts["failures"],
+    )
+    # Only the size of the content is known, not the space it takes up. Blobs
+    # stored before their stored length was recorded count in full.
+    blob_length = func.coalesce(
+        func.length(MementoBlob.content), MementoBlob.stored_length, MementoBlob.length
+    )
+    snapshot.stored_bytes = (
+        conn.execute(select(func.coalesce(func.sum(blob_length), 0))).scalar_one()
+        + conn.execute(
+            select(
+                func.coalesce(func.sum(func.length(MementoSpecimen.html_content)), 0)
+            )
+        ).scalar_one()
+    )
+    snapshot.status_codes = dict(
+        row._tuple()
+        for row in conn.execute(
+            select(CdxRecordSpecimen.status_code, func.count()).group_by(
+                CdxRecordSpecimen.status_code
+            )
+        )
+    )
+    snapshot.failure_reasons = dict(
+        row._tuple()
+        for row in conn.execute(
+            select(MementoFailure.reason, func.count()).group_by(MementoFailure.reason)
+        )
+    )
+    return snapshot
+
+
+def prefix_counts(conn: Connection) -> Dict[str, int]:
+    """Return the number of CDX records inserted for each crawled prefix."""
+    rows = conn.execute(
+        select(
+            CdxCrawlCheckpoint.prefix,
+            func.coalesce(func.sum(CdxCrawlCheckpoint.records), 0),
+        ).group_by(CdxCrawlCheckpoint.prefix)
+    )
+    return {prefix: int(count) for prefix, count in rows}
+
+
+def take_snapshot(engine: Engine) -> Snapshot:
+    """Take a snapshot of gathering statistics without scanning large tables."""
+    with engine.connect() as conn:
+        if engine.dialect.name == "postgresql":
+            snapshot = postgres_snapshot(conn)
+        else:
+            snapshot = exact_snapshot(conn)
+        snapshot.prefixes = prefix_counts(conn)
+    return snapshot
+
+
+def progress(previous: Snapshot, current: Snapshot) -> Progress:
+    """Work out rates of progress between two snapshots."""
+    elapsed = max(current.taken - previous.taken, 1e-9)
+
+    def rate(name: str) -> float:
+        return (getattr(current, name) - getattr(previous, name)) / elapsed
+
+    mementos_per_second = rate("mementos")
+    failures_per_second = rate("failures")
+    finished_per_second = mementos_per_second + failures_per_second
+    eta = None
+    if finished_per_second > 0:
+        eta = timedelta(seconds=round(current.remaining / finished_per_second))
+    return Progress(
+        cdx_records_per_second=rate("cdx_records"),
+        mementos_per_second=mementos_per_second,
+        failures_per_second=failures_per_second,
+        bytes_per_second=rate("stored_bytes"),
+        eta=eta,
+    )
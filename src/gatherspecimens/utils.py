@@ -1,5 +1,6 @@
 """Utility functions for the gatherspecimens package."""
 
+import base64
 import hashlib
 import json
 import logging
@@ -7,8 +8,11 @@ import re
 import sys
 from datetime import datetime
 from pathlib import Path
+from typing import Any, Dict, List, Optional
 
-from sqlalchemy import Engine, create_engine
+from sqlalchemy import Engine, create_engine, event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.pool import NullPool
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
@@ -21,6 +25,11 @@ def url_hash(url: str) -> str:
     return m.hexdigest()
 
 
+def content_digest(content: bytes) -> str:
+    """Hash content the same way as CDX digests: base32-encoded SHA-1."""
+    return base64.b32encode(hashlib.sha1(content).digest()).decode("ascii")
+
+
 def nospecial(url: str) -> str:
     """Remove special characters from a URL."""
     return re.sub(r"[^a-zA-Z0-9\_\-]+", "_", url)
@@ -58,10 +67,115 @@ def common_logging(name: str, filename: str, level: int = logging.DEBUG):
     logging.getLogger("wayback").setLevel(logging.INFO)
 
 
-def get_engine(config_file: Path, echo: bool = False) -> Engine:
-    """Create an SQLAlchemy engine from a JSON configuration."""
+def load_config(config_file: Path) -> Dict[str, Any]:
+    """Load a JSON configuration file."""
     with open(config_file, "r") as f:
-        creds = json.load(f)
+        return json.load(f)
+
+
+# Pool settings for each way the database is used. `default` keeps SQLAlchemy's
+# defaults; `prefork` suits processes running one task at a time, like celery's
+# prefork pool; `gevent` suits greenlets sharing a few connections, and makes
+# psycopg2 wait for the server through gevent; `null` opens a connection per
+# checkout, for when a pooler like PgBouncer sits in front of the server.
+POOL_PROFILES: Dict[str, Dict[str, Any]] = {
+    "default": {},
+    "prefork": {"pool_size": 1, "max_overflow": 1},
+    "gevent": {"pool_size": 4, "max_overflow": 0, "pool_timeout": 60},
+    "null": {"poolclass": NullPool},
+}
+
+# Pool settings that can be set in the `engine` section of the config file.
+POOL_SETTINGS = ("pool_size", "max_overflow", "pool_timeout", "pool_recycle")
+
+# The SQLite synchronous modes that are safe with WAL.
+SQLITE_SYNCHRONOUS = ("NORMAL", "FULL")
+
+
+def gevent_wait_callback(conn: Any, timeout: Optional[float] = None):
+    """Wait for psycopg2 I/O by yielding to other greenlets, not blocking."""
+    from gevent.socket import wait_read, wait_write
+    from psycopg2 import OperationalError, extensions
+
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            return
+        if state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise OperationalError(f"Bad result from poll: {state}")
+
+
+def pool_options(config: Dict[str, Any]) -> Dict[str, Any]:
+    """Return the `create_engine` pool options for the `engine` config section."""
+    profile = config.get("pool", "default")
+    if profile not in POOL_PROFILES:
+        raise ValueError(f"Unknown pool profile: {profile}")
+    options = dict(POOL_PROFILES[profile])
+    if options.get("poolclass") is not NullPool:
+        options.update({k: config[k] for k in POOL_SETTINGS if k in config})
+    if "pool_pre_ping" in config:
+        options["pool_pre_ping"] = bool(config["pool_pre_ping"])
+    return options
+
+
+def sqlite_engine(config: Dict[str, Any], echo: bool = False) -> Engine:
+    """Create an engine for an SQLite database tuned for a single machine.
+
+    The database is put in WAL mode, so readers don't block the writer, and
+    with `synchronous=NORMAL` commits append to the WAL without waiting for
+    the disk; the WAL is synced and copied into the database in batches at
+    each checkpoint, every `wal_autocheckpoint` pages. SQLite allows one
+    writer at a time, so other writers wait up to `busy_timeout` seconds.
+    """
+    synchronous = str(config.get("synchronous", "NORMAL")).upper()
+    if synchronous not in SQLITE_SYNCHRONOUS:
+        raise ValueError(f"Unsupported SQLite synchronous mode: {synchronous}")
+    wal_autocheckpoint = int(config.get("wal_autocheckpoint", 10000))
+    cache_size = -1024 * int(config.get("cache_size_mb", 64))
+
+    engine = create_engine(
+        f"sqlite:///{config['path']}",
+        echo=echo,
+        connect_args={
+            "timeout": float(config.get("busy_timeout", 30)),
+            # Connections are shared by threads, like asyncgather's executor.
+            "check_same_thread": False,
+        },
+        **pool_options(config),
+    )
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA synchronous={synchronous}")
+        cursor.execute(f"PRAGMA wal_autocheckpoint={wal_autocheckpoint}")
+        cursor.execute(f"PRAGMA cache_size={cache_size}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+    log.debug("SQLite database: %s", config["path"])
+    return engine
+
+
+def get_engine(config_file: Path, echo: bool = False) -> Engine:
+    """Create an SQLAlchemy engine from a JSON configuration.
+
+    The optional `engine` section picks the backend, `postgresql` (the
+    default) or `sqlite`, and the pool profile and settings.
+    """
+    creds = load_config(config_file)
+    config = creds.get("engine") or {}
+    backend = config.get("backend", "postgresql")
+    if backend == "sqlite":
+        return sqlite_engine(config, echo)
+    if backend != "postgresql":
+        raise ValueError(f"Unsupported database backend: {backend}")
+
     connection_string = (
         f"postgresql+psycopg2://{creds['user']}:"
         f"{creds['pass']}@{creds['host']}:{creds['port']}"
@@ -73,6 +187,28 @@ def get_engine(config_file: Path, echo: bool = False) -> Engine:
         f"/{creds['database']}"
     )
 
+    if config.get("pool") == "gevent":
+        from psycopg2 import extensions
+
+        extensions.set_wait_callback(gevent_wait_callback)
+
     log.debug("Connection string: %s", safe_connection_string)
-    engine = create_engine(connection_string, echo=echo)
+    engine = create_engine(connection_string, echo=echo, **pool_options(config))
     return engine
+
+
+def insert_ignoring_conflicts(dialect_name: str, table: Any, index_elements: List[str]):
+    """Build an INSERT statement that skips rows conflicting on the given columns.
+
+    This is `INSERT ... ON CONFLICT (...) DO NOTHING`, which both PostgreSQL and
+    SQLite support, but through dialect-specific constructs.
+    """
+    if dialect_name == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing(
+            index_elements=index_elements
+        )
+    if dialect_name == "sqlite":
+        return sqlite.insert(table).on_conflict_do_nothing(
+            index_elements=index_elements
+        )
+    raise ValueError(f"Unsupported database dialect: {dialect_name}")
@@ -0,0 +1,442 @@
+"""Exports gathered mementos as gzipped WARC files with CDX indexes.
+
+Memento metadata is streamed from the database in batches (through a
+server-side cursor on PostgreSQL), without loading any bodies. Bodies are then
+loaded a chunk at a time, each chunk holding as many mementos as fit in the
+memory budget, so memory use stays about the same however many mementos are
+exported.
+
+Each memento is written as a WARC `resource` record, since the Wayback
+Machine's `id_` playback returns the original body but not the original HTTP
+headers. Every record is compressed as its own gzip member, so it can be read
+on its own from its offset. Files are rotated once they reach the maximum size,
+and each file gets a sorted CDX index alongside it, giving the offset and
+compressed length of every record.
+"""
+
+import argparse
+import gzip
+import logging
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from sqlalchemy import Connection, Engine, Row, func, select
+
+from gatherspecimens import blobstore, compression
+from gatherspecimens.blobstore import blob_key
+from gatherspecimens.schema import (CDX_TIMESTAMP, CdxRecordSpecimen,
+                                    CompressionDictionary, MementoBlob,
+                                    MementoSpecimen)
+from gatherspecimens.utils import common_logging, content_digest, get_engine
+
+log = logging.getLogger(__name__)
+
+WARC_VERSION = "WARC/1.0"
+
+WARC_DATE = "%Y-%m-%dT%H:%M:%SZ"
+
+CDX_HEADER = " CDX N b a m s k r M S V g"
+
+# The namespace for record ids, so exporting a memento again gives it the same id.
+RECORD_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "https://web.archive.org/")
+
+DEFAULT_MAX_SIZE = 1000 * 1024 * 1024
+
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+
+
+@dataclass
+class IndexEntry:
+    """A line of a CDX index, pointing at a record in a WARC file."""
+
+    key: str
+    timestamp: str
+    url: str
+    mime_type: str
+    status_code: Optional[int]
+    digest: str
+    length: int
+    offset: int
+    filename: str
+
+    def line(self) -> str:
+        """Return the entry as a line of a CDX file."""
+        return " ".join(
+            [
+                self.key,
+                self.timestamp,
+                self.url,
+                self.mime_type or "-",
+                str(self.status_code) if self.status_code else "-",
+                self.digest,
+                "-",
+                "-",
+                str(self.length),
+                str(self.offset),
+                self.filename,
+            ]
+        )
+
+
+@dataclass
+class ExportStats:
+    """Counts of what was exported."""
+
+    records: int = 0
+    files: List[Path] = field(default_factory=list)
+    missing: int = 0
+
+
+def body_length():
+    """Return an expression for the uncompressed length of a memento's body."""
+    return func.coalesce(
+        MementoBlob.length, func.length(MementoSpecimen.html_content), 0
+    )
+
+
+def metadata_query(after_id: int = 0, url_prefix: Optional[str] = None):
+    """Select the metadata of mementos to export, in id order, without bodies."""
+    query = (
+        select(
+            MementoSpecimen.id,
+            MementoSpecimen.url,
+            MementoSpecimen.raw_url,
+            MementoSpecimen.mime_type,
+            MementoSpecimen.status_code,
+            MementoSpecimen.time,
+            MementoSpecimen.digest,
+            CdxRecordSpecimen.key,
+            body_length().label("length"),
+        )
+        .outerjoin(CdxRecordSpecimen, CdxRecordSpecimen.id == MementoSpecimen.id)
+        .outerjoin(MementoBlob, MementoBlob.digest == MementoSpecimen.digest)
+        .where(MementoSpecimen.id > after_id)
+        .order_by(MementoSpecimen.id)
+    )
+    if url_prefix:
+        query = query.where(MementoSpecimen.url.startswith(url_prefix))
+    return query
+
+
+def budget_chunks(rows: Sequence[Row], budget: int) -> Iterator[List[Row]]:
+    """Split rows into chunks whose bodies add up to at most `budget` bytes.
+
+    A body larger than the budget gets a chunk of its own.
+    """
+    chunk: List[Row] = []
+    chunk_size = 0
+    for row in rows:
+        if chunk and chunk_size + row.length > budget:
+            yield chunk
+            chunk = []
+            chunk_size = 0
+        chunk.append(row)
+        chunk_size += row.length
+    if chunk:
+        yield chunk
+
+
+class BodyLoader:
+    """Loads and decompresses the bodies of a chunk of mementos at a time."""
+
+    def __init__(self, conn: Connection):
+        """Set up the loader to read from a connection."""
+        self.conn = conn
+        self.dictionaries: Dict[int, bytes] = {}
+
+    def dictionary(self, dictionary_id: Optional[int]) -> Optional[bytes]:
+        """Return a compression dictionary's data, loading it once."""
+        if dictionary_id is None:
+            return None
+        if dictionary_id not in self.dictionaries:
+            self.dictionaries[dictionary_id] = self.conn.execute(
+                select(CompressionDictionary.data).where(
+                    CompressionDictionary.id == dictionary_id
+                )
+            ).scalar_one()
+        return self.dictionaries[dictionary_id]
+
+    def load(self, rows: Sequence[Row]) -> Dict[int, bytes]:
+        """Return the bodies of the given mementos by id.
+
+        Mementos with no stored body are left out.
+        """
+        bodies: Dict[int, bytes] = {}
+        inline = self.conn.execute(
+            select(MementoSpecimen.id, MementoSpecimen.html_content).where(
+                MementoSpecimen.id.in_([row.id for row in rows]),
+                MementoSpecimen.html_content.is_not(None),
+            )
+        )
+        for memento_id, content in inline:
+            bodies[memento_id] = content
+
+        digests = {row.digest for row in rows if row.id not in bodies and row.digest}
+        if not digests:
+            return bodies
+        blobs = {}
+        for digest, content, codec, dictionary_id, backend in self.conn.execute(
+            select(
+                MementoBlob.digest,
+                MementoBlob.content,
+                MementoBlob.codec,
+                MementoBlob.dictionary_id,
+                MementoBlob.backend,
+            ).where(MementoBlob.digest.in_(digests))
+        ):
+            dictionary = self.dictionary(dictionary_id)
+            if backend is None:
+                blobs[digest] = compression.decompress(content, codec, dictionary)
+                continue
+            key = blob_key(digest, codec, dictionary_id)
+            with blobstore.get_store(backend).view(key) as mapped:
+                blobs[digest] = compression.decompress(mapped, codec, dictionary)
+        for row in rows:
+            if row.id not in bodies and row.digest in blobs:
+                bodies[row.id] = blobs[row.digest]
+        return bodies
+
+
+def warc_date(time: datetime) -> str:
+    """Format a time for a WARC header; naive times are taken to be UTC."""
+    if time.tzinfo is not None:
+        time = time.astimezone(timezone.utc)
+    return time.strftime(WARC_DATE)
+
+
+def warc_record(headers: List[Tuple[str, str]], block: bytes) -> bytes:
+    """Build an uncompressed WARC record from its headers and content block."""
+    lines = [WARC_VERSION]
+    lines.extend(f"{name}: {value}" for name, value in headers)
+    lines.append(f"Content-Length: {len(block)}")
+    head = ("\r\n".join(lines) + "\r\n\r\n").encode("utf-8")
+    return head + block + b"\r\n\r\n"
+
+
+def warcinfo_record(filename: str, created: datetime) -> bytes:
+    """Build the `warcinfo` record that starts every WARC file."""
+    info = (
+        "software: gatherspecimens warcexport\r\n"
+        "format: WARC File Format 1.0\r\n"
+        "description: Mementos gathered from the Wayback Machine\r\n"
+    ).encode("utf-8")
+    return warc_record(
+        [
+            ("WARC-Type", "warcinfo"),
+            ("WARC-Date", warc_date(created)),
+            ("WARC-Filename", filename),
+            ("WARC-Record-ID", f"<urn:uuid:{uuid.uuid4()}>"),
+            ("Content-Type", "application/warc-fields"),
+        ],
+        info,
+    )
+
+
+def resource_record(row: Row, body: bytes, digest: str) -> bytes:
+    """Build a `resource` record holding a memento's body."""
+    record_id = uuid.uuid5(RECORD_NAMESPACE, row.raw_url)
+    return warc_record(
+        [
+            ("WARC-Type", "resource"),
+            ("WARC-Record-ID", f"<urn:uuid:{record_id}>"),
+            ("WARC-Date", warc_date(row.time)),
+            ("WARC-Target-URI", row.url),
+            ("WARC-Source-URI", row.raw_url),
+            ("WARC-Block-Digest", f"sha1:{digest}"),
+            ("WARC-Payload-Digest", f"sha1:{digest}"),
+            ("Content-Type", row.mime_type or "application/octet-stream"),
+        ],
+        body,
+    )
+
+
+class WarcWriter:
+    """Writes records to gzipped WARC files, rotating them at a maximum size."""
+
+    def __init__(self, directory: Path, prefix: str, max_size: int = DEFAULT_MAX_SIZE):
+        """Set up the writer; files are only created once records are written."""
+        self.directory = Path(directory)
+        self.prefix = prefix
+        self.max_size = max_size
+        self.created = datetime.now(timezone.utc)
+        self.serial = 0
+        self.file: Optional[BinaryIO] = None
+        self.path: Optional[Path] = None
+        self.offset = 0
+        self.index: List[IndexEntry] = []
+        self.paths: List[Path] = []
+
+    def open(self):
+        """Start the next WARC file."""
+        name = "{}-{}-{:05d}.warc.gz".format(
+            self.prefix, self.created.strftime(CDX_TIMESTAMP), self.serial
+        )
+        self.serial += 1
+        self.path = self.directory / name
+        self.file = open(self.path, "wb")
+        self.offset = 0
+        self.index = []
+        self.paths.append(self.path)
+        self.write_member(warcinfo_record(name, self.created))
+
+    def write_member(self, record: bytes) -> Tuple[int, int]:
+        """Write a record as a gzip member, returning its offset and length."""
+        assert self.file is not None
+        member = gzip.compress(record, mtime=0)
+        offset = self.offset
+        self.file.write(member)
+        self.offset += len(member)
+        return offset, len(member)
+
+    def write(self, row: Row, body: bytes):
+        """Write a memento's body as a record, and index it."""
+        if self.file is None:
+            self.open()
+        assert self.path is not None
+        digest = content_digest(body)
+        offset, length = self.write_member(resource_record(row, body, digest))
+        self.index.append(
+            IndexEntry(
+                key=row.key or row.url,
+                timestamp=row.time.strftime(CDX_TIMESTAMP),
+                url=row.url,
+                mime_type=row.mime_type,
+                status_code=row.status_code,
+                digest=digest,
+                length=length,
+                offset=offset,
+                filename=self.path.name,
+            )
+        )
+        if self.offset >= self.max_size:
+            self.close()
+
+    def close(self):
+        """Finish the current WARC file and write its CDX index."""
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        assert self.path is not None
+        lines = sorted(entry.line() for entry in self.index)
+        cdx_path = self.path.with_name(self.path.name[: -len(".warc.gz")] + ".cdx")
+        cdx_path.write_text("\n".join([CDX_HEADER] + lines) + "\n")
+        log.info("Wrote %d records to %s", len(self.index), self.path)
+        self.index = []
+
+
+def export(
+    engine: Engine,
+    directory: Path,
+    prefix: str = "mementos",
+    url_prefix: Optional[str] = None,
+    after_id: int = 0,
+    max_size: int = DEFAULT_MAX_SIZE,
+    batch_size: int = 1000,
+    memory_budget: int = DEFAULT_MEMORY_BUDGET,
+) -> ExportStats:
+    """Export gathered mementos to WARC files in a directory."""
+    directory.mkdir(parents=True, exist_ok=True)
+    stats = ExportStats()
+    writer = WarcWriter(directory, prefix, max_size)
+    try:
+        with engine.connect() as conn:
+            loader = BodyLoader(conn)
+            result = conn.execute(
+                metadata_query(after_id, url_prefix).execution_options(
+                    yield_per=batch_size
+                )
+            )
+            for rows in result.partitions():
+                for chunk in budget_chunks(rows, memory_budget):
+                    bodies = loader.load(chunk)
+                    for row in chunk:
+                        body = bodies.pop(row.id, None)
+                        if body is None:
+                            log.warning("Memento %d has no stored body", row.id)
+                            stats.missing += 1
+                            continue
+                        writer.write(row, body)
+                        stats.records += 1
+                    log.debug("Exported up to memento %d", chunk[-1].id)
+    finally:
+        writer.close()
+    stats.files = writer.paths
+    return stats
+
+
+def main():
+    """Export gathered mementos as WARC files."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--config",
+        help="Path to the database configuration file",
+        type=Path,
+        default=Path("config.json"),
+    )
+    parser.add_argument(
+        "--output",
+        help="Directory to write the WARC and CDX files to",
+        type=Path,
+        default=Path("warc"),
+    )
+    parser.add_argument(
+        "--name", help="Prefix for the names of the files", default="mementos"
+    )
+    parser.add_argument("--url-prefix", help="Only export mementos of URLs like this")
+    parser.add_argument(
+        "--after-id",
+        help="Only export mementos with ids after this one",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--max-size",
+        help="Size in MB at which to start a new WARC file",
+        type=int,
+        default=DEFAULT_MAX_SIZE // (1024 * 1024),
+    )
+    parser.add_argument(
+        "--batch-size",
+        help="Number of memento rows to fetch from the database at a time",
+        type=int,
+        default=1000,
+    )
+    parser.add_argument(
+        "--memory-budget",
+        help="Size in MB of the bodies to hold in memory at a time",
+        type=int,
+        default=DEFAULT_MEMORY_BUDGET // (1024 * 1024),
+    )
+    args = parser.parse_args()
+
+    blobstore.configure_from_config(args.config)
+    stats = export(
+        get_engine(args.config),
+        args.output,
+        prefix=args.name,
+        url_prefix=args.url_prefix,
+        after_id=args.after_id,
+        max_size=args.max_size * 1024 * 1024,
+        batch_size=args.batch_size,
+        memory_budget=args.memory_budget * 1024 * 1024,
+    )
+    log.info(
+        "Exported %d mementos to %d files (%d without bodies)",
+        stats.records,
+        len(stats.files),
+        stats.missing,
+    )
+
+
+def run():
+    """Run the main function with common logging."""
+    common_logging(__name__, __file__)
+    main()
+
+
+if __name__ == "__main__":
+    run()
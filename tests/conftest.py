@@ -1,49 +1,147 @@
 """Common fixtures for tests."""
 
 import logging
+import math
 from pathlib import Path
+from typing import Any, Callable, Dict, List, Sequence
 
 import pytest
 import yaml
 from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
+from wayback import CdxRecord
 
 from gatherspecimens.schema import Base, CdxRecordSpecimen, MementoSpecimen
 
 log = logging.getLogger(__name__)
 
 
+def load_test_data() -> List[Dict[str, Any]]:
+    """Load all the test data files in the test_data directory."""
+    tests = Path(__file__).parent
+    test_data = tests / "test_data"
+
+    loaded = []
+    for test_file in sorted(test_data.glob("*.yml")):
+        with open(test_file) as f:
+            loaded.append(yaml.safe_load(f))
+    return loaded
+
+
+@pytest.fixture
+def test_cdx_records() -> List[CdxRecord]:
+    """Return the CDX records from the test data files."""
+    return [
+        CdxRecordSpecimen.from_serializable(data["cdx"]).to_cdx_record()
+        for data in load_test_data()
+        if "cdx" in data
+    ]
+
+
+@pytest.fixture
+def test_engine():
+    """Create an empty test database with SQLite and yield its engine."""
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+def add_test_rows(db_session: Session):
+    """Add the CDX and memento rows from the test data files."""
+    for test_data in load_test_data():
+        cdx_data = test_data.get("cdx")
+        if cdx_data:
+            cdx_row = CdxRecordSpecimen.from_serializable(cdx_data)
+            db_session.add(cdx_row)
+            log.debug("Added %s", cdx_row)
+
+        memento_data = test_data.get("memento")
+        if memento_data:
+            memento_row = MementoSpecimen.from_serializable(memento_data)
+            db_session.add(memento_row)
+            log.debug("Added %s", memento_row)
+
+    db_session.commit()
+
+
+@pytest.fixture
+def test_data_engine(test_engine):
+    """Create a test database with SQLite holding the test rows."""
+    with Session(test_engine) as db_session:
+        add_test_rows(db_session)
+    yield test_engine
+
+
 @pytest.fixture(scope="module")
 def test_db_session():
     """Create a test database with SQLite and yield it."""
     engine = create_engine("sqlite:///:memory:")
     Base.metadata.create_all(engine)
 
-    # Find all the test data files in the test_data directory.
-    tests = Path(__file__).parent
-    test_data = tests / "test_data"
-    test_files = test_data.glob("*.yml")
-
     with Session(engine) as db_session:
         # Create test rows
-        for test_file in test_files:
-            with open(test_file) as f:
-                test_data = yaml.safe_load(f)
-
-            cdx_data = test_data.get("cdx")
-            if cdx_data:
-                cdx_row = CdxRecordSpecimen.from_serializable(cdx_data)
-                db_session.add(cdx_row)
-                log.debug("Added %s", cdx_row)
-
-            memento_data = test_data.get("memento")
-            if memento_data:
-                memento_row = MementoSpecimen.from_serializable(memento_data)
-                db_session.add(memento_row)
-                log.debug("Added %s", memento_row)
-
-        db_session.commit()
+        add_test_rows(db_session)
 
         log.debug("Yielding session")
         yield db_session
         log.debug("Finished yielding")
+
+
+# Lines of benchmark results, reported at the end of the test run.
+benchmark_results: List[str] = []
+
+
+def pytest_addoption(parser):
+    """Add options for running the benchmarks."""
+    parser.addoption(
+        "--benchmark", action="store_true", help="Run the benchmarks, which are slow"
+    )
+    parser.addoption(
+        "--benchmark-copies",
+        type=int,
+        default=20,
+        help="Number of copies of the test data in the fake archive (default: 20)",
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    """Skip benchmarks unless they were asked for."""
+    if config.getoption("--benchmark"):
+        return
+    skip = pytest.mark.skip(reason="benchmarks only run with --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
+def pytest_terminal_summary(terminalreporter):
+    """Report the benchmark results."""
+    if benchmark_results:
+        terminalreporter.section("benchmarks")
+        for line in benchmark_results:
+            terminalreporter.write_line(line)
+
+
+def percentile(values: Sequence[float], percent: float) -> float:
+    """Return a percentile of some values, by the nearest rank method."""
+    if not values:
+        return math.nan
+    ordered = sorted(values)
+    rank = max(1, math.ceil(percent / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+@pytest.fixture
+def report_benchmark(request) -> Callable[[int, float, Sequence[float]], None]:
+    """Return a function that reports a benchmark's throughput and latency."""
+
+    def report(records: int, seconds: float, latencies: Sequence[float]):
+        benchmark_results.append(
+            f"{request.node.name}: {records} records in {seconds:.2f}s "
+            f"({records / seconds:.1f} records/s), "
+            f"latency p50 {percentile(latencies, 50) * 1000:.1f}ms "
+            f"p99 {percentile(latencies, 99) * 1000:.1f}ms"
+        )
+
+    return report
@@ -0,0 +1,319 @@
+"""A local stand-in for the Wayback Machine's CDX and memento APIs.
+
+The server answers CDX searches, with their filters and collapsing, and
+memento requests from the YAML test data, optionally copied many times over to
+make a larger archive. It can add
+latency to every response, throttle requests with 429s, and fail a fraction of
+them with 503s, to see how the gathering code copes.
+
+Requests are sent to it by mounting a `FakeWaybackAdapter` on a session, which
+rewrites `https://web.archive.org` to the server's address while leaving the
+URLs seen by the `wayback` library unchanged.
+"""
+
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from gatherspecimens.schema import CdxRecordSpecimen, MementoSpecimen
+
+WAYBACK_URL = "https://web.archive.org"
+
+MEMENTO_PATH = re.compile(r"^/web/(\d{14})(\w\w_)?/(.+)$")
+
+CDX_TIMESTAMP = "%Y%m%d%H%M%S"
+
+# The position of each field in a line of CDX search output.
+CDX_FIELDS = {
+    name: index
+    for index, name in enumerate(
+        [
+            "urlkey",
+            "timestamp",
+            "original",
+            "mimetype",
+            "statuscode",
+            "digest",
+            "length",
+        ]
+    )
+}
+
+
+@dataclass
+class Faults:
+    """Faults added to the server's responses."""
+
+    # Seconds added to every response, plus up to `jitter` more at random.
+    latency: float = 0.0
+    jitter: float = 0.0
+    # Requests per second allowed before answering with 429s (0: unlimited).
+    rate_limit: float = 0.0
+    # The fraction of requests answered with 503s.
+    error_rate: float = 0.0
+    seed: int = 0
+
+
+@dataclass
+class Capture:
+    """A capture in the fake archive."""
+
+    record: CdxRecordSpecimen
+    body: bytes
+
+    @property
+    def timestamp(self) -> str:
+        """Return the capture's CDX timestamp."""
+        return self.record.timestamp.strftime(CDX_TIMESTAMP)
+
+    def field(self, index: int) -> str:
+        """Return a field of the capture's CDX line."""
+        return self.cdx_line().split(" ")[index]
+
+    def matches(self, cdx_filter: str) -> bool:
+        """Check whether the capture passes a CDX `[!]field:regex` filter."""
+        name, _, pattern = cdx_filter.lstrip("!").partition(":")
+        matched = re.fullmatch(pattern, self.field(CDX_FIELDS[name])) is not None
+        return matched != cdx_filter.startswith("!")
+
+    def cdx_line(self) -> str:
+        """Return the capture as a line of CDX search output."""
+        record = self.record
+        return " ".join(
+            [
+                record.key,
+                self.timestamp,
+                record.url,
+                record.mime_type,
+                str(record.status_code) if record.status_code else "-",
+                record.digest,
+                str(record.length) if record.length else "-",
+            ]
+        )
+
+
+def copy_record(record: CdxRecordSpecimen, copy: int) -> CdxRecordSpecimen:
+    """Make a distinct copy of a record, with its own URL, time and digest."""
+    if copy == 0:
+        return record
+    separator = "&" if "?" in record.url else "?"
+    url = f"{record.url}{separator}copy={copy}"
+    timestamp = record.timestamp + timedelta(seconds=copy)
+    ts = timestamp.strftime(CDX_TIMESTAMP)
+    return CdxRecordSpecimen(
+        id=None,
+        key=f"{record.key}?copy={copy}",
+        timestamp=timestamp,
+        url=url,
+        mime_type=record.mime_type,
+        status_code=record.status_code,
+        digest=f"{record.digest[:-6]}{copy:06d}",
+        length=record.length,
+        raw_url=f"{WAYBACK_URL}/web/{ts}id_/{url}",
+        view_url=f"{WAYBACK_URL}/web/{ts}/{url}",
+    )
+
+
+def load_captures(test_data: List[Dict[str, Any]], copies: int = 1) -> List[Capture]:
+    """Build the archive's captures from test data, copied `copies` times."""
+    captures = []
+    for data in test_data:
+        if "cdx" not in data:
+            continue
+        record = CdxRecordSpecimen.from_serializable(data["cdx"])
+        body = b"<html><body>Fake page</body></html>"
+        if data.get("memento"):
+            memento = MementoSpecimen.from_serializable(data["memento"])
+            body = memento.html_content or body
+        for copy in range(copies):
+            captures.append(Capture(copy_record(record, copy), body))
+    captures.sort(key=lambda capture: (capture.record.key, capture.timestamp))
+    return captures
+
+
+def url_prefix(url: str) -> str:
+    """Normalize a URL for prefix matching, ignoring its scheme and `www.`."""
+    url = re.sub(r"^[a-z]+://", "", url)
+    return re.sub(r"^www\d?\.", "", url)
+
+
+class FakeWaybackServer(ThreadingHTTPServer):
+    """HTTP server holding the fake archive and its faults."""
+
+    daemon_threads = True
+
+    def __init__(self, captures: List[Capture], faults: Optional[Faults] = None):
+        """Start serving the captures on a free local port."""
+        super().__init__(("127.0.0.1", 0), FakeWaybackHandler)
+        self.captures = captures
+        self.mementos = {
+            (capture.timestamp, capture.record.url): capture for capture in captures
+        }
+        self.faults = faults or Faults()
+        self.random = random.Random(self.faults.seed)
+        self.lock = threading.Lock()
+        self.next_allowed = 0.0
+        self.statuses: Dict[int, int] = {}
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self) -> str:
+        """Return the server's base URL."""
+        host, port = self.server_address[:2]
+        if isinstance(host, bytes):
+            host = host.decode("ascii")
+        return f"http://{host}:{port}"
+
+    def close(self):
+        """Stop the server."""
+        self.shutdown()
+        self.server_close()
+
+    def fault_status(self) -> Tuple[Optional[int], float]:
+        """Decide whether to fail a request, and how long to delay it."""
+        with self.lock:
+            delay = self.faults.latency + self.random.random() * self.faults.jitter
+            if self.faults.rate_limit > 0:
+                now = time.monotonic()
+                if now < self.next_allowed:
+                    return 429, delay
+                self.next_allowed = now + 1 / self.faults.rate_limit
+            if self.random.random() < self.faults.error_rate:
+                return 503, delay
+        return None, delay
+
+    def count_status(self, status: int):
+        """Count a response status."""
+        with self.lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def search(self, query: Dict[str, str], filters: Sequence[str] = ()) -> str:
+        """Answer a CDX search, a page of `limit` results at a time."""
+        prefix = url_prefix(query["url"])
+        exact = query.get("matchType", "exact") == "exact"
+        from_ts = query.get("from", "").ljust(14, "0")
+        to_ts = query.get("to", "").ljust(14, "9")
+        matches = [
+            capture
+            for capture in self.captures
+            if (
+                url_prefix(capture.record.url) == prefix
+                if exact
+                else url_prefix(capture.record.url).startswith(prefix)
+            )
+            and from_ts <= capture.timestamp <= to_ts
+            and all(capture.matches(cdx_filter) for cdx_filter in filters)
+        ]
+        if query.get("collapse"):
+            field = CDX_FIELDS[query["collapse"]]
+            matches = [
+                capture
+                for index, capture in enumerate(matches)
+                if index == 0 or capture.field(field) != matches[index - 1].field(field)
+            ]
+
+        offset = int(query.get("resumeKey") or 0)
+        limit = int(query.get("limit") or len(matches) or 1)
+        page = matches[offset : offset + limit]
+        lines = [capture.cdx_line() for capture in page]
+        if offset + limit < len(matches) and query.get("showResumeKey") == "true":
+            lines += ["", str(offset + limit)]
+        return "\n".join(lines) + "\n" if lines else ""
+
+
+class FakeWaybackHandler(BaseHTTPRequestHandler):
+    """Request handler for the fake Wayback Machine."""
+
+    server: FakeWaybackServer
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        """Answer a CDX search or memento request."""
+        status, delay = self.server.fault_status()
+        if delay:
+            time.sleep(delay)
+        if status is not None:
+            self.respond(status, b"Fake error")
+            return
+
+        parts = urlsplit(self.path)
+        if parts.path == "/cdx/search/cdx":
+            params = parse_qs(parts.query)
+            query = {key: values[-1] for key, values in params.items()}
+            filters = params.get("filter", [])
+            self.respond(200, self.server.search(query, filters).encode())
+            return
+
+        match = MEMENTO_PATH.match(self.path)
+        capture = match and self.server.mementos.get((match.group(1), match.group(3)))
+        if not capture:
+            self.respond(404, b"Not in archive")
+            return
+
+        # Every capture is played back as a 200, whatever its recorded status.
+        time_str = capture.record.timestamp.strftime("%a, %d %b %Y %H:%M:%S GMT")
+        self.respond(
+            200,
+            capture.body,
+            {
+                "Content-Type": capture.record.mime_type,
+                "Memento-Datetime": time_str,
+                "Link": f'<{capture.record.url}>; rel="original"',
+            },
+        )
+
+    def respond(self, status: int, body: bytes, headers: Optional[dict] = None):
+        """Send a complete response."""
+        self.server.count_status(status)
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Don't log requests."""
+
+
+class FakeWaybackAdapter(HTTPAdapter):
+    """Sends Wayback requests to a fake server, timing each one."""
+
+    def __init__(self, server_url: str, **kwargs):
+        """Set up the adapter to send requests to the server at `server_url`."""
+        super().__init__(**kwargs)
+        self.server_url = server_url
+        self.latencies: List[float] = []
+
+    def send(self, request: requests.PreparedRequest, *args, **kwargs):
+        """Send the request to the fake server, as if it were the real one."""
+        original_url = request.url or ""
+        redirected = request.copy()
+        redirected.url = self.server_url + original_url[len(WAYBACK_URL) :]
+
+        start_time = time.perf_counter()
+        response = super().send(redirected, *args, **kwargs)
+        self.latencies.append(time.perf_counter() - start_time)
+
+        response.url = original_url
+        response.request = request
+        return response
+
+
+def mount_fake_wayback(
+    session: requests.Session, server: FakeWaybackServer
+) -> FakeWaybackAdapter:
+    """Send a session's Wayback requests to a fake server."""
+    adapter = FakeWaybackAdapter(server.url)
+    session.mount(WAYBACK_URL, adapter)
+    return adapter
@@ -0,0 +1,107 @@
+"""Tests for extracting articles from stored mementos."""
+
+from datetime import date
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from gatherspecimens.articles import (CONTENTFUL, DRUPAL, DRUPAL2, ERROR,
+                                      GENERIC, MAGAZINE, MTGCOM,
+                                      extract_article, extract_articles,
+                                      parse_date, parse_html)
+from gatherspecimens.extractarticles import extract
+from gatherspecimens.schema import Article, MementoSpecimen
+
+
+def test_parse_html():
+    """Unclosed tags are closed, and scripts are left out of the text."""
+    document = parse_html(
+        "<div class='a b'><p>One<br>two<p>Three <b>bold</div>"
+        "<script>var x = '<p>';</script><p>Four"
+    )
+    assert document.find(cls="b").text() == "One\ntwo\nThree bold"
+    assert document.text() == "One\ntwo\nThree bold\nFour"
+
+
+def test_parse_date():
+    """Dates are found in the formats each era uses."""
+    assert parse_date("Tuesday, January 1, 2002") == date(2002, 1, 1)
+    assert parse_date("Posted in Feature on January 20, 2017") == date(2017, 1, 20)
+    assert parse_date("Aug 14, 2008") == date(2008, 8, 14)
+    assert parse_date("Round 10 Results") is None
+
+
+def test_extract_article(test_data_engine):
+    """Each era's pages are recognised, and their parts extracted."""
+    with Session(test_data_engine) as db_session:
+        mementos = {m.id: m for m in db_session.query(MementoSpecimen)}
+
+    def extracted(memento_id):
+        memento = mementos[memento_id]
+        return extract_article(memento.url, memento.content)
+
+    article = extracted(1916786)
+    assert article.era == MTGCOM
+    assert article.title == "On Your Mark... Get Set... Radiate!"
+    assert article.author == "Anthony Alongi"
+    assert article.published == date(2002, 1, 1)
+    assert article.text.startswith("Fork was never this crazy\nSo Mark Rosewater")
+
+    # The first letter is an image.
+    assert extracted(1260275).text.startswith("So what were you doing")
+
+    article = extracted(334750)
+    assert (article.era, article.title) == (MAGAZINE, "The 2012 Holiday Card")
+    assert (article.author, article.published) == ("Monty Ashley", date(2012, 12, 13))
+
+    article = extracted(1175908)
+    assert (article.era, article.title) == (DRUPAL, "I Would Like to Parley")
+    assert (article.author, article.published) == ("Bruce Richard", date(2014, 6, 17))
+
+    article = extracted(717857)
+    assert (article.era, article.title) == (DRUPAL2, "Aiming at Modern")
+    assert (article.author, article.published) == ("Sam Stoddard", date(2017, 1, 20))
+
+    article = extracted(224855)
+    assert (article.era, article.title) == (
+        CONTENTFUL,
+        "Odds and Ends: Kaladesh, Part 3",
+    )
+    assert (article.author, article.published) == (
+        "Mark Rosewater",
+        date(2016, 10, 31),
+    )
+    assert article.text.startswith("Three weeks ago")
+
+
+def test_extract_articles_error():
+    """A page the parser fails on is marked as an error, not raised."""
+    url = "https://example.com/"
+    (broken, broken_article), (fine, fine_article) = extract_articles(
+        [(1, url, b"<html><![foo ]><p>Text"), (2, url, b"<p>Text")]
+    )
+    assert (broken, broken_article.era, broken_article.text) == (1, ERROR, "")
+    assert (fine, fine_article.era, fine_article.text) == (2, GENERIC, "Text")
+
+
+def test_extract(test_data_engine):
+    """Every HTML memento gets an article, and later runs only do new ones."""
+    with Session(test_data_engine) as db_session:
+        html_count = db_session.scalar(
+            select(func.count())
+            .select_from(MementoSpecimen)
+            .where(MementoSpecimen.mime_type.like("text/html%"))
+        )
+
+    assert extract(test_data_engine, batch_size=4, workers=2) == html_count
+    assert extract(test_data_engine, batch_size=4, workers=2) == 0
+
+    with Session(test_data_engine) as db_session:
+        article = db_session.get(Article, 1175908)
+        assert article.title == "I Would Like to Parley"
+        assert "Conspiracy" in article.text
+
+        # Extraction picks up mementos it hasn't seen, like re-gathered ones.
+        db_session.delete(article)
+        db_session.commit()
+    assert extract(test_data_engine, batch_size=4, workers=2) == 1
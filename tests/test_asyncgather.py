@@ -0,0 +1,187 @@
+"""Tests for the asyncio gathering pipeline."""
+
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from gatherspecimens import failures
+from gatherspecimens.schema import (CdxRecordSpecimen, MementoFailure,
+                                    MementoSpecimen, create_schema)
+from gatherspecimens.utils import content_digest, url_hash
+
+pytest.importorskip("aiohttp")
+
+from aiohttp import web  # noqa: E402
+
+from gatherspecimens import asyncgather  # noqa: E402
+from gatherspecimens.asyncgather import PipelineSettings, gather  # noqa: E402
+
+MEMENTO_HEADERS = {"Memento-Datetime": "Mon, 01 Jan 2024 00:00:00 GMT"}
+
+
+async def memento(request: web.Request) -> web.Response:
+    """Serve mementos, redirects and playback errors by page name."""
+    page = request.match_info["page"]
+    if page == "redirect":
+        return web.Response(
+            status=302, headers={**MEMENTO_HEADERS, "Location": "/web/2024id_/page1"}
+        )
+    if page == "missing":
+        return web.Response(status=404)
+    if page == "unavailable":
+        return web.Response(status=503)
+    return web.Response(body=f"<html>{page}</html>".encode(), headers=MEMENTO_HEADERS)
+
+
+def add_record(
+    db_session: Session,
+    record_id: int,
+    base_url: str,
+    page: str,
+    digest,
+    status_code: int = 200,
+):
+    """Add a CDX record whose memento is served by the test server."""
+    raw_url = f"{base_url}/web/2024id_/{page}"
+    db_session.add(
+        CdxRecordSpecimen(
+            id=record_id,
+            hash_raw_url=url_hash(raw_url),
+            key=page,
+            timestamp=datetime(2024, 1, 1, tzinfo=timezone.utc),
+            url=f"http://example.com/{page}",
+            mime_type="text/html",
+            status_code=status_code,
+            digest=digest,
+            length=None,
+            raw_url=raw_url,
+            view_url=raw_url,
+        )
+    )
+
+
+def test_gather_pipeline(tmp_path):
+    """The pipeline stores mementos, duplicates and failures."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    create_schema(engine)
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get("/web/2024id_/{page}", memento)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        base_url = f"http://127.0.0.1:{port}"
+
+        with Session(engine) as db_session:
+            add_record(db_session, 1, base_url, "page1", "DIGEST1")
+            add_record(db_session, 2, base_url, "page1-again", "DIGEST1")
+            # Redirects share the digest of their (often empty) body, which
+            # isn't what is fetched for them.
+            add_record(db_session, 3, base_url, "redirect", "DIGEST3", 302)
+            add_record(db_session, 6, base_url, "page6", "DIGEST3")
+            add_record(db_session, 4, base_url, "missing", "DIGEST4")
+            add_record(db_session, 5, base_url, "unavailable", "DIGEST5")
+            db_session.commit()
+
+        try:
+            settings = PipelineSettings(
+                concurrency=4, batch_size=2, calls_per_second=0, retries=0
+            )
+            return await gather(engine, settings)
+        finally:
+            await runner.cleanup()
+
+    stats = asyncio.run(scenario())
+    assert stats.results == {
+        "gathered": 3,
+        "deduplicated": 1,
+        "memento playback error": 1,
+        "exception": 1,
+    }
+
+    with Session(engine) as db_session:
+        assert db_session.get(MementoSpecimen, 2).content == b"<html>page1</html>"
+        redirect = db_session.get(MementoSpecimen, 3)
+        assert redirect.content == b"<html>page1</html>"
+        assert redirect.digest == content_digest(b"<html>page1</html>")
+        assert db_session.get(MementoSpecimen, 6).content == b"<html>page6</html>"
+        # A missing memento is given up on, but the Wayback Machine's own
+        # errors are retried later.
+        missing = db_session.get(MementoFailure, 4)
+        assert missing.reason == failures.PLAYBACK
+        assert missing.next_attempt is None
+        unavailable = db_session.get(MementoFailure, 5)
+        assert unavailable.reason == failures.SERVER_ERROR
+        assert unavailable.next_attempt is not None
+
+
+def test_failed_batch_stores_nothing(tmp_path, monkeypatch):
+    """A batch that fails to be stored is rolled back, with every record an error."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    create_schema(engine)
+    with Session(engine) as db_session:
+        for record_id in range(1, 4):
+            add_record(
+                db_session,
+                record_id,
+                "http://127.0.0.1:9",
+                f"page{record_id}",
+                "DIGEST",
+            )
+        db_session.commit()
+        records = db_session.query(CdxRecordSpecimen).order_by("id").all()
+        db_session.expunge_all()
+
+    stored_group_results = asyncgather.stored_group_results
+
+    def fail_on_last(db_session, group, *args):
+        if group[0].id == 3:
+            raise RuntimeError("boom")
+        return stored_group_results(db_session, group, *args)
+
+    monkeypatch.setattr(asyncgather, "stored_group_results", fail_on_last)
+    outcomes = [
+        asyncgather.FetchOutcome([r], error=ValueError("failed")) for r in records
+    ]
+    results = asyncgather.write_batch(engine, outcomes, {})
+
+    assert results == {
+        1: "error while storing",
+        2: "error while storing",
+        3: "error while storing",
+    }
+    with Session(engine) as db_session:
+        assert db_session.query(MementoFailure).count() == 0
+
+
+def test_writer_crash_stops_pipeline(tmp_path, monkeypatch):
+    """The pipeline fails instead of waiting forever if its writer crashes."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    create_schema(engine)
+    with Session(engine) as db_session:
+        # Nothing listens on the discard port, so every fetch fails quickly.
+        for record_id in range(1, 21):
+            add_record(
+                db_session,
+                record_id,
+                "http://127.0.0.1:9",
+                f"page{record_id}",
+                f"DIGEST{record_id}",
+            )
+        db_session.commit()
+
+    def crash(*args):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(asyncgather, "write_batch", crash)
+    settings = PipelineSettings(
+        concurrency=1, batch_size=1, calls_per_second=0, retries=0
+    )
+    with pytest.raises(RuntimeError):
+        asyncio.run(asyncio.wait_for(gather(engine, settings), 10))
@@ -0,0 +1,114 @@
+"""Tests for keeping memento bodies in a filesystem blob store."""
+
+from datetime import timedelta
+
+import pytest
+from sqlalchemy.orm import Session
+
+from gatherspecimens import blobstore, compression
+from gatherspecimens.blobstore import FileSystemStore
+from gatherspecimens.compressbodies import (collect_garbage,
+                                            move_inline_content, offload_blobs)
+from gatherspecimens.schema import MementoBlob, MementoSpecimen
+
+
+@pytest.fixture
+def store(tmp_path):
+    """Write new content to a filesystem store for the duration of a test."""
+    store = FileSystemStore(tmp_path / "blobs")
+    blobstore.configure(store)
+    yield store
+    blobstore.configure(None)
+
+
+def test_sharded_paths(tmp_path):
+    """Files are sharded by the first characters of their key."""
+    store = FileSystemStore(tmp_path)
+    assert store.path("ABCDEFG.zlib") == tmp_path / "AB" / "CD" / "ABCDEFG.zlib"
+
+    store.put("ABCDEFG.zlib", b"content")
+    with store.view("ABCDEFG.zlib") as mapped:
+        assert bytes(mapped) == b"content"
+    store.put("EMPTY.identity", b"")
+    with store.view("EMPTY.identity") as mapped:
+        assert bytes(mapped) == b""
+
+    store.delete("ABCDEFG.zlib")
+    store.delete("ABCDEFG.zlib")
+    assert not store.path("ABCDEFG.zlib").exists()
+
+
+def test_store_in_filesystem(test_engine, store):
+    """Stored content goes to the blob store, with only a reference in the row."""
+    content = b"<html>" + b"page " * 100 + b"</html>"
+    with Session(test_engine) as db_session:
+        MementoBlob.store(db_session, "DIGEST", content, compression.ZLIB)
+        db_session.commit()
+
+    with Session(test_engine) as db_session:
+        blob = db_session.get(MementoBlob, "DIGEST")
+        assert blob.content is None
+        assert blob.backend == blobstore.FILESYSTEM
+        assert store.path(blob.key).exists()
+        assert blob.data == content
+
+
+def test_unused_files_deleted(test_engine, store):
+    """Files are deleted if their row isn't stored, or later if it isn't committed."""
+    content = b"<html>" + b"page " * 100 + b"</html>"
+    with Session(test_engine) as db_session:
+        MementoBlob.store(db_session, "DIGEST", content, compression.ZLIB)
+        db_session.commit()
+        # Storing the digest again keeps the existing row and its file.
+        MementoBlob.store(db_session, "DIGEST", content, compression.IDENTITY)
+        MementoBlob.store(db_session, "DIGEST", content, compression.ZLIB)
+        db_session.commit()
+
+        MementoBlob.store(db_session, "ROLLED_BACK", content, compression.ZLIB)
+        db_session.rollback()
+        MementoBlob.store(db_session, "UNCOMMITTED", content, compression.ZLIB)
+
+    assert store.path("DIGEST.zlib").exists()
+    assert not store.path("DIGEST.identity").exists()
+    # Another transaction may be storing the same content, so these stay for now.
+    assert store.path("ROLLED_BACK.zlib").exists()
+    assert store.path("UNCOMMITTED.zlib").exists()
+    store.path("TEMPORARY.zlib").parent.mkdir(parents=True)
+    store.path("TEMPORARY.zlib").with_name(".TEMPORARY.zlib.0.tmp").write_bytes(b"")
+
+    assert collect_garbage(test_engine, 1) == 0
+    assert collect_garbage(test_engine, 1, timedelta(0)) == 3
+    assert store.path("DIGEST.zlib").exists()
+    assert [path.name for path in store.files()] == ["DIGEST.zlib"]
+    with Session(test_engine) as db_session:
+        assert db_session.get_one(MementoBlob, "DIGEST").data == content
+
+
+def test_offload_and_restore(test_data_engine, store):
+    """Bodies move into the blob store and back, keeping their content."""
+    with Session(test_data_engine) as db_session:
+        originals = {m.id: m.content for m in db_session.query(MementoSpecimen)}
+
+    # Blobs written to the table before the store was configured.
+    blobstore.configure(None)
+    move_inline_content(test_data_engine, 5, compression.ZLIB, {})
+    blobstore.configure(store)
+
+    assert offload_blobs(test_data_engine, 5) > 0
+    with Session(test_data_engine) as db_session:
+        assert (
+            db_session.query(MementoBlob)
+            .filter(MementoBlob.content.is_not(None))
+            .count()
+            == 0
+        )
+        for memento in db_session.query(MementoSpecimen):
+            assert memento.content == originals[memento.id]
+
+    blobstore.configure(None)
+    assert offload_blobs(test_data_engine, 5) > 0
+    assert not any(path.is_file() for path in store.root.rglob("*"))
+    with Session(test_data_engine) as db_session:
+        for memento in db_session.query(MementoSpecimen):
+            assert memento.blob.backend is None
+            assert memento.content == originals[memento.id]
@@ -0,0 +1,168 @@
+"""Tests for CDX record ingestion."""
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import wayback
+from conftest import load_test_data
+from fakewayback import FakeWaybackServer, load_captures, mount_fake_wayback
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from gatherspecimens import cdxrecords
+from gatherspecimens.cdxfilters import CdxFilter
+from gatherspecimens.cdxrecords import (CrawlJob, CrawlSettings,
+                                        ResumableWaybackSession, as_utc,
+                                        load_watermark, plan_incremental_jobs,
+                                        process_job, process_results,
+                                        save_checkpoint, search, time_windows)
+from gatherspecimens.metrics import CDX_RECORDS
+from gatherspecimens.planner import CrawlTarget
+from gatherspecimens.schema import CdxRecordSpecimen
+
+
+def test_process_results_batches(test_engine, test_cdx_records):
+    """Records are inserted in batches, skipping duplicates and stored rows."""
+    records = test_cdx_records
+
+    # Duplicate a few records so that they appear in the same batch.
+    ingest = process_results(iter(records + records[:3]), test_engine, batch_size=4)
+    assert ingest.inserted == len(records)
+    assert ingest.skipped == 3
+
+    with Session(test_engine) as db_session:
+        count = db_session.scalar(select(func.count(CdxRecordSpecimen.id)))
+    assert count == len(records)
+
+    # A second pass should not insert anything.
+    ingest = process_results(iter(records), test_engine, batch_size=4)
+    assert ingest.inserted == 0
+    assert ingest.skipped == len(records)
+
+
+def test_time_windows():
+    """Time windows cover every year without overlapping."""
+    now = datetime(2024, 6, 1, tzinfo=timezone.utc)
+    windows = time_windows(10, now=now)
+
+    assert windows[0][0] == datetime(1996, 1, 1, tzinfo=timezone.utc)
+    assert windows[-1][1] is None
+    for (_, to_date), (from_date, _) in zip(windows, windows[1:]):
+        assert to_date is not None and from_date is not None
+        assert from_date - to_date == timedelta(seconds=1)
+
+    assert time_windows(0) == [(None, None)]
+
+
+def test_resumable_session(monkeypatch):
+    """The session injects a saved resume key and tracks new ones."""
+    sent = []
+    monkeypatch.setattr(
+        wayback.WaybackSession,
+        "request",
+        lambda self, method, url, **kwargs: sent.append(kwargs["params"]),
+    )
+    search_url = "https://web.archive.org/cdx/search/cdx"
+
+    session = ResumableWaybackSession(resume_key="first")
+    session.request("GET", search_url, params={"url": "example.com"})
+    assert sent[-1]["resumeKey"] == "first"
+
+    session.request(
+        "GET", search_url, params={"url": "example.com", "resumeKey": "next"}
+    )
+    assert session.resume_key == "next"
+
+
+def test_completed_checkpoint_skips_job(test_engine):
+    """A job whose checkpoint is complete is not crawled again."""
+    job = CrawlJob("example.com", datetime(2000, 1, 1, tzinfo=timezone.utc))
+    with Session(test_engine) as db_session:
+        save_checkpoint(db_session, job, "key", completed=True)
+        db_session.commit()
+
+    ingest = process_job(job, test_engine, CrawlSettings())
+    assert ingest.inserted == 0 and ingest.skipped == 0
+
+
+def test_cdx_filter(test_cdx_records):
+    """Filters are sent as CDX API filters, and applied to results locally."""
+    cdx_filter = CdxFilter.from_config(
+        {"url": "wizards.com", "status": "2XX", "mime_types": ["text/html"]}
+    )
+    assert cdx_filter.filter_fields() == ["statuscode:2..", "mimetype:text/html"]
+    kept = list(cdx_filter.apply(iter(test_cdx_records)))
+    assert kept
+    assert all(r.status_code == 200 and r.mime_type == "text/html" for r in kept)
+    assert len(kept) < len(test_cdx_records)
+
+    # Consecutive records with the same digest are collapsed into the first.
+    collapse = CdxFilter(collapse="digest")
+    records = [test_cdx_records[0], test_cdx_records[0], test_cdx_records[1]]
+    assert list(collapse.apply(iter(records))) == [records[0], records[2]]
+
+    with pytest.raises(ValueError):
+        CdxFilter(status=("2",))
+
+
+def test_search_filters_on_server(test_cdx_records):
+    """The server leaves out filtered captures, so none are dropped locally."""
+    server = FakeWaybackServer(load_captures(load_test_data()))
+    try:
+        session = wayback.WaybackSession(search_calls_per_second=0)
+        mount_fake_wayback(session, server)
+        client = wayback.WaybackClient(session=session)
+        cdx_filter = CdxFilter(status=("2xx",), collapse="urlkey")
+        job = CrawlJob("www.wizards.com", cdx_filter=cdx_filter)
+
+        filtered_before = CDX_RECORDS.values.get(("filtered",), 0)
+        records = list(search(client, job, limit=5))
+        assert CDX_RECORDS.values.get(("filtered",), 0) == filtered_before
+
+        unfiltered = client.search("www.wizards.com", match_type="prefix")
+        assert records == list(cdx_filter.apply(unfiltered))
+        assert len({record.key for record in records}) == len(records)
+    finally:
+        server.close()
+
+
+def test_incremental_crawl(test_engine, monkeypatch):
+    """Incremental crawls only search after the watermark, then advance it."""
+    captures = load_captures(load_test_data())
+    captures = [c for c in captures if c.record.url.startswith("https://magic.")]
+    newest = as_utc(max(capture.record.timestamp for capture in captures))
+    older = [c for c in captures if as_utc(c.record.timestamp) < newest]
+    server = FakeWaybackServer(older)
+    monkeypatch.setattr(
+        cdxrecords,
+        "mount_controllers",
+        lambda session, controllers: mount_fake_wayback(session, server),
+    )
+    settings = CrawlSettings(search_rate=0)
+    targets = [CrawlTarget("magic.wizards.com")]
+    try:
+        (job,) = plan_incremental_jobs(test_engine, targets, timedelta(days=1))
+        assert job.from_date is None
+        assert process_job(job, test_engine, settings).inserted == len(older)
+        with Session(test_engine) as db_session:
+            watermark = load_watermark(db_session, "magic.wizards.com")
+        assert watermark == as_utc(max(c.record.timestamp for c in older))
+
+        # A crawl that finds nothing new leaves the watermark where it was.
+        (job,) = plan_incremental_jobs(test_engine, targets, timedelta(days=1))
+        assert process_job(job, test_engine, settings).inserted == 0
+        with Session(test_engine) as db_session:
+            assert load_watermark(db_session, "magic.wizards.com") == watermark
+
+        # The next crawl searches the same window again, and only finds
+        # captures since the watermark.
+        server.captures = captures
+        (job,) = plan_incremental_jobs(test_engine, targets, timedelta(days=1))
+        assert job.from_date == watermark - timedelta(days=1)
+        ingest = process_job(job, test_engine, settings)
+        assert ingest.inserted == len(captures) - len(older)
+        assert ingest.inserted + ingest.skipped < len(captures)
+        with Session(test_engine) as db_session:
+            assert load_watermark(db_session, "magic.wizards.com") == newest
+    finally:
+        server.close()
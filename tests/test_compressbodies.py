@@ -0,0 +1,86 @@
+"""Tests for compressing memento bodies."""
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from gatherspecimens import compression
+from gatherspecimens.compressbodies import (move_inline_content,
+                                            recompress_blobs, train)
+from gatherspecimens.schema import (CompressionDictionary, MementoBlob,
+                                    MementoSpecimen)
+
+
+@pytest.mark.parametrize(
+    "codec", [compression.IDENTITY, compression.ZLIB, compression.ZSTD]
+)
+def test_compress_round_trip(codec):
+    """Every codec decompresses to the original data."""
+    if codec == compression.ZSTD:
+        pytest.importorskip("zstandard")
+    data = b"<html>" + b"magic " * 1000 + b"</html>"
+    compressed = compression.compress(data, codec)
+    assert compression.decompress(compressed, codec) == data
+
+
+def test_move_and_recompress(test_data_engine):
+    """Inline bodies move into compressed blobs and keep their content."""
+    pytest.importorskip("zstandard")
+    with Session(test_data_engine) as db_session:
+        originals = {m.id: m.content for m in db_session.query(MementoSpecimen)}
+
+    moved = move_inline_content(test_data_engine, 5, compression.ZLIB, {})
+    assert moved == len(originals)
+
+    train(test_data_engine, "magic.wizards.com", samples=50, size=4096)
+    with Session(test_data_engine) as db_session:
+        dictionaries = CompressionDictionary.latest_by_name(db_session)
+    assert "magic.wizards.com" in dictionaries
+
+    recompressed = recompress_blobs(test_data_engine, 5, compression.ZSTD, dictionaries)
+    assert recompressed > 0
+    assert recompress_blobs(test_data_engine, 5, compression.ZSTD, dictionaries) == 0
+
+    with Session(test_data_engine) as db_session:
+        for memento in db_session.query(MementoSpecimen):
+            assert memento.html_content is None
+            assert memento.content == originals[memento.id]
+        codecs = {blob.codec for blob in db_session.query(MementoBlob)}
+    assert codecs == {compression.ZSTD}
+
+    # Blobs using an older dictionary are recompressed with a newly trained one.
+    train(test_data_engine, "magic.wizards.com", samples=50, size=4096)
+    with Session(test_data_engine) as db_session:
+        retrained = CompressionDictionary.latest_by_name(db_session)
+    latest_id = retrained["magic.wizards.com"].id
+    assert latest_id != dictionaries["magic.wizards.com"].id
+    assert recompress_blobs(test_data_engine, 5, compression.ZSTD, retrained) > 0
+
+    with Session(test_data_engine) as db_session:
+        dictionary_ids = {blob.dictionary_id for blob in db_session.query(MementoBlob)}
+        assert dictionaries["magic.wizards.com"].id not in dictionary_ids
+        assert latest_id in dictionary_ids
+        for memento in db_session.query(MementoSpecimen):
+            assert memento.content == originals[memento.id]
+
+
+def test_recompress_skips_current_blobs(test_data_engine):
+    """Blobs already stored with the codec aren't selected, or their content read."""
+    move_inline_content(test_data_engine, 5, compression.ZLIB, {})
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(test_data_engine, "before_cursor_execute", record)
+    try:
+        assert recompress_blobs(test_data_engine, 5, compression.ZLIB, {}) == 0
+    finally:
+        event.remove(test_data_engine, "before_cursor_execute", record)
+    assert statements
+    assert not any("memento_blob.content" in statement for statement in statements)
+
+    assert recompress_blobs(test_data_engine, 5, compression.IDENTITY, {}) > 0
+    with Session(test_data_engine) as db_session:
+        codecs = {blob.codec for blob in db_session.query(MementoBlob)}
+    assert codecs == {compression.IDENTITY}
@@ -0,0 +1,75 @@
+"""Tests for classifying failures and retrying them."""
+
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy.orm import Session
+from wayback.exceptions import (BlockedByRobotsError, MementoPlaybackError,
+                                NoMementoError, WaybackRetryError)
+
+from gatherspecimens import failures
+from gatherspecimens.gather import new_page
+from gatherspecimens.schema import (CdxRecordSpecimen, MementoFailure,
+                                    MementoSpecimen)
+from gatherspecimens.selection import pending_records, retryable_records
+
+
+def test_classification():
+    """Wayback and connection errors are transient; memento errors are permanent."""
+
+    def transient(error: BaseException) -> bool:
+        return failures.error_reason(error) in failures.TRANSIENT_REASONS
+
+    assert transient(WaybackRetryError(20, 10.0, ConnectionError()))
+    assert transient(ConnectionError())
+    # The client raises this when the Wayback Machine keeps failing.
+    assert transient(MementoPlaybackError("503 error while loading memento at x"))
+    assert not transient(MementoPlaybackError("Memento at x could not be played"))
+    assert not transient(NoMementoError("x"))
+    assert not transient(BlockedByRobotsError("x"))
+    assert failures.ERROR_STATUS not in failures.TRANSIENT_REASONS
+
+
+def test_retry_backoff(test_data_engine):
+    """Transient failures are retried with exponential backoff, then given up."""
+    now = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    with Session(test_data_engine) as db_session:
+        gathered = {m.id for m in db_session.query(MementoSpecimen)}
+        ungathered = [
+            r.id
+            for r in db_session.query(CdxRecordSpecimen).order_by(CdxRecordSpecimen.id)
+            if r.id not in gathered
+        ]
+        transient, permanent = ungathered[:2]
+
+        failures.record_failure(db_session, permanent, failures.PLAYBACK, now)
+        for attempt in range(1, failures.MAX_ATTEMPTS):
+            failure = failures.record_failure(
+                db_session, transient, failures.EXCEPTION, now
+            )
+            assert failure.attempts == attempt
+            assert failure.next_attempt == now + failures.RETRY_BACKOFF * 2 ** (
+                attempt - 1
+            )
+        db_session.commit()
+
+        pending = [row.id for row in db_session.execute(pending_records(0, 1000))]
+        assert transient not in pending and permanent not in pending
+
+        def retryable(at: datetime):
+            query = retryable_records(0, 1000, now=at)
+            return [row.id for row in db_session.execute(query)]
+
+        assert retryable(now) == []
+        assert retryable(now + timedelta(days=30)) == [transient]
+
+        failure = failures.record_failure(db_session, transient, failures.EXCEPTION)
+        assert failure.attempts == failures.MAX_ATTEMPTS
+        assert failure.next_attempt is None
+
+        # A record gathered after failing has its failure cleared.
+        page = new_page(db_session.get(CdxRecordSpecimen, permanent))
+        page.html_content = b"<html></html>"
+        db_session.add(page)
+        db_session.commit()
+        assert failures.clear_recovered_failures(db_session) == 1
+        assert db_session.get(MementoFailure, permanent) is None
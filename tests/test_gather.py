@@ -0,0 +1,70 @@
+"""Tests for storing gathered mementos."""
+
+from typing import List, NamedTuple
+
+from sqlalchemy.orm import Session
+from wayback import CdxRecord
+from wayback.exceptions import MementoPlaybackError
+
+from gatherspecimens.gather import group_by_digest, stored_group_results
+from gatherspecimens.schema import (CdxRecordSpecimen, MementoBlob,
+                                    MementoFailure, MementoSpecimen)
+
+
+class FakeMemento(NamedTuple):
+    """A memento as returned by a fetch."""
+
+    ok: bool
+    status_code: int
+    content: bytes
+
+
+def same_digest_records(records: List[CdxRecord]) -> List[CdxRecordSpecimen]:
+    """Create records that all share one digest."""
+    return [
+        CdxRecordSpecimen(
+            **{
+                **CdxRecordSpecimen.values_from_cdx_record(record),
+                "id": index,
+                "digest": "SAMEDIGEST",
+            }
+        )
+        for index, record in enumerate(records, start=1)
+    ]
+
+
+def test_group_stored_once(test_engine, test_cdx_records):
+    """A digest group is fetched once and the rest are stored as duplicates."""
+    specimens = same_digest_records(test_cdx_records[:3])
+    groups = group_by_digest(specimens)
+    assert list(groups) == ["SAMEDIGEST"]
+
+    with Session(test_engine) as db_session:
+        results = stored_group_results(
+            db_session,
+            groups["SAMEDIGEST"],
+            FakeMemento(True, 200, b"<html></html>"),
+            None,
+            {},
+        )
+        db_session.commit()
+
+        assert results == {1: "gathered", 2: "deduplicated", 3: "deduplicated"}
+        assert db_session.query(MementoBlob).count() == 1
+        assert db_session.get(MementoSpecimen, 3).content == b"<html></html>"
+
+
+def test_group_failure_skips_rest(test_engine, test_cdx_records):
+    """If the first fetch of a group fails, the rest are left for later."""
+    specimens = same_digest_records(test_cdx_records[:2])
+
+    with Session(test_engine) as db_session:
+        results = stored_group_results(
+            db_session, specimens, None, MementoPlaybackError("nope"), {}
+        )
+        db_session.commit()
+
+        assert results[1].startswith("memento playback error")
+        assert results[2].startswith("skipped")
+        assert db_session.query(MementoFailure).count() == 1
+        assert db_session.query(MementoSpecimen).count() == 0
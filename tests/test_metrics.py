@@ -0,0 +1,66 @@
+"""Tests for metrics and their export."""
+
+import json
+import urllib.request
+
+import pytest
+
+from gatherspecimens import metrics
+from gatherspecimens.metrics import (Counter, Histogram, Registry, serve,
+                                     start_exporter, write_textfile)
+
+
+@pytest.fixture
+def registry():
+    """Create a registry with a counter and a histogram."""
+    registry = Registry()
+    results = registry.register(Counter("results_total", "Results.", ["result"]))
+    latency = registry.register(Histogram("latency_seconds", "Latency.", buckets=[1]))
+    results.inc(result="gathered")
+    results.inc(2, result='say "hi"')
+    latency.observe(0.5)
+    latency.observe(3)
+    return registry
+
+
+def test_render(registry):
+    """Metrics are rendered in Prometheus text format."""
+    lines = registry.render().splitlines()
+    assert "# TYPE results_total counter" in lines
+    assert 'results_total{result="gathered"} 1.0' in lines
+    assert 'results_total{result="say \\"hi\\""} 2.0' in lines
+    assert "# TYPE latency_seconds histogram" in lines
+    assert 'latency_seconds_bucket{le="1.0"} 1' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 2' in lines
+    assert "latency_seconds_sum 3.5" in lines
+    assert "latency_seconds_count 2" in lines
+
+    with pytest.raises(ValueError):
+        registry.metrics["results_total"].inc(outcome="wrong label")
+
+
+def test_export(registry, tmp_path):
+    """Metrics are served over HTTP and written to files."""
+    server = serve(0, "127.0.0.1", registry)
+    try:
+        port = server.server_address[1]
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            assert response.read().decode() == registry.render()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    path = tmp_path / "metrics.prom"
+    write_textfile(path, registry)
+    assert path.read_text() == registry.render()
+
+
+def test_exporter_port_offset(tmp_path, monkeypatch):
+    """Processes that serve their own metrics offset the configured port."""
+    served = []
+    monkeypatch.setattr(metrics, "serve", lambda port, host: served.append(port))
+    config_file = tmp_path / "config.json"
+    config_file.write_text(json.dumps({"metrics": {"port": 9101}}))
+    start_exporter(config_file)
+    start_exporter(config_file, port_offset=2)
+    assert served == [9101, 9103]
@@ -0,0 +1,95 @@
+"""Tests for finding near-duplicate captures."""
+
+from datetime import timedelta
+
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from gatherspecimens import nearduplicates
+from gatherspecimens.nearduplicates import (distance, fingerprint, page_words,
+                                            simhash, url_clusters, word_hashes)
+from gatherspecimens.schema import (CdxRecordSpecimen, MementoFingerprint,
+                                    MementoSpecimen)
+
+TEXT = " ".join(f"word{n % 97} filler{n % 13}" for n in range(400))
+
+
+def test_simhash():
+    """Similar texts have close SimHashes, and different texts distant ones."""
+    original = simhash(word_hashes(TEXT))
+    assert simhash(word_hashes(TEXT.upper())) == original
+    assert distance(simhash(word_hashes(TEXT + " updated 12:00")), original) <= 3
+    other = simhash(word_hashes(" ".join(f"other{n}" for n in range(400))))
+    assert distance(other, original) > 10
+    assert simhash([]) == 0
+
+
+def test_page_words():
+    """Only the text is hashed, or the raw HTML if the parser fails on it."""
+    assert page_words(b"<p>One <b>two</b></p><script>x</script>") == word_hashes(
+        "One two"
+    )
+    broken = "<![foo ]><p>One"
+    assert page_words(broken.encode()) == word_hashes(broken)
+
+
+def test_simhashes_numpy(monkeypatch):
+    """Vectorized SimHashes are the same as those computed in pure Python."""
+    pytest.importorskip("numpy")
+    pages = [word_hashes(TEXT), [], word_hashes("one"), word_hashes("a b c d")]
+    vectorized = nearduplicates.simhashes(pages)
+    monkeypatch.setattr(nearduplicates, "numpy", None)
+    assert vectorized == nearduplicates.simhashes(pages)
+
+
+def test_fingerprint(test_data_engine):
+    """New captures are fingerprinted and join the cluster of their near-duplicates."""
+    with Session(test_data_engine) as db_session:
+        html_count = db_session.scalar(
+            select(func.count())
+            .select_from(MementoSpecimen)
+            .where(MementoSpecimen.mime_type.like("text/html%"))
+        )
+    assert fingerprint(test_data_engine) == (html_count, 0)
+    assert fingerprint(test_data_engine) == (0, 0)
+
+    # A later capture of a page, differing only in a line of text.
+    with Session(test_data_engine) as db_session:
+        memento = db_session.get(MementoSpecimen, 1175908)
+        record = db_session.get(CdxRecordSpecimen, 1175908)
+        url = record.url
+        content = memento.content.replace(b"</body>", b"<p>Updated.</p></body>")
+        db_session.add(
+            CdxRecordSpecimen(
+                id=1,
+                hash_raw_url="later",
+                key=record.key,
+                timestamp=record.timestamp + timedelta(days=1),
+                url=record.url,
+                mime_type=record.mime_type,
+                status_code=record.status_code,
+                digest="later",
+                raw_url=record.raw_url,
+                view_url=record.view_url,
+            )
+        )
+        db_session.add(
+            MementoSpecimen(
+                id=1,
+                hash_raw_url="later",
+                raw_url=memento.raw_url,
+                url=memento.url,
+                mime_type=memento.mime_type,
+                status_code=memento.status_code,
+                time=memento.time + timedelta(days=1),
+                view_url=memento.view_url,
+                html_content=content,
+            )
+        )
+        db_session.commit()
+
+    assert fingerprint(test_data_engine) == (1, 1)
+    with Session(test_data_engine) as db_session:
+        assert db_session.get(MementoFingerprint, 1).cluster == 1175908
+        assert url_clusters(db_session, url) == {1175908: [1175908, 1]}
@@ -0,0 +1,60 @@
+"""Tests for planning which prefixes to crawl."""
+
+import json
+
+from gatherspecimens.cdxfilters import CdxFilter
+from gatherspecimens.planner import (CrawlTarget, load_targets, plan_targets,
+                                     urlkey_prefix)
+
+
+def test_load_targets(tmp_path):
+    """Input entries are prefixes, or objects with a prefix and filter rules."""
+    input_file = tmp_path / "input.json"
+    input_file.write_text(
+        json.dumps(["example.com", {"url": "example.org", "collapse": "digest"}])
+    )
+    assert load_targets(input_file) == [
+        CrawlTarget("example.com"),
+        CrawlTarget("example.org", CdxFilter(collapse="digest")),
+    ]
+
+
+def test_urlkey_prefix():
+    """Prefixes are compared by the keys they match, ignoring scheme and www."""
+    assert (
+        urlkey_prefix("www.wizards.com/Magic/Magazine") == "com,wizards)/magic/magazine"
+    )
+    assert urlkey_prefix("https://WWW2.wizards.com/default.asp") == (
+        "com,wizards)/default.asp"
+    )
+    assert urlkey_prefix("magic.wizards.com") == "com,wizards,magic)/"
+    assert urlkey_prefix("http://localhost:8080/a?b=1") == "localhost:8080)/a?b=1"
+
+
+def test_plan_targets():
+    """Overlapping prefixes are merged, and differing rules are kept apart."""
+    html = CdxFilter(mime_types=("text/html",))
+    targets = [
+        CrawlTarget("magic.wizards.com/en/events"),
+        CrawlTarget("www.wizards.com/Magic/Magazine"),
+        CrawlTarget("www.wizards.com/default.asp"),
+        CrawlTarget("wizards.com/Magic/Magazine"),
+        CrawlTarget("wizards.com/default.asp"),
+        CrawlTarget("wizards.com/Magic/Magazine/Article.aspx"),
+        CrawlTarget("https://magic.wizards.com/en"),
+        CrawlTarget("magic.wizards.com/en/articles", html),
+    ]
+    planned = plan_targets(targets)
+
+    assert [target.url for target in planned] == [
+        "www.wizards.com/Magic/Magazine",
+        "www.wizards.com/default.asp",
+        "https://magic.wizards.com/en",
+        "magic.wizards.com/en/articles",
+    ]
+    # The broader prefix leaves the captures with their own rules to the other.
+    assert planned[2].cdx_filter.exclude_urlkeys == ("com,wizards,magic)/en/articles",)
+    assert planned[2].cdx_filter.filter_fields() == [
+        r"!urlkey:com,wizards,magic\)/en/articles.*"
+    ]
+    assert planned[3].cdx_filter == html
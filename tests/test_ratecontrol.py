@@ -0,0 +1,73 @@
+"""Tests for adaptive rate control."""
+
+import pytest
+import wayback
+
+from gatherspecimens.ratecontrol import (AdaptiveRateController,
+                                         LocalRateState, RateControlledAdapter,
+                                         RateLimits, RedisRateState,
+                                         mount_controllers)
+
+LIMITS = RateLimits(
+    initial_rate=10.0, min_rate=1.0, max_rate=20.0, decrease_hold=0.0, latency_limit=5
+)
+
+
+def redis_state():
+    """Create rate state in a fake Redis server."""
+    fakeredis = pytest.importorskip("fakeredis")
+    return RedisRateState(fakeredis.FakeRedis(), "test")
+
+
+@pytest.fixture(params=["local", "redis"])
+def state(request):
+    """Rate state from each backend."""
+    if request.param == "redis":
+        return redis_state()
+    return LocalRateState(LIMITS)
+
+
+def test_aimd(state):
+    """Errors and slow responses halve the rate; successes raise it slowly."""
+    controller = AdaptiveRateController(state, LIMITS)
+    controller.record(429, 0.1)
+    assert state.increase(LIMITS) == pytest.approx(5.0 + 1 / 5.0)
+    controller.record(None, 0.1)
+    controller.record(200, 30.0)
+    assert state.decrease(LIMITS) == pytest.approx(1.0)
+    for _ in range(1000):
+        controller.record(200, 0.1)
+    assert state.decrease(LIMITS) == pytest.approx(10.0)
+
+
+def test_reserve_spaces_requests(state):
+    """Consecutive reservations are spaced by the current rate."""
+    assert state.reserve(LIMITS) == pytest.approx(0.0, abs=0.01)
+    assert state.reserve(LIMITS) == pytest.approx(0.1, abs=0.01)
+    assert state.reserve(LIMITS) == pytest.approx(0.2, abs=0.01)
+
+
+def test_decrease_hold():
+    """Bursts of errors only decrease the rate once per hold period."""
+    limits = RateLimits(initial_rate=8.0, decrease_hold=60.0)
+    state = LocalRateState(limits)
+    assert state.decrease(limits) == 4.0
+    assert state.decrease(limits) == 4.0
+
+
+def test_mount_controllers():
+    """Each API's requests go through its own controller."""
+    controllers = {
+        name: AdaptiveRateController(LocalRateState(LIMITS), LIMITS)
+        for name in ("memento", "search")
+    }
+    session = wayback.WaybackSession()
+    mount_controllers(session, controllers)
+
+    memento_adapter = session.get_adapter("https://web.archive.org/web/2000/x.com")
+    search_adapter = session.get_adapter("https://web.archive.org/cdx/search/cdx")
+    assert isinstance(memento_adapter, RateControlledAdapter)
+    assert memento_adapter.controller is controllers["memento"]
+    assert search_adapter.controller is controllers["search"]
+    assert session.memento_calls_per_second == 0
+    assert session.search_calls_per_second == 0
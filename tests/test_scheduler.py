@@ -0,0 +1,111 @@
+"""Tests for the sliding window task scheduler."""
+
+import pytest
+from vine import promise
+
+from gatherspecimens.scheduler import SlidingWindow
+
+
+class FakeBackend:
+    """A results backend that reports finished tasks, or has them polled."""
+
+    def __init__(self, is_async):
+        """Set up the backend."""
+        self.is_async = is_async
+        self.result_consumer = self
+        self.results = []
+        self.polls = 0
+
+    def drain_events_until(self, p):
+        """Receive results, a check of every task at a time, until p is ready."""
+        while not p.ready:
+            for result in self.results:
+                result.check()
+            yield
+
+
+class FakeResult:
+    """A task result that finishes after being checked a number of times."""
+
+    def __init__(self, task_id, checks, value, backend):
+        """Set up the result."""
+        self.id = task_id
+        self.checks = checks
+        self.value = value
+        self.backend = backend
+        self.on_ready = promise()
+        self.forgotten = False
+
+    def then(self, callback):
+        """Call back with the result once the task has finished."""
+        self.backend.results.append(self)
+        self.on_ready.then(callback)
+
+    def check(self):
+        """Count a check, and finish the task once enough have been made."""
+        self.checks -= 1
+        if self.checks < 0 and not self.on_ready.ready:
+            self.on_ready(self)
+
+    def ready(self):
+        """Return whether the task has finished."""
+        self.backend.polls += 1
+        self.check()
+        return self.on_ready.ready
+
+    def get(self):
+        """Return the task's value, or raise its error."""
+        if isinstance(self.value, Exception):
+            raise self.value
+        return self.value
+
+    def forget(self):
+        """Forget the task's result."""
+        self.forgotten = True
+
+
+class FakeSignature:
+    """A task signature that records when it was sent."""
+
+    def __init__(self, result, sent):
+        """Set up the signature."""
+        self.result = result
+        self.sent = sent
+
+    def apply_async(self):
+        """Send the task."""
+        self.sent.append(self.result.id)
+        return self.result
+
+
+@pytest.mark.parametrize("is_async", [True, False])
+def test_sliding_window(is_async):
+    """Finished tasks are replaced at once, without waiting for slow ones."""
+    backend = FakeBackend(is_async)
+    sent = []
+    results = [FakeResult("slow", 100, "slow", backend)] + [
+        FakeResult(str(i), 1, i, backend) for i in range(10)
+    ]
+    results.append(FakeResult("error", 0, ValueError("boom"), backend))
+
+    window = SlidingWindow(3, poll_interval=0)
+    outcomes = []
+    for outcome in window.run(FakeSignature(result, sent) for result in results):
+        assert window.in_flight <= 3
+        outcomes.append(outcome)
+
+    assert outcomes[-1].task_id == "slow"
+    assert [o.value for o in outcomes[:10]] == list(range(10))
+    error = next(o for o in outcomes if o.task_id == "error")
+    assert isinstance(error.error, ValueError)
+    assert len(sent) == len(results)
+    assert window.in_flight == 0
+    assert all(result.forgotten for result in results)
+    # Backends that report finished tasks are never polled.
+    assert (backend.polls == 0) == is_async
+
+
+def test_window_size():
+    """Windows need room for at least one task."""
+    with pytest.raises(ValueError):
+        SlidingWindow(0)
@@ -0,0 +1,76 @@
+"""Tests for the database schema."""
+
+from datetime import timezone
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+
+from gatherspecimens.schema import (CdxRecordSpecimen, MementoBlob,
+                                    MementoSpecimen, create_schema)
+
+
+def test_memento_content_from_blob(test_engine, test_cdx_records):
+    """Mementos sharing a digest share one stored blob."""
+    with Session(test_engine) as db_session:
+        for record_id, record in enumerate(test_cdx_records[:2], start=1):
+            MementoBlob.store(db_session, "SAMEDIGEST", f"page {record_id}".encode())
+            db_session.add(
+                MementoSpecimen(
+                    id=record_id,
+                    hash_raw_url=str(record_id),
+                    raw_url=record.raw_url,
+                    url=record.url,
+                    mime_type=record.mime_type,
+                    status_code=record.status_code,
+                    time=record.timestamp,
+                    view_url=record.view_url,
+                    digest="SAMEDIGEST",
+                )
+            )
+        db_session.commit()
+
+        assert MementoBlob.exists(db_session, "SAMEDIGEST")
+        assert not MementoBlob.exists(db_session, "OTHERDIGEST")
+        assert db_session.query(MementoBlob).count() == 1
+        assert db_session.get(MementoSpecimen, 2).content == b"page 1"
+
+
+def test_create_schema_adds_columns(tmp_path):
+    """Columns added to a model are added to an existing table."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE memento_failure (id INTEGER PRIMARY KEY)"))
+        conn.execute(
+            text(
+                "CREATE TABLE memento_specimen (id INTEGER PRIMARY KEY, "
+                "hash_raw_url VARCHAR(64), raw_url TEXT, url TEXT, "
+                "mime_type VARCHAR, status_code INTEGER, time DATETIME, "
+                "view_url TEXT, html_content BLOB)"
+            )
+        )
+
+    create_schema(engine)
+    create_schema(engine)
+
+    with engine.connect() as conn:
+        columns = [
+            row[1] for row in conn.execute(text("PRAGMA table_info(memento_specimen)"))
+        ]
+    assert "digest" in columns
+
+
+def test_packed_records(test_db_session):
+    """Records loaded by id and packed records match the stored records."""
+    records = test_db_session.query(CdxRecordSpecimen).order_by("id").limit(3).all()
+    ids = [record.id for record in records]
+
+    loaded = CdxRecordSpecimen.load_many(test_db_session, ids + [10**9])
+    assert sorted(loaded) == ids
+
+    for record in records:
+        unpacked = CdxRecordSpecimen.from_packed(CdxRecordSpecimen.to_packed(record))
+        assert unpacked.to_serializable() == {
+            **record.to_serializable(),
+            "timestamp": record.timestamp.replace(tzinfo=timezone.utc),
+        }
+        assert loaded[record.id].to_cdx_record() == record.to_cdx_record()
@@ -0,0 +1,42 @@
+"""Tests for searching extracted articles."""
+
+from sqlalchemy.orm import Session
+
+from gatherspecimens.extractarticles import extract
+from gatherspecimens.schema import Article
+from gatherspecimens.search import create_search_index, fts5_query, search
+
+
+def test_fts5_query():
+    """Web search syntax is translated, with every term quoted."""
+    assert fts5_query("modern standard") == '"modern" AND "standard"'
+    assert fts5_query('"latest developments" -modern') == (
+        '"latest developments" NOT "modern"'
+    )
+    assert fts5_query("draft or sealed rules") == '("draft" OR "sealed") AND "rules"'
+    assert fts5_query('a"b') == '"a""b"'
+    assert fts5_query("-modern") is None
+
+
+def test_search(test_data_engine):
+    """The index covers articles stored before and after it was created."""
+    extract(test_data_engine, batch_size=10, workers=1)
+    create_search_index(test_data_engine)
+
+    results = search(test_data_engine, "parley")
+    assert results[0].memento_id == 1175908
+    assert results[0].url.startswith("http")
+    # The article's title matches, so it ranks above pages that only mention it.
+    assert all(result.rank <= results[0].rank for result in results)
+
+    assert [r.memento_id for r in search(test_data_engine, '"Vanguard supplements"')]
+    excluded = search(test_data_engine, "parley -conspiracy")
+    assert 1175908 not in [r.memento_id for r in excluded]
+
+    # Articles stored or removed later are reflected in the index.
+    with Session(test_data_engine) as db_session:
+        db_session.delete(db_session.get(Article, 1175908))
+        db_session.commit()
+    assert 1175908 not in [r.memento_id for r in search(test_data_engine, "parley")]
+    extract(test_data_engine, batch_size=10, workers=1)
+    assert search(test_data_engine, "parley")[0].memento_id == 1175908
@@ -0,0 +1,151 @@
+"""Tests for selecting CDX records to gather."""
+
+from datetime import datetime, timezone
+from typing import List
+
+from sqlalchemy.orm import Session
+
+from gatherspecimens.schema import (CdxRecordSpecimen, GatherPriority,
+                                    MementoFingerprint, MementoSpecimen)
+from gatherspecimens.selection import (COLLAPSE, EARLIEST, LATEST, SKIP,
+                                       SPREAD, pending_records, prioritize)
+
+
+def test_pending_records(test_db_session: Session):
+    """Pending records exclude gathered records and page through by id."""
+    gathered = {m.id for m in test_db_session.query(MementoSpecimen)}
+    expected = [
+        r.id
+        for r in test_db_session.query(CdxRecordSpecimen).order_by(CdxRecordSpecimen.id)
+        if r.id not in gathered and (r.status_code is None or r.status_code < 400)
+    ]
+
+    selected: List[int] = []
+    last_id = 0
+    while rows := test_db_session.execute(pending_records(last_id, 3)).all():
+        selected.extend(row.id for row in rows)
+        last_id = rows[-1].id
+
+    assert selected == expected
+
+    # The selected columns are enough to rebuild the record.
+    row = test_db_session.execute(pending_records(0, 1)).one()
+    record = CdxRecordSpecimen.from_serializable(row._asdict())
+    stored = test_db_session.get_one(CdxRecordSpecimen, row.id)
+    assert record.to_serializable() == stored.to_serializable()
+
+
+def add_capture(
+    db_session: Session,
+    record_id: int,
+    path: str,
+    timestamp: datetime,
+    digest: str = "",
+    status_code: int = 200,
+) -> CdxRecordSpecimen:
+    """Add a CDX record for a capture of a page on example.com."""
+    url = f"http://example.com{path}"
+    record = CdxRecordSpecimen(
+        id=record_id,
+        hash_raw_url=str(record_id),
+        key=f"com,example){path}",
+        timestamp=timestamp,
+        url=url,
+        mime_type="text/html",
+        status_code=status_code,
+        digest=digest or str(record_id),
+        raw_url=url,
+        view_url=url,
+    )
+    db_session.add(record)
+    return record
+
+
+def test_near_duplicate_policies(test_engine):
+    """Captures between near-duplicates are skipped, and unchanging URLs collapsed."""
+    # Captures 1, 3 and 5 of /a are gathered, and 1 and 3 are near-duplicates.
+    # Captures 6 and 7 of /b are gathered, and are near-duplicates.
+    captures = [
+        (1, "/a", 1),
+        (2, "/a", None),
+        (3, "/a", 1),
+        (4, "/a", None),
+        (5, "/a", 5),
+        (6, "/b", 6),
+        (7, "/b", 6),
+        (8, "/b", None),
+    ]
+    with Session(test_engine) as db_session:
+        for record_id, path, cluster in captures:
+            timestamp = datetime(2020, 1, record_id, tzinfo=timezone.utc)
+            record = add_capture(db_session, record_id, path, timestamp)
+            if cluster is None:
+                continue
+            db_session.add(
+                MementoSpecimen(
+                    id=record_id,
+                    hash_raw_url=record.hash_raw_url,
+                    raw_url=record.url,
+                    url=record.url,
+                    mime_type="text/html",
+                    time=timestamp.replace(tzinfo=None),
+                    view_url=record.url,
+                    html_content=b"",
+                )
+            )
+            db_session.add(
+                MementoFingerprint(
+                    memento_id=record_id,
+                    url=record.url,
+                    timestamp=timestamp,
+                    simhash=0,
+                    cluster=cluster,
+                )
+            )
+        db_session.commit()
+
+        def selected(policy):
+            rows = db_session.execute(
+                pending_records(0, 10, near_duplicates=policy)
+            ).all()
+            return [row.id for row in rows]
+
+        assert selected(None) == [2, 4, 8]
+        assert selected(SKIP) == [4, 8]
+        assert selected(COLLAPSE) == [4]
+
+
+def test_priority_rounds(test_engine):
+    """Prioritized rounds cover every URL, and then distinct digests, first."""
+    with Session(test_engine) as db_session:
+        add_capture(db_session, 1, "/a", datetime(2019, 1, 1, tzinfo=timezone.utc))
+        add_capture(db_session, 2, "/a", datetime(2019, 6, 1, tzinfo=timezone.utc))
+        add_capture(db_session, 3, "/a", datetime(2020, 3, 1, tzinfo=timezone.utc), "1")
+        add_capture(db_session, 4, "/a", datetime(2020, 4, 1, tzinfo=timezone.utc))
+        add_capture(
+            db_session, 5, "/a", datetime(2021, 1, 1, tzinfo=timezone.utc), "", 301
+        )
+        add_capture(db_session, 6, "/b", datetime(2019, 1, 1, tzinfo=timezone.utc))
+        add_capture(
+            db_session, 7, "/c", datetime(2019, 1, 1, tzinfo=timezone.utc), "", 404
+        )
+        db_session.commit()
+
+        def rounds(order):
+            assert prioritize(db_session, order) == 5
+            return {
+                row.record_id: row.round
+                for row in db_session.query(GatherPriority).order_by(
+                    GatherPriority.record_id
+                )
+            }
+
+        # The redirect comes last, and a repeated digest after distinct ones.
+        assert rounds(LATEST) == {1: 4, 2: 3, 3: 2, 4: 1, 5: 5, 6: 1}
+        assert rounds(EARLIEST) == {1: 1, 2: 2, 3: 4, 4: 3, 5: 5, 6: 1}
+        # The latest capture of 2019 comes before the second latest of 2020.
+        assert rounds(SPREAD) == {1: 4, 2: 2, 3: 3, 4: 1, 5: 5, 6: 1}
+
+        # Each round is selected on its own, by id.
+        rows = db_session.execute(pending_records(0, 10, priority_round=1)).all()
+        assert [row.id for row in rows] == [4, 6]
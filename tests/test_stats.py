@@ -0,0 +1,67 @@
+"""Tests for gathering statistics."""
+
+from dataclasses import replace
+from datetime import timedelta
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from gatherspecimens import blobstore, compression
+from gatherspecimens.blobstore import FileSystemStore
+from gatherspecimens.cdxrecords import CrawlJob, save_checkpoint
+from gatherspecimens.compressbodies import move_inline_content, offload_blobs
+from gatherspecimens.schema import CdxRecordSpecimen, MementoSpecimen
+from gatherspecimens.selection import pending_records
+from gatherspecimens.stats import progress, take_snapshot
+
+
+def test_snapshot(test_data_engine):
+    """Snapshots count rows, content and records per prefix."""
+    job = CrawlJob("magic.wizards.com", None, None)
+    with Session(test_data_engine) as db_session:
+        save_checkpoint(db_session, job, "key1", completed=False, inserted=10)
+        save_checkpoint(db_session, job, "key2", completed=True, inserted=5)
+        db_session.commit()
+        cdx_records = db_session.query(CdxRecordSpecimen).count()
+        mementos = db_session.query(MementoSpecimen).count()
+        pending = db_session.scalar(
+            select(func.count()).select_from(pending_records(0, 10**9).subquery())
+        )
+
+    snapshot = take_snapshot(test_data_engine)
+    assert snapshot.cdx_records == cdx_records
+    assert snapshot.mementos == mementos
+    # Records with an error status are never gathered, so they aren't left.
+    assert snapshot.remaining == pending < cdx_records - mementos
+    assert snapshot.stored_bytes > 0
+    assert sum(snapshot.status_codes.values()) == cdx_records
+    assert snapshot.prefixes == {"magic.wizards.com": 15}
+
+
+def test_offloaded_bytes(test_data_engine, tmp_path):
+    """Content moved into a blob store still counts as stored."""
+    move_inline_content(test_data_engine, 5, compression.ZLIB, {})
+    stored_bytes = take_snapshot(test_data_engine).stored_bytes
+    assert stored_bytes > 0
+
+    blobstore.configure(FileSystemStore(tmp_path))
+    try:
+        assert offload_blobs(test_data_engine, 5) > 0
+    finally:
+        blobstore.configure(None)
+    assert take_snapshot(test_data_engine).stored_bytes == stored_bytes
+
+
+def test_progress(test_data_engine):
+    """Progress is measured between snapshots, with an ETA for the rest."""
+    current = take_snapshot(test_data_engine)
+    previous = replace(
+        current,
+        taken=current.taken - 10,
+        mementos=current.mementos - 20,
+        stored_bytes=current.stored_bytes - 1000,
+    )
+    rates = progress(previous, current)
+    assert rates.mementos_per_second == 2.0
+    assert rates.bytes_per_second == 100.0
+    assert rates.eta == timedelta(seconds=round(current.remaining / 2.0))
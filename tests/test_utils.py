@@ -0,0 +1,70 @@
+"""Tests for creating database engines from the config file."""
+
+import json
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.pool import NullPool
+
+from gatherspecimens.utils import get_engine, pool_options
+
+POSTGRES_CREDS = {
+    "user": "user",
+    "pass": "password",
+    "host": "localhost",
+    "port": 5432,
+    "database": "database",
+}
+
+
+def write_config(tmp_path, config):
+    """Write a config file and return its path."""
+    config_file = tmp_path / "config.json"
+    config_file.write_text(json.dumps(config))
+    return config_file
+
+
+def test_pool_options():
+    """Profiles set pool options, and explicit settings override them."""
+    assert pool_options({}) == {}
+    assert pool_options({"pool": "gevent", "pool_size": 8}) == {
+        "pool_size": 8,
+        "max_overflow": 0,
+        "pool_timeout": 60,
+    }
+    assert pool_options({"pool": "null", "pool_size": 8}) == {"poolclass": NullPool}
+    with pytest.raises(ValueError):
+        pool_options({"pool": "eventlet"})
+
+
+def test_postgres_engine(tmp_path):
+    """Engines for PostgreSQL get the pool profile, and gevent-friendly waiting."""
+    psycopg2_extensions = pytest.importorskip("psycopg2.extensions")
+    pytest.importorskip("gevent")
+
+    engine = get_engine(write_config(tmp_path, POSTGRES_CREDS))
+    assert engine.dialect.name == "postgresql"
+    assert psycopg2_extensions.get_wait_callback() is None
+
+    config = dict(POSTGRES_CREDS, engine={"pool": "gevent", "max_overflow": 2})
+    try:
+        engine = get_engine(write_config(tmp_path, config))
+        assert (engine.pool.size(), engine.pool._max_overflow) == (4, 2)
+        assert psycopg2_extensions.get_wait_callback() is not None
+    finally:
+        psycopg2_extensions.set_wait_callback(None)
+
+
+def test_sqlite_engine(tmp_path):
+    """Engines for SQLite use WAL without syncing every commit, and no unsafe modes."""
+    config = {"engine": {"backend": "sqlite", "path": str(tmp_path / "test.db")}}
+    engine = get_engine(write_config(tmp_path, config))
+    with engine.connect() as conn:
+        assert conn.scalar(text("PRAGMA journal_mode")) == "wal"
+        # 1 is NORMAL.
+        assert conn.scalar(text("PRAGMA synchronous")) == 1
+    engine.dispose()
+
+    config["engine"]["synchronous"] = "OFF"
+    with pytest.raises(ValueError):
+        get_engine(write_config(tmp_path, config))
@@ -0,0 +1,73 @@
+"""Tests for exporting mementos as WARC files."""
+
+import gzip
+import zlib
+
+from sqlalchemy.orm import Session
+
+from gatherspecimens import compression
+from gatherspecimens.compressbodies import move_inline_content
+from gatherspecimens.schema import MementoSpecimen
+from gatherspecimens.warcexport import CDX_HEADER, export
+
+
+def read_record(path, offset, length):
+    """Read and parse the gzip member holding a record."""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        member = f.read(length)
+    decompressor = zlib.decompressobj(wbits=31)
+    record = decompressor.decompress(member)
+    # The member holds exactly one record.
+    assert decompressor.eof and not decompressor.unused_data
+    head, _, block = record.partition(b"\r\n\r\n")
+    lines = head.decode("utf-8").split("\r\n")
+    headers = dict(line.split(": ", 1) for line in lines[1:])
+    return lines[0], headers, block[: int(headers["Content-Length"])]
+
+
+def read_index(cdx_path):
+    """Read the lines of a CDX index, split into fields."""
+    lines = cdx_path.read_text().splitlines()
+    assert lines[0] == CDX_HEADER
+    return [line.split(" ") for line in lines[1:]]
+
+
+def test_export(test_data_engine, tmp_path):
+    """Every memento is exported, and the indexes point at their records."""
+    with Session(test_data_engine) as db_session:
+        originals = {m.url: m.content for m in db_session.query(MementoSpecimen)}
+    # Store some bodies as compressed blobs, and leave the rest inline.
+    move_inline_content(test_data_engine, 5, compression.ZLIB, {})
+    with Session(test_data_engine) as db_session:
+        first = db_session.query(MementoSpecimen).order_by(MementoSpecimen.id).first()
+        first.html_content = first.content
+        db_session.commit()
+
+    stats = export(
+        test_data_engine, tmp_path, max_size=20000, batch_size=3, memory_budget=50000
+    )
+    assert stats.records == len(originals)
+    assert len(stats.files) > 1
+
+    exported = {}
+    for path in stats.files:
+        # The file as a whole reads as a single gzip stream.
+        assert gzip.decompress(path.read_bytes()).startswith(b"WARC/1.0\r\n")
+        entries = read_index(path.with_name(path.name[: -len(".warc.gz")] + ".cdx"))
+        assert entries == sorted(entries, key=" ".join)
+        for key, timestamp, url, *_, length, offset, filename in entries:
+            assert filename == path.name
+            version, headers, block = read_record(path, int(offset), int(length))
+            assert version == "WARC/1.0"
+            assert headers["WARC-Type"] == "resource"
+            assert headers["WARC-Target-URI"] == url
+            exported[url] = block
+    assert exported == originals
+
+
+def test_export_prefix(test_data_engine, tmp_path):
+    """Only mementos of URLs with the prefix are exported."""
+    stats = export(test_data_engine, tmp_path, url_prefix="https://no.such.host/")
+    assert stats.records == 0
+    assert stats.files == []